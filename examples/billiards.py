@@ -4,6 +4,8 @@ import math
 import numpy as np
 import os
 import matplotlib.pyplot as plt
+from optimizers import optimizers
+from rendering import LazyGUI
 
 real = ti.f32
 ti.init(default_fp=real, flatten_if=True)
@@ -45,6 +47,10 @@ ti.root.lazy_grad()
 dt = 0.003
 alpha = 0.00000
 learning_rate = 0.01
+# Update rule of the initial state, a key of optimizers.optimizers. Adam
+# steps every coordinate by about adam_learning_rate instead.
+optimizer_name = 'sgd'
+adam_learning_rate = 0.005
 
 
 @ti.func
@@ -97,7 +103,8 @@ def initialize():
     v[0, 0] = init_v[None]
 
 
-gui = ti.GUI("Billiards", (1024, 1024), background_color=0x3C733F)
+# Created on first use, offscreen if there is no display.
+gui = LazyGUI("Billiards", (1024, 1024), background_color=0x3C733F)
 
 
 def forward(visualize=False, output=None):
@@ -157,6 +164,11 @@ def optimize():
 
     clear()
     # forward(visualize=True, output='initial')
+    optimizer = optimizers[optimizer_name](
+        [init_x, init_v],
+        learning_rate=adam_learning_rate
+        if optimizer_name == 'adam' else learning_rate,
+        gradient_clip=None)
 
     for iter in range(200):
         clear()
@@ -169,9 +181,7 @@ def optimize():
             forward(visualize=True, output=output)
 
         print('Iter=', iter, 'Loss=', loss[None])
-        for d in range(2):
-            init_x[None][d] -= learning_rate * init_x.grad[None][d]
-            init_v[None][d] -= learning_rate * init_v.grad[None][d]
+        optimizer.step()
 
     clear()
     forward(visualize=True, output='final')
@@ -4,6 +4,7 @@ import os
 import math
 import numpy as np
 import matplotlib.pyplot as plt
+from optimizers import optimizers
 
 real = ti.f32
 ti.init(default_fp=real, arch=ti.gpu, flatten_if=True)
@@ -343,6 +344,8 @@ def visualize(s, folder):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--iters', type=int, default=100)
+    parser.add_argument('--optimizer', choices=list(optimizers), default='sgd',
+                        help='update rule of the controller')
     options = parser.parse_args()
 
     # initialization
@@ -361,6 +364,13 @@ def main():
         actuator_id[i] = scene.actuator_id[i]
         particle_type[i] = scene.particle_type[i]
 
+    # Plain gradient descent unless another rule is chosen; Adam steps every
+    # weight by about its learning rate.
+    optimizer = optimizers[options.optimizer](
+        [weights, bias],
+        learning_rate=0.01 if options.optimizer == 'adam' else 0.1,
+        gradient_clip=None)
+
     losses = []
     for iter in range(options.iters):
         with ti.ad.Tape(loss):
@@ -368,13 +378,7 @@ def main():
         l = loss[None]
         losses.append(l)
         print('i=', iter, 'loss=', l)
-        learning_rate = 0.1
-
-        for i in range(n_actuators):
-            for j in range(n_sin_waves):
-                # print(weights.grad[i, j])
-                weights[i, j] -= learning_rate * weights.grad[i, j]
-            bias[i] -= learning_rate * bias.grad[i]
+        optimizer.step()
 
         if iter % 10 == 0:
             # visualize
@@ -5,6 +5,7 @@ import math
 import numpy as np
 import os
 import matplotlib.pyplot as plt
+from optimizers import optimizers
 
 real = ti.f32
 ti.init(default_fp=real)
@@ -63,6 +64,10 @@ def allocate_fields():
 dt = 0.03
 alpha = 0.00000
 learning_rate = 2e-2
+# Update rule of the controller, a key of optimizers.optimizers. Adam steps
+# every weight by about adam_learning_rate instead.
+optimizer_name = 'sgd'
+adam_learning_rate = 1e-3
 
 K = 1e-3
 
@@ -182,6 +187,11 @@ def optimize():
 
     initialize()
     forward(visualize=True, output='initial')
+    optimizer = optimizers[optimizer_name](
+        [weight1, bias1, weight2, bias2],
+        learning_rate=adam_learning_rate
+        if optimizer_name == 'adam' else learning_rate,
+        gradient_clip=None)
 
     losses = []
     for iter in range(200000):
@@ -198,22 +208,7 @@ def optimize():
             print(iter, sum(losses))
             losses.clear()
 
-        tot = 0
-        for i in range(8):
-            for j in range(n_hidden):
-                weight1[i,
-                        j] = weight1[i, j] - weight1.grad[i, j] * learning_rate
-                tot += weight1.grad[i, j]**2
-        # print(tot)
-        for j in range(n_hidden):
-            bias1[j] = bias1[j] - bias1.grad[j] * learning_rate
-
-        for i in range(n_hidden):
-            for j in range(n_gravitation):
-                weight2[i,
-                        j] = weight2[i, j] - weight2.grad[i, j] * learning_rate
-        for j in range(n_gravitation):
-            bias2[j] = bias2[j] - bias2.grad[j] * learning_rate
+        optimizer.step()
 
     forward(visualize=True, output='final')
 
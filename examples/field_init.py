@@ -0,0 +1,47 @@
+import math
+import numpy as np
+from taichi.lang.util import to_numpy_type
+
+
+def upload(field, array):
+    """
+    Copy array into field with a single from_numpy() call instead of one
+    Python access per element. array is cast to the dtype of the field, so
+    lists, read-only skeleton arrays and columns of structured arrays can be
+    passed as they are.
+    """
+    field.from_numpy(np.ascontiguousarray(array, dtype=to_numpy_type(field.dtype)))
+
+
+def initial_rows(initial, n_rows):
+    """
+    Contents of a field whose leading axis is time: initial in row 0 and
+    zeros in the other n_rows - 1 rows.
+    """
+    initial = np.asarray(initial)
+    rows = np.zeros((n_rows,) + initial.shape, dtype=initial.dtype)
+    rows[0] = initial
+    return rows
+
+
+def stack_padded(arrays, length):
+    """
+    Stack per-robot arrays of up to length rows into one array of shape
+    (len(arrays), length, ...), padded with zeros.
+    """
+    arrays = [np.asarray(a) for a in arrays]
+    stacked = np.zeros((len(arrays), length) + arrays[0].shape[1:],
+                       dtype=arrays[0].dtype)
+    for b, a in enumerate(arrays):
+        stacked[b, :len(a)] = a
+    return stacked
+
+
+def normal_weights(shape, fan, scale, rng=np.random):
+    """
+    Controller weights of the given shape drawn in one call from a normal
+    distribution with standard deviation sqrt(2 / fan) * scale. rng is
+    np.random, a RandomState or a Generator; the first two produce the same
+    values as drawing the weights one by one in row-major order.
+    """
+    return rng.standard_normal(shape) * math.sqrt(2 / fan) * scale
@@ -0,0 +1,118 @@
+import ast
+import hashlib
+import json
+import os
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def imported_sources(path):
+    """
+    path and every module of this directory it imports, directly or through
+    other modules of this directory, sorted.
+    """
+    sources = set()
+    pending = [path]
+    while pending:
+        source = pending.pop()
+        if source in sources:
+            continue
+        sources.add(source)
+        with open(os.path.join(here, source), 'rb') as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = name.split('.')[0] + '.py'
+                if os.path.exists(os.path.join(here, module)):
+                    pending.append(module)
+    return sorted(sources)
+
+
+# Sources whose contents determine the loss curve of an evaluation: the
+# simulation and every module it imports (optimizers, seeding, ...).
+simulation_sources = imported_sources('rigid_body.py')
+
+
+def code_version(paths=simulation_sources):
+    """
+    Short hash of the simulation sources, so that cached results are not
+    reused once the simulation code changes.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(os.path.join(here, path), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+class FitnessCache:
+    """
+    In-memory and on-disk cache of loss curves, keyed by
+    (genome, shape, path, iters, seed, code version). Entries are appended to
+    a single JSON-lines file, so the cache survives across runs without
+    creating a file per evaluation.
+
+    Parameters:
+        directory (str): Directory of the cache file.
+        filename (str): Name of the cache file.
+        seeds_per_genome (int): If set, every genome is evaluated with one of
+            only this many seeds (0 .. seeds_per_genome - 1), so repeated
+            genomes are served from the cache once all of their seeds have
+            been evaluated. If None, every evaluation draws a fresh seed.
+    """
+
+    def __init__(self, directory='results', filename='fitness_cache.jsonl',
+                 seeds_per_genome=3):
+        self.filepath = os.path.join(directory, filename)
+        self.seeds_per_genome = seeds_per_genome
+        self.version = code_version()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(self.filepath):
+            with open(self.filepath) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.entries[entry['key']] = entry['losses']
+
+    def key(self, genome, shape, path, iters, seed):
+        return repr((genome, shape, path, iters, seed, self.version))
+
+    def choose_seeds(self, n, rng=None):
+        """
+        Distinct seeds for n restarts of a genome, drawn from the
+        np.random.Generator rng (None: a fresh unseeded one). With
+        seeds_per_genome, there are at most that many.
+        """
+        rng = np.random.default_rng(rng)
+        if self.seeds_per_genome is None:
+            return rng.choice(2**31, n, replace=False).tolist()
+        return rng.choice(self.seeds_per_genome, min(n, self.seeds_per_genome),
+                          replace=False).tolist()
+
+    def get(self, genome, shape, path, iters, seed):
+        """
+        Cached losses for an evaluation, or None.
+        """
+        losses = self.entries.get(self.key(genome, shape, path, iters, seed))
+        if losses is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return losses
+
+    def put(self, genome, shape, path, iters, seed, losses):
+        key = self.key(genome, shape, path, iters, seed)
+        if key in self.entries or not losses:
+            return
+        self.entries[key] = losses
+        os.makedirs(os.path.dirname(self.filepath) or '.', exist_ok=True)
+        with open(self.filepath, 'a') as f:
+            f.write(json.dumps({'key': key, 'losses': losses}) + '\n')
@@ -0,0 +1,27 @@
+import numpy as np
+
+
+def spring_incidence(anchor_a, anchor_b, n_objects):
+    """
+    CSR incidence of springs on objects, for gathering spring impulses per
+    object instead of scattering them with atomics. The ends of the springs
+    attached to object i are entries[offsets[i]:offsets[i + 1]], where end
+    2 * s is the anchor_a end of spring s and 2 * s + 1 its anchor_b end.
+
+    Parameters:
+        anchor_a, anchor_b (array): Objects the ends of every spring are
+            attached to.
+        n_objects (int): Number of objects (padded objects have no springs).
+
+    Returns:
+        offsets (array): int32 array of n_objects + 1 row offsets.
+        entries (array): int32 array of 2 * len(anchor_a) spring ends,
+            sorted by object.
+    """
+    anchors = np.concatenate([anchor_a, anchor_b]).astype(np.int64)
+    n_springs = len(anchor_a)
+    ends = np.concatenate([2 * np.arange(n_springs), 2 * np.arange(n_springs) + 1])
+    order = np.argsort(anchors, kind='stable')
+    offsets = np.zeros(n_objects + 1, dtype=np.int32)
+    offsets[1:] = np.cumsum(np.bincount(anchors, minlength=n_objects))
+    return offsets, ends[order].astype(np.int32)
@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+import sys
+
+# Taichi's offline cache of compiled kernels. Kernels are specialized on the
+# sizes of the robot fields, so every robot size adds its own entries, and
+# concurrent workers must not write the same cache directory. The layout is
+#
+#   taichi_cache/shared/     read by every worker, only written by warm_up
+#   taichi_cache/staging/k/  private copy of the shared cache for worker k,
+#                            which receives the kernels the worker compiles
+#
+# Every directory is bounded to max_cache_size bytes by Taichi's LRU cleaning,
+# which evicts the least recently used kernels when a program exits.
+cache_root = 'taichi_cache'
+max_cache_size = 256 * 2**20
+# Kernel metadata of a cache directory. The kernel files (*.tic) are named by
+# the hash of their code, so identical names always hold identical kernels.
+metadata_file = 'ticache.tcb'
+# Designs already compiled into the shared cache, see warm_up().
+warm_file = 'warm.json'
+
+
+def shared_dir():
+    return os.path.abspath(os.path.join(cache_root, 'shared'))
+
+
+def staging_dir(worker_id):
+    return os.path.abspath(os.path.join(cache_root, 'staging', str(worker_id)))
+
+
+def cache_size(directory):
+    """
+    Total size in bytes of the files in a cache directory.
+    """
+    if not os.path.isdir(directory):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(directory)
+               if entry.is_file())
+
+
+def use_cache(directory):
+    """
+    Make the next ti.init() of this process use directory as its offline
+    cache, bounded to max_cache_size bytes. Like TI_CPU_MAX_NUM_THREADS, the
+    settings are read from the environment, so this must run before Taichi
+    is imported.
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.environ['TI_OFFLINE_CACHE'] = '1'
+    os.environ['TI_OFFLINE_CACHE_FILE_PATH'] = directory
+    os.environ['TI_OFFLINE_CACHE_MAX_SIZE_OF_FILES'] = str(max_cache_size)
+    os.environ['TI_OFFLINE_CACHE_CLEANING_POLICY'] = 'lru'
+
+
+def stage(worker_id):
+    """
+    Staging directory of a worker, refreshed from the shared cache if the
+    shared cache changed since it was staged. Kernel files are hard-linked
+    (copied where links are not supported); the metadata, which Taichi
+    rewrites, is copied. Kernels the worker compiled into a stale staging
+    directory are discarded, since metadata cannot be merged.
+    """
+    shared = shared_dir()
+    staging = staging_dir(worker_id)
+    shared_metadata = os.path.join(shared, metadata_file)
+    staged_metadata = os.path.join(staging, metadata_file)
+    if not os.path.exists(shared_metadata):
+        os.makedirs(staging, exist_ok=True)
+        return staging
+    if (os.path.exists(staged_metadata) and
+            os.path.getmtime(staged_metadata) >= os.path.getmtime(shared_metadata)):
+        return staging
+
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    for entry in os.scandir(shared):
+        if not entry.name.endswith('.tic'):
+            continue
+        target = os.path.join(staging, entry.name)
+        try:
+            os.link(entry.path, target)
+        except OSError:
+            shutil.copyfile(entry.path, target)
+    shutil.copy2(shared_metadata, staged_metadata)
+    return staging
+
+
+def configure_worker(worker_id):
+    """
+    WorkerPool initializer: point the worker's Taichi at its staging
+    directory.
+    """
+    use_cache(stage(worker_id))
+
+
+def configure_shared(worker_id=None):
+    """
+    WorkerPool initializer of the process that writes the shared cache.
+    """
+    use_cache(shared_dir())
+
+
+def warmed_designs():
+    """
+    Keys of the designs warm_up() has compiled into the shared cache.
+    """
+    path = os.path.join(cache_root, warm_file)
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(json.load(f))
+
+
+def warm_up(target, jobs, key):
+    """
+    Compile kernels into the shared cache before the workers start. Every job
+    is run by target (a top-level function) in a single process that owns
+    the shared cache, e.g. one optimization iteration per robot size, unless
+    key(job) was warmed up before. Workers staged afterwards load the
+    kernels instead of compiling them.
+    """
+    from worker_pool import WorkerPool
+
+    warm = warmed_designs()
+    jobs = [job for job in jobs if key(job) not in warm]
+    if not jobs:
+        return
+    print(f"Compiling kernels into {shared_dir()}")
+    with WorkerPool(target, n_workers=1, initializer=configure_shared) as pool:
+        pool.map(jobs)
+    # Written only after the shared cache was flushed, when the worker exited.
+    with open(os.path.join(cache_root, warm_file), 'w') as f:
+        json.dump(sorted(warm | {key(job) for job in jobs}), f)
+
+
+def clean():
+    """
+    Delete the shared cache and every staging directory.
+    """
+    shutil.rmtree(cache_root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    # python3 kernel_cache.py [size/clean]
+    if len(sys.argv) > 1 and sys.argv[1] == 'clean':
+        clean()
+    else:
+        directories = [shared_dir()]
+        staging_root = os.path.join(cache_root, 'staging')
+        if os.path.isdir(staging_root):
+            directories += [staging_dir(k) for k in sorted(os.listdir(staging_root))]
+        for directory in directories:
+            print(f'{directory}: {cache_size(directory) / 2**20:.1f} MiB')
@@ -1,63 +1,501 @@
-import subprocess
-import random
+import math
+import functools
+import hashlib
 from collections import Counter
-from rigid_body import load_results
-from concurrent.futures import ProcessPoolExecutor
-import uuid
+from itertools import zip_longest
+from worker_pool import WorkerPool, report
+from fitness_cache import FitnessCache, code_version
+import kernel_cache
+from metrics import MetricsLog, loss_component_names
+import seeding
 import sys
+import time
 import matplotlib.pyplot as plt
 from datetime import datetime
 import os
 import numpy as np
+from scipy import stats
 import ast
 import re
 
 mutation_rate = 0.1
 visualize = False
 save_results = True
+# Number of individuals simulated in lockstep by one worker job. Values above 1
+# batch them into one RigidBodySim population, padded to the largest num_boxes.
+individuals_per_job = 1
+# If True, loss curves are cached per (num_boxes, seed) in results/fitness_cache.jsonl, and every num_boxes
+# value is only ever evaluated with seeds_per_genome different seeds (None: a fresh seed every time).
+use_fitness_cache = True
+seeds_per_genome = 3
+# Number of restarts (distinct initialization seeds) every individual is trained with. The restarts of a genome
+# run in lockstep as one population in a single worker, and its fitness is summarized by the mean, min and standard
+# deviation of their final losses and a confidence interval of the mean (see fitness_stats()). With the fitness
+# cache, at most seeds_per_genome restarts are run.
+restarts_per_genome = 1
+# Statistic of the restarts that selection ranks by: 'mean', 'min', or 'upper' (upper bound of the confidence
+# interval of the mean, which prefers consistently good genomes over lucky ones), and the confidence level.
+selection_statistic = 'mean'
+confidence_level = 0.95
+# Root seed of a GA run (see seeding.py). The genomes, the restart seeds of every (generation, individual, restart)
+# and the initialization of every training run are derived from it, so a run with the same seed and settings
+# evolves the same designs with the same losses, whichever worker evaluates them. None draws a fresh seed, which
+# is printed at the start of the run.
+seed = None
+num_boxes_range = range(4, 13)
+# Continuous genes of a robot design besides num_boxes, as (low, high, decimals). Every gene is an argument of
+# build_robot_skeleton(); crossover blends them, mutation resamples them uniformly, and they are rounded to
+# decimals so that the fitness cache still recognizes repeated designs.
+gene_ranges = {
+    'stiffness': (50, 100, 0),
+    'actuation': (0.05, 0.35, 3),
+    'rest_to_spring': (0.75, 1.25, 2),
+    'radius': (0.1, 0.2, 3),
+}
+# Shapes the GA chooses from (None: only the shape given on the command line), and the probability that a
+# random design has spokes.
+evolved_shapes = None
+spokes_rate = 0.0
+# If True, individuals are raced with successive halving: all of them are trained for racing_min_iters
+# iterations, then only the best 1 / racing_eta continue for racing_eta times as many iterations, and so on
+# until the survivors reach iters. Eliminated individuals keep their shorter loss curves and rank below all
+# survivors.
+use_racing = False
+racing_min_iters = 5
+racing_eta = 2
+# Number of worker processes (None: available cores // threads_per_worker), Taichi CPU threads per worker, and
+# whether to pin every worker to its own cores, so that workers x threads matches the machine.
+n_workers = None
+threads_per_worker = 1
+pin_workers = True
+# If True, the kernels of every robot size the GA can produce are compiled into a shared Taichi offline cache
+# before the workers start (see kernel_cache.py), and every worker loads them from its own staging copy of it.
+# Workers then allocate the fields of every size up front, since cached kernels are tied to allocation order, so
+# it trades the bounded per-worker memory of allocating sizes on first use for compile time. Off by default.
+use_kernel_cache = False
 # population_size =10
 # generations = 10
 # path = "sine"
 # shape = "wheel"
 # iters = 20
 
-def evaluate_individual(n_boxes):
+# One record per robot design. Populations are NumPy arrays of genomes, so that crossover and mutation act on
+# every individual at once.
+genome_dtype = np.dtype([('shape', 'U6'), ('num_boxes', np.int64), ('stiffness', np.float64),
+                         ('actuation', np.float64), ('rest_to_spring', np.float64), ('radius', np.float64),
+                         ('spokes', np.bool_)])
+# Stream of the genetic operators, reseeded from the run seed by parallel_evolutionary_optimize().
+rng = np.random.default_rng()
+
+def random_genomes(n):
+    """
+    Draw n random genomes, uniformly from the evolved shapes, num_boxes_range and gene_ranges.
+    """
+    genomes = np.empty(n, dtype=genome_dtype)
+    genomes['shape'] = rng.choice(evolved_shapes or [shape], n)
+    genomes['num_boxes'] = rng.choice(num_boxes_range, n)
+    for gene, (low, high, decimals) in gene_ranges.items():
+        genomes[gene] = np.round(rng.uniform(low, high, n), decimals)
+    genomes['spokes'] = rng.random(n) < spokes_rate
+    return genomes
+
+def crossover(parents1, parents2):
+    """
+    One child per pair of parent genomes. Numeric genes are blended at a random point between the two parents,
+    shape and spokes are inherited from either parent.
+    """
+    n = len(parents1)
+    children = np.empty(n, dtype=genome_dtype)
+    for gene in ['shape', 'spokes']:
+        children[gene] = np.where(rng.random(n) < 0.5, parents1[gene], parents2[gene])
+    blend = lambda gene: parents1[gene] + rng.random(n) * (parents2[gene] - parents1[gene])
+    children['num_boxes'] = np.rint(blend('num_boxes'))
+    for gene, (_, _, decimals) in gene_ranges.items():
+        children[gene] = np.round(blend(gene), decimals)
+    return children
+
+def mutate(genomes, rate):
+    """
+    Resample every gene of every genome with probability rate.
+    """
+    fresh = random_genomes(len(genomes))
+    for gene in genome_dtype.names:
+        genomes[gene] = np.where(rng.random(len(genomes)) < rate, fresh[gene], genomes[gene])
+    return genomes
+
+def genome_design(genome):
+    """
+    Design of a genome: the dict of build_robot_skeleton() arguments, with plain Python values.
+    """
+    return dict(zip(genome_dtype.names, genome.item()))
+
+def describe(design):
+    return (f"{design['shape']} with num_boxes = {design['num_boxes']} (stiffness {design['stiffness']:g}, "
+            f"actuation {design['actuation']:g}, rest_to_spring {design['rest_to_spring']:g}, "
+            f"radius {design['radius']:g}{', spokes' if design['spokes'] else ''})")
+
+def pad_design():
+    """
+    Largest design the GA can produce, which batched jobs are padded to so that they share compiled kernels.
+    """
+    return {'num_boxes': max(num_boxes_range), 'spokes': spokes_rate > 0}
+
+def evaluate_individual(design, shape, path, iters, seeds=(None,)):
     """
-    Run gradient-descent optimization (rigid_body.py) on a rigid-body of n_boxes.
+    Run gradient-descent optimization (rigid_body.py) on a rigid-body design, once per seed. Runs inside a
+    persistent WorkerPool process, which imports rigid_body (and initializes Taichi) only once. The restarts are
+    trained in lockstep as one RigidBodySim population, so they share compiled kernels and kernel launches. The
+    loss of every restart and iteration is streamed to the main process as a ('loss', iter, losses) progress
+    report while it runs, and the sampled loss components (see rigid_body.metrics_interval) as
+    ('metrics', iter, components).
 
     Inputs:
-        n_boxes: Number of boxes (objects) for rigid-body. See build_robot_skeleton() for more.
+        design: build_robot_skeleton() arguments of the rigid-body, see genome_design().
+        shape: Shape of the rigid-body, either "wheel" or "circle".
+        path: Desired path for the rigid-body to follow.
+        iters: Number of iterations of optimization to run.
+        seeds: Seeds of every restart, which its initialization is derived from (see seeding.py), None for an
+            unseeded one.
 
     Outputs:
-        n_boxes: Number of objects for a given rigid-body.
-        final_loss: Loss value for the final iteration of optimization.
-        losses: List of all losses during optimization.
-    
+        List of (design, final_loss, losses) tuples, one per seed, with the loss value for the final iteration
+        and the list of all losses during optimization.
     """
-    
-    run = sys.argv[1]
-    shape = sys.argv[2]
-    iters = int(sys.argv[3])
-    path = sys.argv[4]
-    
-    print(f"Testing num_boxes = {n_boxes}")
-
-    unique_id = uuid.uuid4().hex  # Generate a unique ID
-    filename = f"{n_boxes}_evo_results_{unique_id}.pkl"
-
-    result = subprocess.run(
-        ["python", "rigid_body.py", str(n_boxes), run, shape, str(iters), path, filename],
-        capture_output=True, text=True
-    )
-    # subprocess.run("ti cache clean -p C:/taichi_cache/ticache")
-    if result.returncode == 0:
-        robot_id, losses = load_results(directory='results', filename=filename)
-        final_loss = losses[-1]
-        print(f"Robot ID: {robot_id}, Losses: {losses}")
-        return n_boxes, final_loss, losses
+    import rigid_body
+
+    print(f"Testing {describe(design)} with {len(seeds)} restart(s)")
+
+    try:
+        all_losses = rigid_body.run_population([design] * len(seeds), shape, path, iters, seeds=list(seeds),
+                                               callback=lambda it, losses: report(('loss', it, losses)),
+                                               metrics=lambda it, components: report(
+                                                   ('metrics', it, components.tolist())))
+    except Exception as e:
+        print("Error running rigid_body.py:", e)
+        return [(design, float('inf'), [])] * len(seeds)  # Assign a high loss for failed runs
+    print(f"Robot: {describe(design)}, Losses: {all_losses}")
+    return [(design, losses[-1], losses) for losses in all_losses]
+
+def evaluate_batch(population, shape, path, iters, pad_boxes=None, seeds=None):
+    """
+    Run gradient-descent optimization on several rigid-bodies at once, simulated in lockstep as one
+    RigidBodySim population inside a persistent WorkerPool process. Losses and sampled loss components are
+    streamed to the main process as ('loss', iter, losses) and ('metrics', iter, components) progress reports,
+    with one entry per rigid-body.
+
+    Inputs:
+        population: List of designs, one per rigid-body, all of the same shape.
+        shape: Shape of the rigid-bodies, either "wheel" or "circle".
+        path: Desired path for the rigid-bodies to follow.
+        iters: Number of iterations of optimization to run.
+        pad_boxes: Design every rigid-body is padded to, so that batches share compiled kernels.
+        seeds: Optional list with one initialization seed per rigid-body.
+
+    Outputs:
+        List of (design, final_loss, losses) tuples, as returned by evaluate_individual().
+    """
+    import rigid_body
+
+    print(f"Testing {len(population)} {shape} designs")
+
+    try:
+        all_losses = rigid_body.run_population(population, shape, path, iters, pad_boxes=pad_boxes, seeds=seeds,
+                                               callback=lambda it, losses: report(('loss', it, losses)),
+                                               metrics=lambda it, components: report(
+                                                   ('metrics', it, components.tolist())))
+    except Exception as e:
+        print("Error running rigid_body.py:", e)
+        return [(design, float('inf'), []) for design in population]  # Assign a high loss for failed runs
+    return [(design, losses[-1], losses) for design, losses in zip(population, all_losses)]
+
+def kernel_populations():
+    """
+    One population (list of designs) of every size of fields the workers can simulate: every num_boxes in
+    num_boxes_range, with and without spokes, of every evolved shape. Batched jobs are padded to pad_design(), so
+    they only need one size per shape and batch size.
+    """
+    # Only num_boxes and spokes change the size of a robot, the other genes keep their lowest value.
+    genes = {gene: low for gene, (low, _, _) in gene_ranges.items()}
+    populations = []
+    for design_shape in evolved_shapes or [shape]:
+        designs = [{'shape': design_shape, 'num_boxes': num_boxes, **genes, 'spokes': spokes}
+                   for num_boxes in num_boxes_range for spokes in sorted({False, spokes_rate > 0})]
+        if individuals_per_job > 1:
+            # The last chunk of a generation (or racing rung) may be smaller.
+            populations += [[designs[-1]] * n_batch for n_batch in range(1, individuals_per_job + 1)]
+        else:
+            # Genomes that are partly served from the fitness cache run fewer restarts.
+            populations += [[design] * n_restarts for design in designs
+                            for n_restarts in range(1, restarts_per_genome + 1)]
+    return populations
+
+def init_worker(populations, pad_boxes, worker_id):
+    """
+    WorkerPool initializer. Points Taichi at the worker's staging copy of the kernel cache and allocates the fields
+    of every population size in the same order as compile_kernels(), so that the cached kernels apply.
+    """
+    kernel_cache.configure_worker(worker_id)
+    import rigid_body
+    rigid_body.preallocate_populations(populations, None, pad_boxes)
+
+def compile_kernels(populations, path, pad_boxes):
+    """
+    Run optimization iterations of every population the way the workers do, including a racing rung resumed from
+    trained parameters, so that the Taichi kernels of every size of fields are compiled into the shared kernel
+    cache. Runs in the single process that writes the shared cache.
+    """
+    import rigid_body
+
+    rigid_body.preallocate_populations(populations, None, pad_boxes)
+    for population in populations:
+        print(f"Compiling kernels for {len(population)} x {describe(population[0])}")
+        _, parameters = rigid_body.run_population(population, population[0]['shape'], path, 2, pad_boxes=pad_boxes,
+                                                  seeds=[0] * len(population), return_parameters=True,
+                                                  metrics=lambda it, components: None)
+        rigid_body.run_population(population, population[0]['shape'], path, 1, pad_boxes=pad_boxes,
+                                  parameters=parameters, metrics=lambda it, components: None)
+
+def warm_up_kernel_cache():
+    """
+    Compile the kernels of every population size (see kernel_populations()) into the shared kernel cache, unless
+    an earlier run with the same simulation code and sizes did.
+    """
+    populations = kernel_populations()
+    pad_boxes = pad_design() if individuals_per_job > 1 else None
+    kernel_cache.warm_up(compile_kernels, [(populations, path, pad_boxes)],
+                         key=lambda job: hashlib.sha1(repr((code_version(),) + job).encode()).hexdigest())
+    return populations, pad_boxes
+
+def print_progress(design, seed, it, loss):
+    """
+    Print the live loss of an individual, as reported by its worker after every iteration.
+    """
+    print(f"  {describe(design)} (seed {seed}): iteration {it + 1}/{iters}, loss {loss:.4f}")
+
+def progress_handler(chunks, metrics=None, done=0):
+    """
+    on_progress handler for WorkerPool.map(). Prints the live losses reported by the workers, and passes the
+    sampled loss components to metrics(design, seed, iter, components).
+
+    Inputs:
+        chunks: For every job of the map, the list of (design, seed, indices) jobs it evaluates.
+        metrics: Optional callback for the loss components.
+        done: Number of iterations the jobs had completed before (for racing rungs).
+    """
+    def on_progress(job_id, progress):
+        kind, it, values = progress
+        for (design, seed, _), value in zip(chunks[job_id], values):
+            if kind == 'loss':
+                print_progress(design, seed, done + it, value)
+            elif metrics is not None:
+                metrics(design, seed, done + it, value)
+    return on_progress
+
+def evaluate_rung(population, shape, path, iters, pad_boxes=None, seeds=None, parameters=None):
+    """
+    Continue the optimization of several rigid-bodies for one rung of the racing scheduler, inside a
+    persistent WorkerPool process. Losses and loss components are streamed as for evaluate_batch().
+
+    Inputs:
+        population: List of designs, one per rigid-body, all of the same shape.
+        shape: Shape of the rigid-bodies, either "wheel" or "circle".
+        path: Desired path for the rigid-bodies to follow.
+        iters: Number of iterations of optimization to run in this rung.
+        pad_boxes: Design every rigid-body is padded to, or None. Must be the same for every rung.
+        seeds: Optional list with one initialization seed per rigid-body, used in the first rung.
+        parameters: Parameters returned by the previous rung, one per rigid-body, or None for the first rung.
+
+    Outputs:
+        List of (losses, parameters) tuples, one per rigid-body, with the losses of this rung only.
+    """
+    import rigid_body
+
+    print(f"Testing {len(population)} {shape} designs")
+
+    try:
+        all_losses, all_parameters = rigid_body.run_population(
+            population, shape, path, iters, pad_boxes=pad_boxes, seeds=seeds,
+            callback=lambda it, losses: report(('loss', it, losses)), parameters=parameters,
+            return_parameters=True,
+            metrics=lambda it, components: report(('metrics', it, components.tolist())))
+    except Exception as e:
+        print("Error running rigid_body.py:", e)
+        return [([], None)] * len(population)
+    return list(zip(all_losses, all_parameters))
+
+def chunk_jobs(indices, jobs):
+    """
+    Split job indices into chunks of at most individuals_per_job jobs for batched evaluation. Every chunk holds
+    a single shape, since the shape selects the loss of the whole batch.
+    """
+    chunks = []
+    for chunk_shape in sorted({jobs[j][0]['shape'] for j in indices}):
+        same_shape = [j for j in indices if jobs[j][0]['shape'] == chunk_shape]
+        chunks += [same_shape[i:i + individuals_per_job] for i in range(0, len(same_shape), individuals_per_job)]
+    return chunks
+
+def race(pool, jobs, metrics=None):
+    """
+    Evaluate jobs with successive halving (see use_racing). Every rung trains the remaining individuals in
+    chunks of individuals_per_job, resuming from the parameters of the previous rung.
+
+    Inputs:
+        pool: WorkerPool running evaluate_rung.
+        jobs: List of (design, seed, indices) tuples, as built by evaluate_population().
+        metrics: Optional callback for the loss components, see progress_handler().
+
+    Outputs:
+        List of (design, final_loss, losses) tuples in job order.
+    """
+    pad_boxes = pad_design() if individuals_per_job > 1 else None
+    curves = [[] for _ in jobs]
+    parameters = [None] * len(jobs)
+    alive = list(range(len(jobs)))
+    budget = min(racing_min_iters, iters)
+    while alive:
+        done = len(curves[alive[0]])
+        chunks = chunk_jobs(alive, jobs)
+        on_progress = progress_handler([[jobs[j] for j in chunk] for chunk in chunks], metrics, done)
+        outputs = pool.map((([jobs[j][0] for j in chunk], jobs[chunk[0]][0]['shape'], path, budget - done, pad_boxes,
+                             [jobs[j][1] for j in chunk],
+                             None if done == 0 else [parameters[j] for j in chunk]) for chunk in chunks),
+                           on_progress=on_progress)
+        for chunk, chunk_outputs in zip(chunks, outputs):
+            for j, (losses, params) in zip(chunk, chunk_outputs):
+                curves[j] += losses
+                parameters[j] = params
+
+        # Failed runs drop out of the race.
+        alive = [j for j in alive if len(curves[j]) == budget]
+        if budget >= iters:
+            break
+        alive.sort(key=lambda j: curves[j][-1])
+        n_keep = math.ceil(len(alive) / racing_eta)
+        for j in alive[n_keep:]:
+            print(f"Stopped {describe(jobs[j][0])} (seed {jobs[j][1]}) after {budget} iterations, "
+                  f"loss {curves[j][-1]:.4f}")
+        alive = alive[:n_keep]
+        budget = min(budget * racing_eta, iters)
+
+    return [(design, curve[-1] if curve else float('inf'), curve)
+            for (design, _, _), curve in zip(jobs, curves)]
+
+def fitness_stats(final_losses):
+    """
+    Summary of the final losses of the restarts of a genome: their mean, min and standard deviation, the
+    half-width of the confidence interval of the mean at confidence_level (Student's t), its upper bound, and the
+    number of restarts.
+    """
+    final_losses = np.asarray(final_losses, dtype=np.float64)
+    n = len(final_losses)
+    mean = float(final_losses.mean())
+    std = float(final_losses.std(ddof=1)) if n > 1 else 0.0
+    ci = float(stats.t.ppf((1 + confidence_level) / 2, n - 1) * std / math.sqrt(n)) if n > 1 else 0.0
+    return {'mean': mean, 'min': float(final_losses.min()), 'std': std, 'ci': ci, 'upper': mean + ci, 'n': n}
+
+def aggregate_restarts(design, restarts):
+    """
+    Combine the (design, final_loss, losses) results of the restarts of a genome. Only the restarts that ran
+    the most iterations count (racing may stop the others early); failed runs do not count at all.
+
+    Outputs:
+        design: The evaluated design.
+        final_loss: Mean final loss of the restarts, or inf if all of them failed.
+        losses: Mean loss curve of the restarts.
+        stats: fitness_stats() of the final losses, or None if all restarts failed.
+    """
+    curves = [losses for _, _, losses in restarts if losses]
+    if not curves:
+        return design, float('inf'), [], None
+    longest = max(len(curve) for curve in curves)
+    curves = [curve for curve in curves if len(curve) == longest]
+    summary = fitness_stats([curve[-1] for curve in curves])
+    return design, summary['mean'], np.mean(curves, axis=0).tolist(), summary
+
+def evaluate_population(pool, population, seeds, cache=None, metrics=None):
+    """
+    Evaluate every individual of a population on the worker pool, once per restart seed. Restarts whose
+    (genome, seed) is in the cache are not simulated again, and every distinct missing (genome, seed) pair is
+    simulated once. Without batching or racing, the missing restarts of a genome run as one job.
+
+    Inputs:
+        pool: WorkerPool running evaluate_individual (evaluate_batch if individuals_per_job > 1, evaluate_rung
+            if use_racing).
+        population: Array of genomes.
+        seeds: List of restart seeds per individual. Restarts with seed None are always simulated.
+        cache: FitnessCache, or None.
+        metrics: Optional callback for the loss components, see progress_handler().
+
+    Outputs:
+        List of (design, final_loss, losses, stats) tuples in population order, see aggregate_restarts().
+    """
+    restarts = [[] for _ in population]
+    pending = {}
+    for idx, (genome, individual_seeds) in enumerate(zip(population, seeds)):
+        design = genome_design(genome)
+        for r, seed in enumerate(individual_seeds):
+            if seed is None:
+                pending[(genome.item(), idx, r)] = (design, seed, [idx])
+                continue
+            losses = cache.get(genome.item(), shape, path, iters, seed) if cache is not None else None
+            if losses:
+                restarts[idx].append((design, losses[-1], losses))
+            else:
+                pending.setdefault((genome.item(), seed), (design, seed, []))[2].append(idx)
+
+    jobs = list(pending.values())
+    if use_racing:
+        evaluated = race(pool, jobs, metrics)
+    elif individuals_per_job > 1:
+        batches = chunk_jobs(range(len(jobs)), jobs)
+        on_progress = progress_handler([[jobs[j] for j in batch] for batch in batches], metrics)
+        evaluated = [None] * len(jobs)
+        outputs = pool.map((([jobs[j][0] for j in batch], jobs[batch[0]][0]['shape'], path, iters, pad_design(),
+                             [jobs[j][1] for j in batch]) for batch in batches), on_progress=on_progress)
+        for batch, batch_results in zip(batches, outputs):
+            for j, result in zip(batch, batch_results):
+                evaluated[j] = result
     else:
-        print("Error running rigid_body.py:", result.stderr)
-        return n_boxes, float('inf'), []  # Assign a high loss for failed runs
+        # The pending restarts of every genome, at most restarts_per_genome per job.
+        by_genome = {}
+        for j, (design, _, _) in enumerate(jobs):
+            by_genome.setdefault(tuple(design.values()), []).append(j)
+        groups = [group[i:i + restarts_per_genome] for group in by_genome.values()
+                  for i in range(0, len(group), restarts_per_genome)]
+        on_progress = progress_handler([[jobs[j] for j in group] for group in groups], metrics)
+        evaluated = [None] * len(jobs)
+        outputs = pool.map(((jobs[group[0]][0], jobs[group[0]][0]['shape'], path, iters,
+                             [jobs[j][1] for j in group]) for group in groups), on_progress=on_progress)
+        for group, group_results in zip(groups, outputs):
+            for j, result in zip(group, group_results):
+                evaluated[j] = result
+
+    for (design, seed, indices), result in zip(jobs, evaluated):
+        # Curves cut short by racing are not cached as full evaluations.
+        if cache is not None and seed is not None and len(result[2]) == iters:
+            cache.put(tuple(design.values()), shape, path, iters, seed, result[2])
+        for idx in indices:
+            restarts[idx].append(result)
+    return [aggregate_restarts(genome_design(genome), individual_restarts)
+            for genome, individual_restarts in zip(population, restarts)]
+
+def restart_seeds(run_seed, generation, individual, cache=None):
+    """
+    Seeds of the restarts_per_genome restarts of an individual, derived from the run seed by (generation,
+    individual, restart). With a fitness cache of seeds_per_genome seeds, they are drawn from those instead (from
+    the stream of the generation and individual), so that repeated genomes are served from the cache.
+    """
+    if cache is not None and cache.seeds_per_genome is not None:
+        return cache.choose_seeds(restarts_per_genome,
+                                  seeding.generator(run_seed, seeding.cache_stream, generation, individual))
+    return [seeding.derive_seed(run_seed, seeding.restart_stream, generation, individual, restart)
+            for restart in range(restarts_per_genome)]
+
+def selection_key(stats):
+    """
+    Value selection minimizes for a genome, see selection_statistic.
+    """
+    return stats[selection_statistic]
 
 def parallel_evolutionary_optimize():
     """
@@ -73,59 +511,95 @@ def parallel_evolutionary_optimize():
         path: Desired path for rigid bodies to follow. 
 
     Output:
-        best_num_boxes: Number of boxes from the fittest rigid-body.
+        best_design: Design (build_robot_skeleton() arguments) of the fittest rigid-body.
         all_generation_losses: List of all losses across all generations.
         all_populations: List of all populations across all generations.
         mode_num_boxes: Most populous num_boxes configuration in the final generation.
     """
-    num_boxes_range = range(4, 13)
-    population = [random.choice(num_boxes_range) for _ in range(population_size)]
+    global rng
+    run_seed = seeding.root_seed(seed)
+    print(f"Seed: {run_seed}")
+    rng = seeding.generator(run_seed, seeding.ga_stream)
+    population = random_genomes(population_size)
     
     all_generation_losses = []
     all_populations = []
+    cache = FitnessCache(seeds_per_genome=seeds_per_genome) if use_fitness_cache else None
+    metrics_log = None
+    if save_results:
+        # Sampled loss components of every simulated individual.
+        timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        metrics_log = MetricsLog(os.path.join('results', f'loss_components_{path}_{shape}_{timestamp}.csv'),
+                                 ['generation'] + list(genome_dtype.names) + ['seed', 'iter'] + loss_component_names)
+
+    # Persistent workers, reused by every generation.
+    if use_racing:
+        target = evaluate_rung
+    elif individuals_per_job > 1:
+        target = evaluate_batch
+    else:
+        target = evaluate_individual
+    initializer = None
+    if use_kernel_cache:
+        initializer = functools.partial(init_worker, *warm_up_kernel_cache())
+    pool = WorkerPool(target, n_workers=n_workers, threads_per_worker=threads_per_worker, pin_cpus=pin_workers,
+                      initializer=initializer)
 
     for generation in range(generations):
         print(f"Generation {generation + 1}/{generations}")
         fitness_scores = []
         generation_losses = []
 
-        # Use ProcessPoolExecutor for parallel execution
-        with ProcessPoolExecutor() as executor:
-            results = list(executor.map(evaluate_individual, population))
+        start = time.perf_counter()
+        pool.reset_stats()
+        seeds = [restart_seeds(run_seed, generation, idx, cache) for idx in range(len(population))]
+        metrics = None
+        if metrics_log is not None:
+            metrics = lambda design, seed, it, components: metrics_log.write(
+                generation=generation, **design, seed=seed, iter=it, **dict(zip(loss_component_names, components)))
+        results = evaluate_population(pool, population, seeds, cache, metrics)
+        print(f"Generation {generation + 1} evaluated in {time.perf_counter() - start:.1f} s "
+              f"({pool.wall_time:.1f} s on {pool.n_workers} workers, {pool.utilization():.0%} utilization)")
+        if cache is not None:
+            print(f"Fitness cache: {cache.hits} hits, {cache.misses} misses so far")
 
-        for n_boxes, final_loss, losses in results:
+        for design, final_loss, losses, summary in results:
             if losses:
-                fitness_scores.append((n_boxes, final_loss))
+                fitness_scores.append((design, final_loss, len(losses), selection_key(summary)))
                 generation_losses.append(losses)
-                print(f"Final loss for num_boxes = {n_boxes}: {final_loss}")
+                if summary['n'] > 1:
+                    print(f"Final loss for {describe(design)}: {summary['mean']:.4f} +/- {summary['ci']:.4f} "
+                          f"(min {summary['min']:.4f}, std {summary['std']:.4f}, {summary['n']} restarts)")
+                else:
+                    print(f"Final loss for {describe(design)}: {final_loss}")
 
         all_generation_losses.append(generation_losses)
         all_populations.append(population.copy())
 
-        # Select the best individuals
-        fitness_scores.sort(key=lambda x: x[1])
-        selected = fitness_scores[:population_size // 2]
+        # Select the best individuals. Individuals stopped early by racing rank below all that finished.
+        # Otherwise they rank by the selection_statistic of their restarts.
+        fitness_scores.sort(key=lambda x: (-x[2], x[3]))
+        selected = fitness_scores[:max(1, population_size // 2)]
 
-        # Crossover and Mutation
-        new_population = []
-        for _ in range(population_size):
-            parent1 = random.choice(selected)[0]
-            parent2 = random.choice(selected)[0]
-            child = (parent1 + parent2) // 2
-            if random.random() < mutation_rate:
-                child = random.choice(num_boxes_range)
-            new_population.append(child)
+        # Crossover and Mutation, on the whole population at once. Every gene mutates with mutation_rate.
+        parents = np.array([tuple(design.values()) for design, *_ in selected], dtype=genome_dtype)
+        rng = seeding.generator(run_seed, seeding.ga_stream, generation)
+        population = mutate(crossover(rng.choice(parents, population_size), rng.choice(parents, population_size)),
+                            mutation_rate)
 
-        population = new_population
-        #subprocess.run("ti cache clean -p C:/taichi_cache/ticache")
+    pool.close()
+    if metrics_log is not None:
+        metrics_log.close()
+        print(f"Saved loss components to {metrics_log.filepath}")
 
-    final_population_counts = Counter(population)
+    final_population_counts = Counter(population['num_boxes'].tolist())
     mode_num_boxes = final_population_counts.most_common(1)[0][0]
 
-    best_num_boxes = min(fitness_scores, key=lambda x: x[1])[0]
-    print(f"Best num_boxes: {best_num_boxes} with loss: {min(fitness_scores, key=lambda x: x[1])[1]}")
+    # fitness_scores of the last generation are sorted best first.
+    best_design, best_loss = fitness_scores[0][:2]
+    print(f"Best design: {describe(best_design)} with loss: {best_loss}")
 
-    return best_num_boxes, all_generation_losses, all_populations, mode_num_boxes
+    return best_design, all_generation_losses, all_populations, mode_num_boxes
 
 def save_generation_losses(all_generation_losses, directory="results", filename=None):
     """
@@ -165,14 +639,15 @@ def plot_generation_losses(all_generation_losses, all_populations, directory="re
     
     # Group losses by num_boxes
     for generation_losses, population in zip(all_generation_losses, all_populations):
-        for num_boxes, losses in zip(population, generation_losses):
+        for num_boxes, losses in zip(population['num_boxes'].tolist(), generation_losses):
             if num_boxes not in num_boxes_losses:
                 num_boxes_losses[num_boxes] = []
             num_boxes_losses[num_boxes].append(losses)
     
     # Plot average loss per generation for each num_boxes
     for num_boxes, losses in num_boxes_losses.items():
-        avg_losses = [sum(loss) / len(loss) for loss in zip(*losses)]
+        # Curves stopped early by racing only count towards the iterations they reached.
+        avg_losses = [np.mean([l for l in loss if l is not None]) for loss in zip_longest(*losses)]
         plt.plot(avg_losses, label=f'num_boxes {num_boxes}')
 
     timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
@@ -210,7 +685,7 @@ def plot_population_distribution_and_avg_loss(all_generation_losses, all_populat
         avg_loss = np.mean([loss[-1] for loss in generation_losses])  
         avg_losses_per_generation.append(avg_loss)
         
-        for num_boxes in population:
+        for num_boxes in population['num_boxes'].tolist():
             if num_boxes not in num_boxes_counts:
                 num_boxes_counts[num_boxes] = [0] * len(all_populations)
             num_boxes_counts[num_boxes][gen_idx] += 1 
@@ -256,8 +731,10 @@ def main():
     # plot_generation_losses(all_generation_losses, all_populations)
     # plot_population_distribution_and_avg_loss(all_generation_losses, all_populations)
     
+    if run == "warmup":
+        warm_up_kernel_cache()
     if run == "para":
-        best_num_boxes, all_generation_losses, all_populations, mode_boxes = parallel_evolutionary_optimize()
+        best_design, all_generation_losses, all_populations, mode_boxes = parallel_evolutionary_optimize()
         if save_results:
             save_generation_losses(all_generation_losses)
         plot_generation_losses(all_generation_losses, all_populations)
@@ -266,7 +743,12 @@ def main():
     
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) != 7: 
+    if len(sys.argv) > 1 and sys.argv[1] == "warmup":
+        # python3 main_opt.py warmup [shape=wheel] [path=sin]
+        run = "warmup"
+        shape = sys.argv[2] if len(sys.argv) > 2 else "wheel"
+        path = sys.argv[3] if len(sys.argv) > 3 else "sin"
+    elif len(sys.argv) != 7: 
         print(
         "Usage: python3 main_opt.py [run=para] [shape=wheel/circle] [iter=1, 2, ..., n] [path=cos/sin/parabola] [generations=1, 2, ..., n] [population_size=1, 2, ..., n]"
         )   
@@ -1,15 +1,17 @@
 from mass_spring_robot_config import robots
 import argparse
-import random
 import sys
+import time
 import matplotlib.pyplot as plt
 import taichi as ti
 import math
 import numpy as np
 import os
-
-random.seed(0)
-np.random.seed(0)
+from optimizers import optimizers
+from incidence import spring_incidence
+from field_init import initial_rows, normal_weights, upload
+import seeding
+from rendering import LazyGUI
 
 real = ti.f32
 ti.init(default_fp=real)
@@ -49,8 +51,24 @@ spring_anchor_b = ti.field(ti.i32)
 spring_length = scalar()
 spring_stiffness = scalar()
 spring_actuation = scalar()
+# If True, apply_spring_force() stores the impulse of every spring, and every
+# object sums those of its springs through the CSR incidence built by
+# setup_robot() (see spring_incidence()), instead of the springs scattering
+# them into v_inc with atomic adds.
+gather_spring_impulses = False
+spring_impulse = vec()
+incidence_offset = ti.field(ti.i32)
+incidence = ti.field(ti.i32)
 
 n_sin_waves = 10
+# If True, the frequency and phase of every sine-wave input of the controller
+# are trained along with its weights.
+learn_sin_basis = False
+sin_omega = scalar()
+sin_phase = scalar()
+# Value of every sine-wave input at every timestep, precomputed by
+# compute_sin_basis() instead of being evaluated by every hidden unit in nn1.
+sin_basis = scalar()
 weights1 = scalar()
 bias1 = scalar()
 
@@ -63,6 +81,9 @@ center = vec()
 
 act = scalar()
 
+# Squared gradient norm of the controller, written by the optimizer.
+grad_norm_sqr = ti.field(ti.f64)
+
 
 def n_input_states():
     return n_sin_waves + 4 * n_objects + 2
@@ -73,6 +94,11 @@ def allocate_fields():
     ti.root.dense(ti.i, n_springs).place(spring_anchor_a, spring_anchor_b,
                                          spring_length, spring_stiffness,
                                          spring_actuation)
+    ti.root.dense(ti.ij, (max_steps, n_springs)).place(spring_impulse)
+    ti.root.dense(ti.i, n_objects + 1).place(incidence_offset)
+    ti.root.dense(ti.i, 2 * n_springs).place(incidence)
+    ti.root.dense(ti.i, n_sin_waves).place(sin_omega, sin_phase)
+    ti.root.dense(ti.ij, (max_steps, n_sin_waves)).place(sin_basis)
     ti.root.dense(ti.ij, (n_hidden, n_input_states())).place(weights1)
     ti.root.dense(ti.i, n_hidden).place(bias1)
     ti.root.dense(ti.ij, (n_springs, n_hidden)).place(weights2)
@@ -81,11 +107,17 @@ def allocate_fields():
     ti.root.dense(ti.ij, (max_steps, n_springs)).place(act)
     ti.root.dense(ti.i, max_steps).place(center)
     ti.root.place(loss, goal)
+    ti.root.dense(ti.i, 1).place(grad_norm_sqr)
     ti.root.lazy_grad()
 
 
 dt = 0.004
 learning_rate = 25
+# Adam steps every weight by about its learning rate, see
+# optimizers.ClippedAdam.
+adam_learning_rate = 0.01
+# Created by the first optimize() call, and reset by the following ones.
+optimizer = None
 
 
 @ti.kernel
@@ -97,13 +129,25 @@ def compute_center(t: ti.i32):
         center[t] = (1.0 / n_objects) * c
 
 
+@ti.kernel
+def compute_sin_basis():
+    for t, j in sin_basis:
+        sin_basis[t, j] = ti.sin(sin_omega[j] * t * dt + sin_phase[j])
+
+
+def init_sin_basis():
+    sin_omega.fill(spring_omega)
+    sin_phase.from_numpy(
+        (2 * math.pi / n_sin_waves * np.arange(n_sin_waves)).astype(np.float32))
+    compute_sin_basis()
+
+
 @ti.kernel
 def nn1(t: ti.i32):
     for i in range(n_hidden):
         actuation = 0.0
         for j in ti.static(range(n_sin_waves)):
-            actuation += weights1[i, j] * ti.sin(spring_omega * t * dt +
-                                                 2 * math.pi / n_sin_waves * j)
+            actuation += weights1[i, j] * sin_basis[t, j]
         for j in ti.static(range(n_objects)):
             offset = x[t, j] - center[t]
             # use a smaller weight since there are too many of them
@@ -135,7 +179,7 @@ def nn2(t: ti.i32):
 
 
 @ti.kernel
-def apply_spring_force(t: ti.i32):
+def apply_spring_force(t: ti.i32, gather: ti.template()):
     for i in range(n_springs):
         a = spring_anchor_a[i]
         b = spring_anchor_b[i]
@@ -149,19 +193,41 @@ def apply_spring_force(t: ti.i32):
         impulse = dt * (length -
                         target_length) * spring_stiffness[i] / length * dist
 
-        ti.atomic_add(v_inc[t + 1, a], -impulse)
-        ti.atomic_add(v_inc[t + 1, b], impulse)
+        if ti.static(gather):
+            spring_impulse[t + 1, i] = impulse
+        else:
+            ti.atomic_add(v_inc[t + 1, a], -impulse)
+            ti.atomic_add(v_inc[t + 1, b], impulse)
+
+
+@ti.func
+def spring_impulse_sum(t, i):
+    # Impulses of the springs attached to object i, in CSR order. Anchor a
+    # (even spring ends) receives the negated impulse.
+    total = ti.Vector([0.0, 0.0])
+    for k in range(incidence_offset[i], incidence_offset[i + 1]):
+        end = incidence[k]
+        total += (end % 2 * 2 - 1) * spring_impulse[t, end // 2]
+    return total
+
+
+@ti.func
+def velocity_increment(t, i, gather: ti.template()):
+    inc = v_inc[t, i]
+    if ti.static(gather):
+        inc += spring_impulse_sum(t, i)
+    return inc
 
 
 use_toi = False
 
 
 @ti.kernel
-def advance_toi(t: ti.i32):
+def advance_toi(t: ti.i32, gather: ti.template()):
     for i in range(n_objects):
         s = math.exp(-dt * damping)
-        old_v = s * v[t - 1, i] + dt * gravity * ti.Vector([0.0, 1.0
-                                                            ]) + v_inc[t, i]
+        old_v = s * v[t - 1, i] + dt * gravity * ti.Vector(
+            [0.0, 1.0]) + velocity_increment(t, i, gather)
         old_x = x[t - 1, i]
         new_x = old_x + dt * old_v
         toi = 0.0
@@ -176,11 +242,11 @@ def advance_toi(t: ti.i32):
 
 
 @ti.kernel
-def advance_no_toi(t: ti.i32):
+def advance_no_toi(t: ti.i32, gather: ti.template()):
     for i in range(n_objects):
         s = math.exp(-dt * damping)
-        old_v = s * v[t - 1, i] + dt * gravity * ti.Vector([0.0, 1.0
-                                                            ]) + v_inc[t, i]
+        old_v = s * v[t - 1, i] + dt * gravity * ti.Vector(
+            [0.0, 1.0]) + velocity_increment(t, i, gather)
         old_x = x[t - 1, i]
         new_v = old_v
         depth = old_x[1] - ground_height
@@ -198,11 +264,12 @@ def compute_loss(t: ti.i32):
     loss[None] = -x[t, head_id][0]
 
 
-gui = ti.GUI("Mass Spring Robot", (512, 512), background_color=0xFFFFFF)
+# Created on first use, offscreen if there is no display.
+gui = LazyGUI("Mass Spring Robot", (512, 512), background_color=0xFFFFFF)
 
 
 def forward(output=None, visualize=True):
-    if random.random() > 0.5:
+    if rng.random() > 0.5:
         goal[None] = [0.9, 0.2]
     else:
         goal[None] = [0.1, 0.2]
@@ -215,15 +282,18 @@ def forward(output=None, visualize=True):
 
     total_steps = steps if not output else steps * 2
 
+    if learn_sin_basis:
+        compute_sin_basis()
+
     for t in range(1, total_steps):
         compute_center(t - 1)
         nn1(t - 1)
         nn2(t - 1)
-        apply_spring_force(t - 1)
+        apply_spring_force(t - 1, gather_spring_impulses)
         if use_toi:
-            advance_toi(t)
+            advance_toi(t, gather_spring_impulses)
         else:
-            advance_no_toi(t)
+            advance_no_toi(t, gather_spring_impulses)
 
         if (t + 1) % interval == 0 and visualize:
             gui.line(begin=(0, ground_height),
@@ -287,31 +357,45 @@ def setup_robot(objects, springs):
 
     print('n_objects=', n_objects, '   n_springs=', n_springs)
 
-    for i in range(n_objects):
-        x[0, i] = objects[i]
+    upload(x, initial_rows(objects, max_steps))
+    upload(spring_anchor_a, springs['anchor_a'])
+    upload(spring_anchor_b, springs['anchor_b'])
+    upload(spring_length, springs['length'])
+    upload(spring_stiffness, springs['stiffness'])
+    upload(spring_actuation, springs['actuation'])
+
+    offsets, ends = spring_incidence(springs['anchor_a'], springs['anchor_b'],
+                                     n_objects)
+    upload(incidence_offset, offsets)
+    upload(incidence, ends)
 
-    for i in range(n_springs):
-        s = springs[i]
-        spring_anchor_a[i] = s[0]
-        spring_anchor_b[i] = s[1]
-        spring_length[i] = s[2]
-        spring_stiffness[i] = s[3]
-        spring_actuation[i] = s[4]
+
+def init_weights():
+    upload(weights1, normal_weights((n_hidden, n_input_states()),
+                                    n_hidden + n_input_states(), 2, rng))
+    # TODO: n_springs should be n_actuators
+    upload(weights2, normal_weights((n_springs, n_hidden),
+                                    n_hidden + n_springs, 3, rng))
 
 
 def optimize(toi, visualize):
-    global use_toi
+    global use_toi, optimizer
     use_toi = toi
-    for i in range(n_hidden):
-        for j in range(n_input_states()):
-            weights1[i, j] = np.random.randn() * math.sqrt(
-                2 / (n_hidden + n_input_states())) * 2
-
-    for i in range(n_springs):
-        for j in range(n_hidden):
-            # TODO: n_springs should be n_actuators
-            weights2[i, j] = np.random.randn() * math.sqrt(
-                2 / (n_hidden + n_springs)) * 3
+    init_weights()
+    init_sin_basis()
+    if optimizer is None:
+        params = [weights1, bias1, weights2, bias2]
+        if learn_sin_basis:
+            params += [sin_omega, sin_phase]
+        optimizer = optimizers[options.optimizer](
+            params,
+            grad_norm_sqr,
+            learning_rate=adam_learning_rate
+            if options.optimizer == 'adam' else 1,
+            gradient_clip=0.2,
+            eps=1e-6,
+            normalize=True)
+    optimizer.reset()
 
     losses = []
     # forward('initial{}'.format(robot_id), visualize=visualize)
@@ -323,46 +407,62 @@ def optimize(toi, visualize):
 
         print('Iter=', iter, 'Loss=', loss[None])
 
-        total_norm_sqr = 0
-        for i in range(n_hidden):
-            for j in range(n_input_states()):
-                total_norm_sqr += weights1.grad[i, j]**2
-            total_norm_sqr += bias1.grad[i]**2
-
-        for i in range(n_springs):
-            for j in range(n_hidden):
-                total_norm_sqr += weights2.grad[i, j]**2
-            total_norm_sqr += bias2.grad[i]**2
-
+        total_norm_sqr = optimizer.step()[0]
         print(total_norm_sqr)
 
-        # scale = learning_rate * min(1.0, gradient_clip / total_norm_sqr ** 0.5)
-        gradient_clip = 0.2
-        scale = gradient_clip / (total_norm_sqr**0.5 + 1e-6)
-        for i in range(n_hidden):
-            for j in range(n_input_states()):
-                weights1[i, j] -= scale * weights1.grad[i, j]
-            bias1[i] -= scale * bias1.grad[i]
-
-        for i in range(n_springs):
-            for j in range(n_hidden):
-                weights2[i, j] -= scale * weights2.grad[i, j]
-            bias2[i] -= scale * bias2.grad[i]
         losses.append(loss[None])
 
     return losses
 
+
+def benchmark():
+    """
+    Time the forward and backward pass of the robot with spring impulses
+    scattered with atomics and gathered per object, over options.iters
+    iterations each, from the same weights.
+    """
+    global gather_spring_impulses
+    init_weights()
+    init_sin_basis()
+    print(f'{n_objects} objects, {n_springs} springs, {steps} steps')
+    for gather in [False, True]:
+        gather_spring_impulses = gather
+        for iter in range(options.iters + 1):
+            if iter == 1:
+                # The first iteration compiles the kernels.
+                start = time.perf_counter()
+            clear()
+            with ti.ad.Tape(loss):
+                forward(visualize=False)
+        elapsed = (time.perf_counter() - start) / options.iters
+        grad_norm = np.linalg.norm(weights1.grad.to_numpy())
+        print(f'{"gather" if gather else "scatter":>8}: {elapsed:.4f} s/iter, '
+              f'loss {loss[None]:.6f}, |grad weights1| {grad_norm:.6f}')
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument('robot_id', type=int, help='[robot_id=0, 1, 2, ...]')
-parser.add_argument('task', type=str, help='train/plot')
+parser.add_argument('task', type=str, help='train/plot/benchmark')
 parser.add_argument('--iters', type=int, default=100)
+parser.add_argument('--gather', action='store_true',
+                    help='gather spring impulses per object instead of '
+                    'scattering them with atomics')
+parser.add_argument('--optimizer', choices=list(optimizers), default='sgd',
+                    help='update rule of the controller')
+parser.add_argument('--seed', type=int, default=0,
+                    help='seed of the weight initialization (see seeding.py)')
 options = parser.parse_args()
+rng = seeding.generator(options.seed)
 
 def main():
+    global gather_spring_impulses
+    gather_spring_impulses = gather_spring_impulses or options.gather
 
     setup_robot(*robots[options.robot_id]())
 
-    if options.task == 'plot':
+    if options.task == 'benchmark':
+        benchmark()
+    elif options.task == 'plot':
         ret = {}
         for toi in [False, True]:
             ret[toi] = []
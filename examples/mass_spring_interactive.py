@@ -7,6 +7,9 @@ import taichi as ti
 import math
 import numpy as np
 import os
+from optimizers import ClippedSGD
+from field_init import initial_rows, normal_weights, upload
+from rendering import LazyGUI
 
 real = ti.f32
 ti.init(default_fp=real)
@@ -48,6 +51,14 @@ spring_stiffness = scalar()
 spring_actuation = scalar()
 
 n_sin_waves = 10
+# If True, the frequency and phase of every sine-wave input of the controller
+# are trained along with its weights.
+learn_sin_basis = False
+sin_omega = scalar()
+sin_phase = scalar()
+# Value of every sine-wave input at every timestep, precomputed by
+# compute_sin_basis() instead of being evaluated by every hidden unit in nn1.
+sin_basis = scalar()
 weights1 = scalar()
 bias1 = scalar()
 
@@ -61,6 +72,9 @@ target_v = vec()
 
 act = scalar()
 
+# Squared gradient norm of the controller, written by ClippedSGD.
+grad_norm_sqr = ti.field(ti.f64)
+
 
 def n_input_states():
     return n_sin_waves + 4 * n_objects + 2
@@ -71,6 +85,8 @@ def allocate_fields():
     ti.root.dense(ti.i, n_springs).place(spring_anchor_a, spring_anchor_b,
                                          spring_length, spring_stiffness,
                                          spring_actuation)
+    ti.root.dense(ti.i, n_sin_waves).place(sin_omega, sin_phase)
+    ti.root.dense(ti.ij, (max_steps, n_sin_waves)).place(sin_basis)
     ti.root.dense(ti.ij, (n_hidden, n_input_states())).place(weights1)
     ti.root.dense(ti.i, n_hidden).place(bias1)
     ti.root.dense(ti.ij, (n_springs, n_hidden)).place(weights2)
@@ -79,6 +95,7 @@ def allocate_fields():
     ti.root.dense(ti.ij, (max_steps, n_springs)).place(act)
     ti.root.dense(ti.i, max_steps).place(center, target_v)
     ti.root.place(loss, goal)
+    ti.root.dense(ti.i, 1).place(grad_norm_sqr)
     ti.root.lazy_grad()
 
 
@@ -95,13 +112,25 @@ def compute_center(t: ti.i32):
         center[t] = (1.0 / n_objects) * c
 
 
+@ti.kernel
+def compute_sin_basis():
+    for t, j in sin_basis:
+        sin_basis[t, j] = ti.sin(sin_omega[j] * t * dt + sin_phase[j])
+
+
+def init_sin_basis():
+    sin_omega.fill(spring_omega)
+    sin_phase.from_numpy(
+        (2 * math.pi / n_sin_waves * np.arange(n_sin_waves)).astype(np.float32))
+    compute_sin_basis()
+
+
 @ti.kernel
 def nn1(t: ti.i32):
     for i in range(n_hidden):
         actuation = 0.0
         for j in ti.static(range(n_sin_waves)):
-            actuation += weights1[i, j] * ti.sin(spring_omega * t * dt +
-                                                 2 * math.pi / n_sin_waves * j)
+            actuation += weights1[i, j] * sin_basis[t, j]
         for j in ti.static(range(n_objects)):
             offset = x[t, j] - center[t]
             # use a smaller weight since there are too many of them
@@ -174,7 +203,8 @@ def compute_loss(t: ti.i32):
     ti.atomic_add(loss[None], dt * (target_v[t][0] - v[t, head_id][0])**2)
 
 
-gui = ti.GUI("Mass Spring Robot", (512, 512), background_color=0xFFFFFF)
+# Created on first use, offscreen if there is no display.
+gui = LazyGUI("Mass Spring Robot", (512, 512), background_color=0xFFFFFF)
 
 
 def forward(output=None, visualize=True):
@@ -191,6 +221,9 @@ def forward(output=None, visualize=True):
 
     total_steps = steps if not output else steps * 2
 
+    if learn_sin_basis:
+        compute_sin_basis()
+
     pool = [(random.random() - 0.5) * 2 for _ in range(100)]
     for i in range(total_steps):
         if output:
@@ -276,29 +309,31 @@ def setup_robot(objects, springs):
 
     print('n_objects=', n_objects, '   n_springs=', n_springs)
 
-    for i in range(n_objects):
-        x[0, i] = [objects[i][0] + 0.4, objects[i][1]]
-
-    for i in range(n_springs):
-        s = springs[i]
-        spring_anchor_a[i] = s[0]
-        spring_anchor_b[i] = s[1]
-        spring_length[i] = s[2]
-        spring_stiffness[i] = s[3]
-        spring_actuation[i] = s[4]
+    upload(x, initial_rows(objects + [0.4, 0], max_steps))
+    upload(spring_anchor_a, springs['anchor_a'])
+    upload(spring_anchor_b, springs['anchor_b'])
+    upload(spring_length, springs['length'])
+    upload(spring_stiffness, springs['stiffness'])
+    upload(spring_actuation, springs['actuation'])
 
 
 def optimize(visualize):
-    for i in range(n_hidden):
-        for j in range(n_input_states()):
-            weights1[i, j] = np.random.randn() * math.sqrt(
-                2 / (n_hidden + n_input_states())) * 2
-
-    for i in range(n_springs):
-        for j in range(n_hidden):
-            # TODO: n_springs should be n_actuators
-            weights2[i, j] = np.random.randn() * math.sqrt(
-                2 / (n_hidden + n_springs)) * 3
+    upload(weights1, normal_weights((n_hidden, n_input_states()),
+                                    n_hidden + n_input_states(), 2))
+    # TODO: n_springs should be n_actuators
+    upload(weights2, normal_weights((n_springs, n_hidden),
+                                    n_hidden + n_springs, 3))
+
+    init_sin_basis()
+    params = [weights1, bias1, weights2, bias2]
+    if learn_sin_basis:
+        params += [sin_omega, sin_phase]
+    optimizer = ClippedSGD(params,
+                           grad_norm_sqr,
+                           learning_rate=1,
+                           gradient_clip=0.1,
+                           eps=1e-6,
+                           normalize=True)
 
     losses = []
     # forward('initial{}'.format(robot_id), visualize=visualize)
@@ -313,31 +348,9 @@ def optimize(visualize):
 
         print('Iter=', iter, 'Loss=', loss[None])
 
-        total_norm_sqr = 0
-        for i in range(n_hidden):
-            for j in range(n_input_states()):
-                total_norm_sqr += weights1.grad[i, j]**2
-            total_norm_sqr += bias1.grad[i]**2
-
-        for i in range(n_springs):
-            for j in range(n_hidden):
-                total_norm_sqr += weights2.grad[i, j]**2
-            total_norm_sqr += bias2.grad[i]**2
-
+        total_norm_sqr = optimizer.step()[0]
         print(total_norm_sqr)
 
-        # scale = learning_rate * min(1.0, gradient_clip / total_norm_sqr ** 0.5)
-        gradient_clip = 0.1
-        scale = gradient_clip / (total_norm_sqr**0.5 + 1e-6)
-        for i in range(n_hidden):
-            for j in range(n_input_states()):
-                weights1[i, j] -= scale * weights1.grad[i, j]
-            bias1[i] -= scale * bias1.grad[i]
-
-        for i in range(n_springs):
-            for j in range(n_hidden):
-                weights2[i, j] -= scale * weights2.grad[i, j]
-            bias2[i] -= scale * bias2.grad[i]
         losses.append(loss[None])
 
         print(time.time() - t, ' 2')
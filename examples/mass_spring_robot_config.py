@@ -1,6 +1,16 @@
+import functools
+
+import numpy as np
+
 objects = []
 springs = []
 
+# Springs of the skeletons returned by the robots below. Objects are returned
+# as an (n_objects, 2) array of positions.
+spring_dtype = np.dtype([('anchor_a', np.int32), ('anchor_b', np.int32),
+                         ('length', np.float64), ('stiffness', np.float64),
+                         ('actuation', np.float64)])
+
 
 def add_object(x):
     objects.append(x)
@@ -14,6 +24,32 @@ def add_spring(a, b, length=None, stiffness=1, actuation=0.1):
     springs.append([a, b, length, stiffness, actuation])
 
 
+def skeleton(build):
+    """
+    Turn a robot built through the functions above into a memoized function
+    returning its (objects, springs) arrays. Every robot starts from empty
+    lists, so building one does not add to another. The arrays are read-only,
+    since every caller shares them.
+    """
+
+    @functools.lru_cache(maxsize=None)
+    @functools.wraps(build)
+    def build_arrays():
+        objects.clear()
+        springs.clear()
+        point_id.clear()
+        mesh_springs.clear()
+        build()
+        object_array = np.array(objects, dtype=np.float64).reshape(-1, 2)
+        spring_array = np.array([tuple(s) for s in springs], dtype=spring_dtype)
+        object_array.flags.writeable = False
+        spring_array.flags.writeable = False
+        return object_array, spring_array
+
+    return build_arrays
+
+
+@skeleton
 def robotA():
     add_object([0.2, 0.1])
     add_object([0.3, 0.13])
@@ -39,27 +75,24 @@ def robotA():
     link(3, 1)
     link(5, 1)
 
-    return objects, springs
-
 
-points = []
-point_id = []
-mesh_springs = []
+# Object of every mesh point, and the springs of the mesh as sorted pairs of
+# objects, so that shared points and edges are found in constant time.
+point_id = {}
+mesh_springs = set()
 
 
 def add_mesh_point(i, j):
-    if (i, j) not in points:
-        id = add_object((i * 0.05 + 0.1, j * 0.05 + 0.1))
-        points.append((i, j))
-        point_id.append(id)
-    return point_id[points.index((i, j))]
+    if (i, j) not in point_id:
+        point_id[(i, j)] = add_object((i * 0.05 + 0.1, j * 0.05 + 0.1))
+    return point_id[(i, j)]
 
 
 def add_mesh_spring(a, b, s, act):
-    if (a, b) in mesh_springs or (b, a) in mesh_springs:
+    if (min(a, b), max(a, b)) in mesh_springs:
         return
 
-    mesh_springs.append((a, b))
+    mesh_springs.add((min(a, b), max(a, b)))
     add_spring(a, b, stiffness=s, actuation=act)
 
 
@@ -91,6 +124,7 @@ def add_mesh_triangle(i, j, actuation=0.0):
                 add_mesh_spring(i, j, 3e4, 0)
 
 
+@skeleton
 def robotB():
     add_mesh_triangle(2, 0, actuation=0.15)
     add_mesh_triangle(0, 0, actuation=0.15)
@@ -102,9 +136,8 @@ def robotB():
     # add_mesh_square(2, 3)
     # add_mesh_square(2, 4)
 
-    return objects, springs
-
 
+@skeleton
 def robotC():
     add_mesh_square(2, 0, actuation=0.15)
     add_mesh_square(0, 0, actuation=0.15)
@@ -116,9 +149,8 @@ def robotC():
     add_mesh_square(2, 3)
     add_mesh_square(2, 4)
 
-    return objects, springs
-
 
+@skeleton
 def robotD():
     add_mesh_square(2, 0, actuation=0.15)
     add_mesh_square(0, 0, actuation=0.15)
@@ -133,7 +165,5 @@ def robotD():
     add_mesh_square(4, 0, actuation=0.15)
     add_mesh_square(4, 1, actuation=0.15)
 
-    return objects, springs
-
 
 robots = [robotA, robotB, robotC, robotD]
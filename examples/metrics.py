@@ -0,0 +1,38 @@
+import csv
+import os
+
+# Loss components written by rigid_body.compute_loss(), in the order of its
+# loss_components field.
+loss_component_names = ['distance', 'deviation', 'deformation']
+
+
+class MetricsLog:
+    """
+    CSV stream of sampled training metrics, one row per write(). Rows are
+    flushed as they are written, so the file can be followed while training
+    runs.
+
+    Parameters:
+        filepath (str): CSV file to create. Its directory is created if needed.
+        fields (list): Column names.
+    """
+
+    def __init__(self, filepath, fields):
+        os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        self.filepath = filepath
+        self.file = open(filepath, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=fields)
+        self.writer.writeheader()
+
+    def write(self, **row):
+        self.writer.writerow(row)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,259 @@
+import taichi as ti
+
+
+@ti.func
+def batch_index(I: ti.template(), batched: ti.template()):
+    b = 0
+    if ti.static(batched):
+        b = I[0]
+    return b
+
+
+@ti.func
+def grad_sqr(p: ti.template(), I: ti.template(), dtype: ti.template()):
+    g = ti.cast(p.grad[I], dtype)
+    if ti.static(isinstance(p, ti.MatrixField)):
+        return g.norm_sqr()
+    else:
+        return g * g
+
+
+@ti.func
+def clipped_grad(p: ti.template(), I: ti.template(), norm_sqr: ti.template(),
+                 gradient_clip, eps, clip: ti.template(),
+                 normalize: ti.template(), batched: ti.template()):
+    scale = ti.cast(1.0, norm_sqr.dtype)
+    if ti.static(clip):
+        scale = gradient_clip / (ti.sqrt(norm_sqr[batch_index(I, batched)]) +
+                                 eps)
+        if ti.static(not normalize):
+            scale = ti.min(1.0, scale)
+    return ti.cast(scale * p.grad[I], p.dtype)
+
+
+@ti.func
+def update_element(p: ti.template(), m: ti.template(), s: ti.template(),
+                   I: ti.template(), g, learning_rate, beta1, beta2, epsilon,
+                   rule: ti.template()):
+    if ti.static(rule == 'sgd'):
+        p[I] -= ti.cast(learning_rate * g, p.dtype)
+    elif ti.static(rule == 'momentum'):
+        m[I] = beta1 * m[I] + (1 - beta1) * g
+        p[I] -= ti.cast(learning_rate * m[I], p.dtype)
+    else:
+        m[I] = beta1 * m[I] + (1 - beta1) * g
+        s[I] = beta2 * s[I] + (1 - beta2) * g * g
+        p[I] -= ti.cast(learning_rate * m[I] / (ti.sqrt(s[I]) + epsilon),
+                        p.dtype)
+
+
+@ti.kernel
+def clipped_update(params: ti.template(), first: ti.template(),
+                   second: ti.template(), norm_sqr: ti.template(),
+                   learning_rate: ti.f32, gradient_clip: ti.f32, eps: ti.f32,
+                   beta1: ti.f32, beta2: ti.f32, epsilon: ti.f32,
+                   rule: ti.template(), clip: ti.template(),
+                   normalize: ti.template(), batched: ti.template(),
+                   dtype: ti.template(), has_first: ti.template(),
+                   has_second: ti.template()):
+    """
+    Squared gradient norm and clipped update of every field in params, in one
+    launch. With batched, the leading axis of every field indexes independent
+    models, each with its own norm in norm_sqr[b], accumulated in dtype.
+    first and second hold the moment estimates of every parameter if
+    has_first and has_second; otherwise they are placeholders of the length
+    of params. 0-D fields are updated by a serial statement instead of a
+    loop.
+    """
+    for b in norm_sqr:
+        norm_sqr[b] = 0.0
+    for k in ti.static(range(len(params))):
+        if ti.static(len(params[k].shape) > 0):
+            for I in ti.grouped(params[k]):
+                norm_sqr[batch_index(I, batched)] += grad_sqr(params[k], I,
+                                                              dtype)
+        else:
+            norm_sqr[0] += grad_sqr(params[k], None, dtype)
+    for k in ti.static(range(len(params))):
+        p = ti.static(params[k])
+        # Only the rules with moments (has_first, has_second) touch m and s.
+        m = ti.static(first[k])
+        s = ti.static(second[k])
+        if ti.static(len(p.shape) > 0):
+            for I in ti.grouped(p):
+                g = clipped_grad(p, I, norm_sqr, gradient_clip, eps, clip,
+                                 normalize, batched)
+                update_element(p, m, s, I, g, learning_rate, beta1, beta2,
+                               epsilon, rule)
+        else:
+            g = clipped_grad(p, None, norm_sqr, gradient_clip, eps, clip,
+                             normalize, batched)
+            update_element(p, m, s, None, g, learning_rate, beta1, beta2,
+                           epsilon, rule)
+
+
+def zeros_like(fb, p):
+    """
+    A zero-initialized field of the shape, element type and dtype of p,
+    placed in the FieldsBuilder fb.
+    """
+    if isinstance(p, ti.MatrixField) and getattr(p, 'ndim', 2) == 1:
+        z = ti.Vector.field(p.n, dtype=p.dtype)
+    elif isinstance(p, ti.MatrixField):
+        z = ti.Matrix.field(p.n, p.m, dtype=p.dtype)
+    else:
+        z = ti.field(p.dtype)
+    if p.shape:
+        fb.dense(ti.axes(*range(len(p.shape))), p.shape).place(z)
+    else:
+        fb.place(z)
+    return z
+
+
+class ClippedSGD:
+    """
+    Gradient descent on a list of fields, with the step scaled by the global
+    gradient norm. The norm and the update of all parameters run in a single
+    kernel launch instead of per-element Python accesses.
+
+    Parameters:
+        params (list): Fields to optimize; their gradients must be allocated.
+        norm_sqr (field): Field of shape (n_batch,) (or (1,) if not batched)
+            that receives the squared gradient norms, accumulated in its
+            dtype. If None, the optimizer allocates it in f32, which every
+            backend supports.
+        learning_rate (float): Step size.
+        gradient_clip (float): Maximum step norm before the learning rate,
+            or None to use the raw gradients.
+        eps (float): Added to the gradient norm to avoid division by zero.
+        normalize (bool): If True, every step is scaled to exactly
+            gradient_clip; otherwise only steps longer than it are clipped.
+        batched (bool): If True, the leading axis of every field indexes
+            independent models that are clipped separately.
+    """
+
+    rule = 'sgd'
+    # Number of moment estimates kept per parameter.
+    n_moments = 0
+
+    def __init__(self, params, norm_sqr=None, learning_rate=1.0,
+                 gradient_clip=0.2, eps=1e-4, normalize=False, batched=False):
+        self.params = tuple(params)
+        self.learning_rate = learning_rate
+        self.gradient_clip = gradient_clip
+        self.eps = eps
+        self.normalize = normalize
+        self.batched = batched
+        self.beta1 = 0.0
+        self.beta2 = 0.0
+        self.epsilon = 0.0
+        self.iter = 0
+
+        # The moment estimates stay on the device, in a SNodeTree of their
+        # own that destroy() releases along with the parameters. The builder
+        # is only created if something is placed in it: an unfinalized one
+        # makes every later kernel launch fail.
+        self.snode_tree = None
+        self.norm_sqr = norm_sqr
+        self.first = ()
+        self.second = ()
+        if norm_sqr is None or self.n_moments > 0:
+            fb = ti.FieldsBuilder()
+            if norm_sqr is None:
+                self.norm_sqr = ti.field(ti.f32)
+                n_batch = self.params[0].shape[0] if batched else 1
+                fb.dense(ti.i, n_batch).place(self.norm_sqr)
+            if self.n_moments > 0:
+                self.first = tuple(zeros_like(fb, p) for p in self.params)
+            if self.n_moments > 1:
+                self.second = tuple(zeros_like(fb, p) for p in self.params)
+            self.snode_tree = fb.finalize()
+
+    def reset(self):
+        """
+        Forget the moment estimates, e.g. after the parameters were
+        reinitialized.
+        """
+        self.iter = 0
+        for m in self.first + self.second:
+            m.fill(0)
+
+    def step_size(self):
+        return self.learning_rate
+
+    def step(self):
+        """
+        Apply one update and return the squared gradient norms as a NumPy
+        array.
+        """
+        self.iter += 1
+        # Rules without moments pass params in their place, so that the
+        # kernel can index them statically.
+        clipped_update(self.params, self.first or self.params,
+                       self.second or self.params, self.norm_sqr,
+                       self.step_size(), self.gradient_clip or 0.0, self.eps,
+                       self.beta1, self.beta2, self.epsilon, self.rule,
+                       self.gradient_clip is not None, self.normalize,
+                       self.batched, self.norm_sqr.dtype, bool(self.first),
+                       bool(self.second))
+        return self.norm_sqr.to_numpy()
+
+    def destroy(self):
+        if self.snode_tree is not None:
+            self.snode_tree.destroy()
+            self.snode_tree = None
+
+
+class ClippedMomentum(ClippedSGD):
+    """
+    ClippedSGD with momentum: the step follows an exponential moving average
+    of the clipped gradients, so the learning rate of ClippedSGD carries
+    over.
+
+    Parameters:
+        momentum (float): Decay of the moving average.
+        Other parameters are those of ClippedSGD.
+    """
+
+    rule = 'momentum'
+    n_moments = 1
+
+    def __init__(self, params, norm_sqr=None, momentum=0.9, **kwargs):
+        super().__init__(params, norm_sqr, **kwargs)
+        self.beta1 = momentum
+
+
+class ClippedAdam(ClippedSGD):
+    """
+    Adam on the clipped gradients. Every parameter moves by about
+    learning_rate per step whatever the scale of its gradient, so it needs a
+    much smaller learning rate than ClippedSGD.
+
+    Parameters:
+        beta1, beta2 (float): Decay of the first and second moment estimates.
+        epsilon (float): Added to the root of the second moment.
+        Other parameters are those of ClippedSGD.
+    """
+
+    rule = 'adam'
+    n_moments = 2
+
+    def __init__(self, params, norm_sqr=None, beta1=0.9, beta2=0.999,
+                 epsilon=1e-8, **kwargs):
+        super().__init__(params, norm_sqr, **kwargs)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+
+    def step_size(self):
+        # Bias correction of the zero-initialized moment estimates.
+        return self.learning_rate * (1 - self.beta2**self.iter)**0.5 / (
+            1 - self.beta1**self.iter)
+
+
+# Optimizers by the name the examples select them with.
+optimizers = {
+    'sgd': ClippedSGD,
+    'momentum': ClippedMomentum,
+    'adam': ClippedAdam,
+}
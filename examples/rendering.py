@@ -0,0 +1,186 @@
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+
+def has_display():
+    """
+    Whether a window can be opened. On Linux this needs an X11 or Wayland
+    display; other platforms are assumed to have one.
+    """
+    if sys.platform.startswith('linux'):
+        return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+    return True
+
+
+def hex_to_rgb(color):
+    return np.array([(color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF],
+                    dtype=np.uint8)
+
+
+class OffscreenCanvas:
+    """
+    Rasterizes the subset of ti.GUI used by the examples (clear, line, circle
+    and show) into a NumPy image instead of a window, so that frames can be
+    written on machines without a display. Coordinates are normalized to
+    [0, 1] with the origin at the bottom left, radii are in pixels, as for
+    ti.GUI.
+
+    Parameters:
+        name (str): Unused, for compatibility with ti.GUI.
+        res (int or tuple): Width and height in pixels.
+        background_color (int): 0xRRGGBB color of clear().
+    """
+
+    def __init__(self, name='', res=512, background_color=0x000000):
+        self.res = (res, res) if isinstance(res, int) else tuple(res)
+        self.background_color = background_color
+        # Rows from top to bottom, as written to image files.
+        self.img = np.empty((self.res[1], self.res[0], 3), dtype=np.uint8)
+        self.clear()
+
+    def clear(self, color=None):
+        self.img[:] = hex_to_rgb(self.background_color if color is None else color)
+
+    def to_pixels(self, pos):
+        pos = np.ravel(pos).astype(np.float64)
+        return np.array([pos[0] * self.res[0], (1 - pos[1]) * self.res[1]])
+
+    def capsule(self, begin, end, radius, color):
+        """
+        Fill every pixel whose center is within radius pixels of the segment
+        from begin to end (both in pixels), which covers lines and circles.
+        """
+        radius = max(radius, 0.5)
+        x0, y0 = np.floor(np.minimum(begin, end) - radius).astype(int)
+        x1, y1 = np.ceil(np.maximum(begin, end) + radius).astype(int) + 1
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.res[0]), min(y1, self.res[1])
+        if x0 >= x1 or y0 >= y1:
+            return
+        ys, xs = np.mgrid[y0:y1, x0:x1] + 0.5
+        d = end - begin
+        length_sqr = d @ d
+        s = 0.0
+        if length_sqr > 0:
+            s = np.clip(((xs - begin[0]) * d[0] + (ys - begin[1]) * d[1]) /
+                        length_sqr, 0, 1)
+        dist_sqr = (xs - begin[0] - s * d[0])**2 + (ys - begin[1] - s * d[1])**2
+        self.img[y0:y1, x0:x1][dist_sqr <= radius**2] = hex_to_rgb(color)
+
+    def line(self, begin, end, radius=1, color=0xFFFFFF):
+        self.capsule(self.to_pixels(begin), self.to_pixels(end), radius, color)
+
+    def circle(self, pos, color=0xFFFFFF, radius=1):
+        center = self.to_pixels(pos)
+        self.capsule(center, center, radius, color)
+
+    def show(self, file=None):
+        """
+        Write the frame to file if given. Frames are not shown anywhere, so
+        without a file this only clears the canvas, as ti.GUI.show() does.
+        """
+        if file:
+            from imageio import imwrite
+            os.makedirs(os.path.dirname(file) or '.', exist_ok=True)
+            imwrite(file, self.img)
+        self.clear()
+
+
+class LazyGUI:
+    """
+    Stand-in for a ti.GUI that is only created when something is drawn, so
+    that importing a module (e.g. in a GA worker that never visualizes) does
+    not open a window. Without a display, an OffscreenCanvas is created
+    instead, which can still write frames to files.
+
+    Parameters:
+        name, res, background_color: As for ti.GUI.
+        headless (bool): Always use an OffscreenCanvas if True, never if
+            False; None decides by has_display().
+    """
+
+    def __init__(self, name, res=512, background_color=0x000000, headless=None):
+        self.name = name
+        self.res = res
+        self.background_color = background_color
+        self.headless = headless
+        self.backend = None
+
+    def __getattr__(self, attr):
+        # Only called for attributes LazyGUI does not have itself, i.e. the
+        # drawing methods of the backend.
+        if self.backend is None:
+            headless = self.headless
+            if headless is None:
+                headless = not has_display()
+            if headless:
+                self.backend = OffscreenCanvas(self.name, self.res,
+                                               self.background_color)
+            else:
+                import taichi as ti
+                self.backend = ti.GUI(self.name, self.res,
+                                      background_color=self.background_color)
+        return getattr(self.backend, attr)
+
+
+class FrameWriter:
+    """
+    Rasterizes frames in a pool of worker processes. The workers write PNG
+    files themselves, or return their images to be encoded into a single
+    video file with imageio.
+
+    Parameters:
+        render (callable): Module-level function run in the workers. It turns
+            one frame into an image array, or writes the frame to a file and
+            returns None.
+        video (str): Path of the video file (the format follows the
+            extension, e.g. .gif, or .mp4 with imageio-ffmpeg), or None.
+        processes (int): Number of worker processes (None: one per CPU),
+            started with the spawn method.
+            With a single one, frames are rendered in the calling process.
+        fps (int): Frame rate of the video.
+    """
+
+    def __init__(self, render, video=None, processes=None, fps=30):
+        self.render = render
+        self.pool = None
+        processes = processes or os.cpu_count() or 1
+        if processes > 1:
+            # spawn, so that workers never inherit a Taichi runtime (and its
+            # threads) from the parent; they import the module of render.
+            ctx = multiprocessing.get_context('spawn')
+            self.pool = ctx.Pool(processes)
+        self.writer = None
+        if video:
+            import imageio
+            os.makedirs(os.path.dirname(video) or '.', exist_ok=True)
+            self.writer = imageio.get_writer(video, fps=fps)
+
+    def write(self, frames):
+        """
+        Render a list of frames and append their images to the video, in
+        order.
+        """
+        if self.pool is None:
+            images = map(self.render, frames)
+        else:
+            images = self.pool.imap(self.render, frames, chunksize=4)
+        for image in images:
+            if self.writer is not None:
+                self.writer.append_data(image)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,46 +1,73 @@
 import taichi as ti
+import functools
 import math
 import numpy as np
 import os
+from optimizers import optimizers
+from incidence import spring_incidence
+from field_init import normal_weights, stack_padded, upload
+import seeding
+from metrics import MetricsLog, loss_component_names
+from rendering import FrameWriter, LazyGUI, OffscreenCanvas
+from taichi.lang import impl
 
 real = ti.f32
 ti.init(default_fp=real, arch=ti.cpu)
 
-max_steps = 4096
 vis_interval = 256
 output_vis_interval = 16
 steps = 2048
-assert steps * 2 <= max_steps
+# Timesteps per segment for gradient checkpointing (see RigidBodySim), or None
+# to keep the whole trajectory for the backward pass.
+checkpoint_segment_length = None
+# If True, every timestep is simulated by the single fused_step() kernel
+# instead of one kernel launch per stage (see RigidBodySim).
+fuse_step_kernels = False
+# If True, spring impulses are stored per spring end and summed by every
+# object over its springs (see spring_incidence()) instead of being scattered
+# into the objects with atomic adds (see RigidBodySim).
+gather_spring_impulses = False
+# If True, every timestep first compacts the box corners that reach the ground
+# within the step into a list, and collision only processes those (see
+# RigidBodySim).
+sparse_contacts = False
+# If True, boxes of a robot also collide with each other, unless a spring or
+# joint connects them (see RigidBodySim).
+box_collisions = False
+# Objects every bucket of the spatial hash of box collisions holds; further
+# objects hashed to a full bucket are not collided.
+bucket_capacity = 8
+# Fraction of the penetration of two boxes resolved per timestep.
+box_contact_stiffness = 0.2
+# The loss components (see loss_component_names) are read back and passed to
+# the metrics callback of RigidBodySim.optimize() every metrics_interval
+# iterations, and after the last one.
+metrics_interval = 10
+# Seed of the initialization of command-line runs (see seeding.py). None draws
+# a fresh one every run.
+seed = 0
+
+# Frames of output rollouts (forward(output=...)) are rendered after the
+# simulation by render_processes worker processes (None: one per CPU, 1: in
+# this process). If output_video is a file extension (e.g. 'gif', or 'mp4'
+# with imageio-ffmpeg), they are encoded into rigid_body/<output>.<ext>
+# instead of being written as PNG files.
+render_processes = None
+output_video = None
 
 vis_resolution = 1024
 
 scalar = lambda: ti.field(dtype=real)
 vec = lambda: ti.Vector.field(2, dtype=real)
 
-loss = scalar()
 
-use_toi = False
+def n_time_steps(output=False):
+    """
+    Length of the time axis needed for training (steps), or for an output
+    rollout, which simulates twice as long.
+    """
+    return steps * 2 if output else steps
 
-x = vec()
-v = vec()
-rotation = scalar()
-# angular velocity
-omega = scalar()
-
-halfsize = vec()
-
-inverse_mass = scalar()
-inverse_inertia = scalar()
-
-v_inc = vec()
-x_inc = vec()
-rotation_inc = scalar()
-omega_inc = scalar()
-
-head_id = 3
-goal = vec()
-
-n_objects = 0
 # target_ball = 0
 elasticity = 0.0
 ground_height = 0.1
@@ -53,93 +80,322 @@ gradient_clip = 30
 spring_omega = 30
 default_actuation = 0.05
 
-n_springs = 0
-spring_anchor_a = ti.field(ti.i32)
-spring_anchor_b = ti.field(ti.i32)
-# spring_length = -1 means it is a joint
-spring_length = scalar()
-spring_offset_a = vec()
-spring_offset_b = vec()
-spring_actuation = scalar()
-spring_stiffness = scalar()
-
 n_sin_waves = 10
+# If True, the frequency and phase of every sine-wave input of the controller
+# are trained along with its weights.
+learn_sin_basis = False
 
 n_hidden = 32
-weights1 = scalar()
-bias1 = scalar()
-hidden = scalar()
-weights2 = scalar()
-bias2 = scalar()
-actuation = scalar()
 
 dt = 0.001
 learning_rate = 1.0
-
-def n_input_states():
+# Update rule of the controllers and spring stiffnesses, a key of
+# optimizers.optimizers. Adam steps every parameter by about its learning
+# rate, so it uses adam_learning_rate instead of learning_rate.
+optimizer_name = 'sgd'
+adam_learning_rate = 0.01
+
+
+def parameter_names():
+    """
+    Trainable fields of RobotFields under the current settings. Read when the
+    optimizer is created rather than at import, so that settings changed
+    afterwards (e.g. learn_sin_basis) are trained.
+    """
+    names = ['weights1', 'bias1', 'weights2', 'bias2', 'spring_stiffness']
+    if learn_sin_basis:
+        names += ['sin_omega', 'sin_phase']
+    return names
+
+
+def n_input_states(n_objects):
     return n_sin_waves + 6 * n_objects + 2
 
 
-def allocate_fields():
-    ti.root.dense(ti.i,
-                  max_steps).dense(ti.j,
-                                   n_objects).place(x, v, rotation,
-                                                    rotation_inc, omega, v_inc,
-                                                    x_inc, omega_inc)
-    ti.root.dense(ti.i, n_objects).place(halfsize, inverse_mass,
-                                         inverse_inertia)
-    ti.root.dense(ti.i, n_springs).place(spring_anchor_a, spring_anchor_b,
-                                         spring_length, spring_offset_a,
-                                         spring_offset_b, spring_stiffness, 
-                                         spring_actuation)
-    ti.root.dense(ti.ij, (n_hidden, n_input_states())).place(weights1)
-    ti.root.dense(ti.ij, (n_springs, n_hidden)).place(weights2)
-    ti.root.dense(ti.i, n_hidden).place(bias1)
-    ti.root.dense(ti.i, n_springs).place(bias2)
-    ti.root.dense(ti.ij, (max_steps, n_springs)).place(actuation)
-    ti.root.dense(ti.ij, (max_steps, n_hidden)).place(hidden)
-    ti.root.place(loss, goal)
-    ti.root.lazy_grad()
+@ti.data_oriented
+class RobotFields:
+    """
+    All Taichi fields of a population of n_batch robots, placed on their own
+    SNodeTree so they can be destroyed when robots of another size are set up.
+    Every per-robot field has a leading population axis; robots with fewer
+    objects or springs than the fields hold are padded and masked out.
+    Kernels take a RobotFields as a template argument, so they are compiled
+    once per RobotFields and reused by every population loaded into it.
+
+    Parameters:
+        n_objects (int): Number of boxes per robot (after padding).
+        n_springs (int): Number of springs and joints per robot (after padding).
+        n_steps (int): Length of the time axis.
+        n_batch (int): Number of robots simulated in lockstep.
+        n_checkpoints (int): Number of saved states for checkpointed
+            simulation. Slot 0 always holds the initial state.
+        n_basis_steps (int): Number of timesteps of the sine-wave basis,
+            i.e. the longest simulation. Defaults to n_steps.
+        n_buckets (int): Number of buckets of the spatial hash of box
+            collisions per robot, 1 if boxes do not collide.
+    """
+
+    def __init__(self, n_objects, n_springs, n_steps=steps, n_batch=1,
+                 n_checkpoints=1, n_basis_steps=None, n_buckets=1):
+        self.n_objects = n_objects
+        self.n_springs = n_springs
+        self.n_steps = n_steps
+        self.n_batch = n_batch
+        self.n_checkpoints = n_checkpoints
+        self.n_buckets = n_buckets
+        # A box can only overlap the boxes of the 3 x 3 cells around it.
+        self.n_neighbors = 1
+        if n_buckets > 1:
+            self.n_neighbors = max(1, min(9 * bucket_capacity, n_objects - 1))
+        # Number of timesteps written by the last forward pass, i.e. the rows
+        # clear_states() has to reset.
+        self.touched_steps = 0
+
+        # Sum of the losses of all robots, the value the Tape differentiates.
+        self.loss = scalar()
+        self.losses = scalar()
+
+        self.x = vec()
+        self.v = vec()
+        self.rotation = scalar()
+        # angular velocity
+        self.omega = scalar()
+
+        # States at segment boundaries, from which checkpointed simulation
+        # recomputes the trajectory of a segment during the backward pass.
+        self.checkpoint_x = vec()
+        self.checkpoint_v = vec()
+        self.checkpoint_rotation = scalar()
+        self.checkpoint_omega = scalar()
+
+        self.halfsize = vec()
+        # 1 for real objects and springs, 0 for padding.
+        self.object_mask = scalar()
+        self.spring_mask = scalar()
+        self.object_count = ti.field(ti.i32)
+
+        self.inverse_mass = scalar()
+        self.inverse_inertia = scalar()
+
+        self.v_inc = vec()
+        self.x_inc = vec()
+        self.rotation_inc = scalar()
+        self.omega_inc = scalar()
+
+        self.head_id = ti.field(ti.i32)
+        self.goal = vec()
+
+        self.spring_anchor_a = ti.field(ti.i32)
+        self.spring_anchor_b = ti.field(ti.i32)
+        # spring_length = -1 means it is a joint
+        self.spring_length = scalar()
+        self.spring_offset_a = vec()
+        self.spring_offset_b = vec()
+        self.spring_actuation = scalar()
+        self.spring_stiffness = scalar()
+        # Change of velocity and angular velocity every spring end causes,
+        # for gathering them per object. End 2 * s + k of spring s is
+        # [..., s, k], with k = 0 for anchor a and 1 for anchor b.
+        self.spring_delta_v = vec()
+        self.spring_delta_omega = scalar()
+        # Spring ends attached to every object in CSR form, see
+        # spring_incidence().
+        self.incidence_offset = ti.field(ti.i32)
+        self.incidence = ti.field(ti.i32)
+        # Box corners in contact with the ground during every row, as
+        # (b * n_objects + i) * 4 + k for corner k of object i of robot b,
+        # see find_contacts().
+        self.n_contacts = ti.field(ti.i32)
+        self.contacts = ti.field(ti.i32)
+        # Spatial hash of the boxes of every robot, rebuilt every timestep by
+        # build_box_grid(): the grid cell of the center of every box is
+        # hashed to a bucket. Cells are cell_size wide, at least the diameter
+        # of the largest box. The boxes every box may overlap during every
+        # row are listed in neighbors.
+        self.cell_size = scalar()
+        self.bucket_count = ti.field(ti.i32)
+        self.bucket_objects = ti.field(ti.i32)
+        self.neighbor_count = ti.field(ti.i32)
+        self.neighbors = ti.field(ti.i32)
+
+        self.sin_omega = scalar()
+        self.sin_phase = scalar()
+        # Value of every sine-wave input at every timestep, precomputed by
+        # compute_sin_basis() instead of being evaluated by every hidden unit
+        # in nn1. Indexed by timestep, not by row, since it is not a state.
+        self.sin_basis = scalar()
+
+        self.weights1 = scalar()
+        self.bias1 = scalar()
+        self.hidden = scalar()
+        self.weights2 = scalar()
+        self.bias2 = scalar()
+        self.actuation = scalar()
+
+        self.deformation_loss = scalar()
+        # Distance, deviation and deformation loss of every robot.
+        self.loss_components = ti.Vector.field(len(loss_component_names),
+                                               dtype=real)
+        self.grad_norm_sqr = ti.field(ti.f64)
+
+        fb = ti.FieldsBuilder()
+        fb.dense(ti.ijk, (n_batch, n_steps, n_objects)).place(
+            self.x, self.v, self.rotation, self.rotation_inc, self.omega,
+            self.v_inc, self.x_inc, self.omega_inc)
+        fb.dense(ti.ijk, (n_batch, n_checkpoints, n_objects)).place(
+            self.checkpoint_x, self.checkpoint_v, self.checkpoint_rotation,
+            self.checkpoint_omega)
+        fb.dense(ti.ij, (n_batch, n_objects)).place(self.halfsize,
+                                                    self.inverse_mass,
+                                                    self.inverse_inertia,
+                                                    self.object_mask)
+        fb.dense(ti.ij, (n_batch, n_springs)).place(self.spring_anchor_a,
+                                                    self.spring_anchor_b,
+                                                    self.spring_length,
+                                                    self.spring_offset_a,
+                                                    self.spring_offset_b,
+                                                    self.spring_stiffness,
+                                                    self.spring_actuation,
+                                                    self.spring_mask)
+        fb.dense(ti.ijkl, (n_batch, n_steps, n_springs, 2)).place(
+            self.spring_delta_v, self.spring_delta_omega)
+        fb.dense(ti.ij, (n_batch, n_objects + 1)).place(self.incidence_offset)
+        fb.dense(ti.i, n_steps).place(self.n_contacts)
+        fb.dense(ti.ij, (n_steps, n_batch * n_objects * 4)).place(self.contacts)
+        fb.dense(ti.ij, (n_batch, n_buckets)).place(self.bucket_count)
+        fb.dense(ti.ijk, (n_batch, n_buckets, bucket_capacity)).place(
+            self.bucket_objects)
+        fb.dense(ti.ijk, (n_batch, n_steps, n_objects)).place(
+            self.neighbor_count)
+        fb.dense(ti.ijkl, (n_batch, n_steps, n_objects, self.n_neighbors)).place(
+            self.neighbors)
+        fb.dense(ti.ij, (n_batch, 2 * n_springs)).place(self.incidence)
+        fb.dense(ti.ij, (n_batch, n_sin_waves)).place(self.sin_omega,
+                                                      self.sin_phase)
+        fb.dense(ti.ijk, (n_batch, n_basis_steps or n_steps,
+                          n_sin_waves)).place(self.sin_basis)
+        fb.dense(ti.ijk, (n_batch, n_hidden, n_input_states(n_objects))).place(
+            self.weights1)
+        fb.dense(ti.ijk, (n_batch, n_springs, n_hidden)).place(self.weights2)
+        fb.dense(ti.ij, (n_batch, n_hidden)).place(self.bias1)
+        fb.dense(ti.ij, (n_batch, n_springs)).place(self.bias2)
+        fb.dense(ti.ijk, (n_batch, n_steps, n_springs)).place(self.actuation)
+        fb.dense(ti.ijk, (n_batch, n_steps, n_hidden)).place(self.hidden)
+        fb.dense(ti.i, n_batch).place(self.losses, self.head_id,
+                                      self.object_count,
+                                      self.deformation_loss,
+                                      self.loss_components,
+                                      self.grad_norm_sqr)
+        fb.place(self.loss, self.goal, self.cell_size)
+        fb.lazy_grad()
+        self.snode_tree = fb.finalize()
+        # Keeps its moment estimates next to the fields, for as long as they
+        # live.
+        self.optimizer = optimizers[optimizer_name](
+            [getattr(self, name) for name in parameter_names()],
+            self.grad_norm_sqr,
+            learning_rate=adam_learning_rate
+            if optimizer_name == 'adam' else learning_rate,
+            gradient_clip=0.2,
+            eps=1e-4,
+            batched=True)
+
+    def destroy(self):
+        self.optimizer.destroy()
+        self.snode_tree.destroy()
+
+
+def untaped(kernel):
+    """
+    Keep a kernel that is not differentiated off the ti.ad.Tape. Unlike
+    ti.ad.no_grad, which clears the grad_replaced flag of the runtime when it
+    returns, this restores the flag it found: called from simulate_segment()
+    (a ti.ad.grad_replaced function), no_grad would let the tape record the
+    rest of the segment, which simulate_segment_grad() already
+    differentiates.
+    """
+    @functools.wraps(kernel)
+    def decorated(*args):
+        runtime = impl.get_runtime()
+        replaced = runtime.grad_replaced
+        runtime.grad_replaced = True
+        try:
+            kernel(*args)
+        finally:
+            runtime.grad_replaced = replaced
+
+    return decorated
+
+
+@ti.func
+def row(f, t):
+    # Row of timestep t on the time axis. In checkpointed mode the time axis
+    # is a ring buffer over the current segment; otherwise it never wraps.
+    return t % f.n_steps
+
 
 @ti.kernel
-def nn1(t: ti.i32):
-    for i in range(n_hidden):
-        actuation = 0.0
-        for j in ti.static(range(n_sin_waves)):
-            actuation += weights1[i, j] * ti.sin(spring_omega * t * dt +
-                                                 2 * math.pi / n_sin_waves * j)
-        for j in ti.static(range(n_objects)):
-            offset = x[t, j] - x[t, head_id]
-            # use a smaller weight since there are too many of them
-            actuation += weights1[i, j * 6 + n_sin_waves] * offset[0] * 0.05
-            actuation += weights1[i,
-                                  j * 6 + n_sin_waves + 1] * offset[1] * 0.05
-            actuation += weights1[i, j * 6 + n_sin_waves + 2] * v[t,
-                                                                  j][0] * 0.05
-            actuation += weights1[i, j * 6 + n_sin_waves + 3] * v[t,
-                                                                  j][1] * 0.05
-            actuation += weights1[i, j * 6 + n_sin_waves +
-                                  4] * rotation[t, j] * 0.05
-            actuation += weights1[i, j * 6 + n_sin_waves + 5] * omega[t,
-                                                                      j] * 0.05
-
-        actuation += weights1[i, n_objects * 6 + n_sin_waves] * goal[None][0]
-        actuation += weights1[i,
-                              n_objects * 6 + n_sin_waves + 1] * goal[None][1]
-        actuation += bias1[i]
-        actuation = ti.tanh(actuation)
-        hidden[t, i] = actuation
+def compute_sin_basis(f: ti.template()):
+    for b, t, j in f.sin_basis:
+        f.sin_basis[b, t, j] = ti.sin(f.sin_omega[b, j] * t * dt +
+                                      f.sin_phase[b, j])
+
+
+# The stages of a timestep are written as ti.funcs computing one element, so
+# that the per-stage kernels and fused_step() share the same code.
+@ti.func
+def nn1_hidden(f, t, b, i):
+    r = row(f, t)
+    head_id = f.head_id[b]
+    actuation = 0.0
+    for j in ti.static(range(n_sin_waves)):
+        actuation += f.weights1[b, i, j] * f.sin_basis[b, t, j]
+    for j in ti.static(range(f.n_objects)):
+        offset = f.x[b, r, j] - f.x[b, r, head_id]
+        # padded objects feed zeros into the controller
+        mask = f.object_mask[b, j]
+        # use a smaller weight since there are too many of them
+        actuation += f.weights1[b, i, j * 6 + n_sin_waves] * offset[0] * 0.05 * mask
+        actuation += f.weights1[b, i,
+                                j * 6 + n_sin_waves + 1] * offset[1] * 0.05 * mask
+        actuation += f.weights1[b, i, j * 6 + n_sin_waves + 2] * f.v[b, r,
+                                                                     j][0] * 0.05 * mask
+        actuation += f.weights1[b, i, j * 6 + n_sin_waves + 3] * f.v[b, r,
+                                                                     j][1] * 0.05 * mask
+        actuation += f.weights1[b, i, j * 6 + n_sin_waves +
+                                4] * f.rotation[b, r, j] * 0.05 * mask
+        actuation += f.weights1[b, i, j * 6 + n_sin_waves + 5] * f.omega[b, r,
+                                                                         j] * 0.05 * mask
+
+    actuation += f.weights1[b, i, f.n_objects * 6 + n_sin_waves] * f.goal[None][0]
+    actuation += f.weights1[b, i,
+                            f.n_objects * 6 + n_sin_waves + 1] * f.goal[None][1]
+    actuation += f.bias1[b, i]
+    actuation = ti.tanh(actuation)
+    f.hidden[b, r, i] = actuation
 
 
 @ti.kernel
-def nn2(t: ti.i32):
-    for i in range(n_springs):
-        act = 0.0
-        for j in ti.static(range(n_hidden)):
-            act += weights2[i, j] * hidden[t, j]
-        act += bias2[i]
-        act = ti.tanh(act)
-        actuation[t, i] = act
+def nn1(f: ti.template(), t: ti.i32):
+    for b, i in ti.ndrange(f.n_batch, n_hidden):
+        nn1_hidden(f, t, b, i)
+
+
+@ti.func
+def nn2_spring(f, t, b, i):
+    r = row(f, t)
+    act = 0.0
+    for j in ti.static(range(n_hidden)):
+        act += f.weights2[b, i, j] * f.hidden[b, r, j]
+    act += f.bias2[b, i]
+    act = ti.tanh(act)
+    f.actuation[b, r, i] = act
+
+
+@ti.kernel
+def nn2(f: ti.template(), t: ti.i32):
+    for b, i in ti.ndrange(f.n_batch, f.n_springs):
+        nn2_spring(f, t, b, i)
 
 
 @ti.func
@@ -148,170 +404,402 @@ def rotation_matrix(r):
 
 
 @ti.kernel
-def initialize_properties():
-    for i in range(n_objects):
-        inverse_mass[i] = 1.0 / (4 * halfsize[i][0] * halfsize[i][1])
-        inverse_inertia[i] = 1.0 / (4 / 3 * halfsize[i][0] * halfsize[i][1] *
-                                    (halfsize[i][0] * halfsize[i][0] +
-                                     halfsize[i][1] * halfsize[i][1]))
+def initialize_properties(f: ti.template()):
+    for b, i in ti.ndrange(f.n_batch, f.n_objects):
+        # padded objects stay massless so that no impulse can move them
+        f.inverse_mass[b, i] = 0.0
+        f.inverse_inertia[b, i] = 0.0
+        if f.object_mask[b, i] > 0:
+            hs = f.halfsize[b, i]
+            f.inverse_mass[b, i] = 1.0 / (4 * hs[0] * hs[1])
+            f.inverse_inertia[b, i] = 1.0 / (4 / 3 * hs[0] * hs[1] *
+                                             (hs[0] * hs[0] + hs[1] * hs[1]))
         # ti.print(inverse_mass[i])
         # ti.print(inverse_inertia[i])
 
 
 @ti.func
-def to_world(t, i, rela_x):
-    rot = rotation[t, i]
+def to_world(f, b, t, i, rela_x):
+    r = row(f, t)
+    rot = f.rotation[b, r, i]
     rot_matrix = rotation_matrix(rot)
 
     rela_pos = rot_matrix @ rela_x
-    rela_v = omega[t, i] * ti.Vector([-rela_pos[1], rela_pos[0]])
+    rela_v = f.omega[b, r, i] * ti.Vector([-rela_pos[1], rela_pos[0]])
 
-    world_x = x[t, i] + rela_pos
-    world_v = v[t, i] + rela_v
+    world_x = f.x[b, r, i] + rela_pos
+    world_v = f.v[b, r, i] + rela_v
 
     return world_x, world_v, rela_pos
 
 
 @ti.func
-def apply_impulse(t, i, impulse, location, toi_input):
+def impulse_response(f, b, t, i, impulse, location):
+    delta_v = impulse * f.inverse_mass[b, i]
+    delta_omega = (location - f.x[b, row(f, t), i]).cross(impulse) * \
+                  f.inverse_inertia[b, i]
+    return delta_v, delta_omega
+
+
+@ti.func
+def apply_impulse(f, b, t, i, impulse, location, toi_input):
+    r1 = row(f, t + 1)
     # ti.print(toi)
-    delta_v = impulse * inverse_mass[i]
-    delta_omega = (location - x[t, i]).cross(impulse) * inverse_inertia[i]
+    delta_v, delta_omega = impulse_response(f, b, t, i, impulse, location)
 
     toi = ti.min(ti.max(0.0, toi_input), dt)
 
-    ti.atomic_add(x_inc[t + 1, i], toi * (-delta_v))
-    ti.atomic_add(rotation_inc[t + 1, i], toi * (-delta_omega))
+    ti.atomic_add(f.x_inc[b, r1, i], toi * (-delta_v))
+    ti.atomic_add(f.rotation_inc[b, r1, i], toi * (-delta_omega))
 
-    ti.atomic_add(v_inc[t + 1, i], delta_v)
-    ti.atomic_add(omega_inc[t + 1, i], delta_omega)
+    ti.atomic_add(f.v_inc[b, r1, i], delta_v)
+    ti.atomic_add(f.omega_inc[b, r1, i], delta_omega)
 
 
-@ti.kernel
-def collide(t: ti.i32):
-    for i in range(n_objects):
-        hs = halfsize[i]
+@ti.func
+def corner_state(f, t, b, i, k):
+    # World position, velocity after gravity, and offset from the center of
+    # mass of corner k of object i.
+    offset_scale = ti.Vector([k % 2 * 2 - 1, k // 2 % 2 * 2 - 1])
+    corner_x, corner_v, rela_pos = to_world(f, b, t, i,
+                                            offset_scale * f.halfsize[b, i])
+    corner_v = corner_v + dt * gravity * ti.Vector([0.0, 1.0])
+    return corner_x, corner_v, rela_pos
+
+
+@ti.func
+def collide_corner(f, t, b, i, k):
+    corner_x, corner_v, rela_pos = corner_state(f, t, b, i, k)
+
+    # Apply impulse so that there's no sinking
+    normal = ti.Vector([0.0, 1.0])
+    tao = ti.Vector([1.0, 0.0])
+
+    rn = rela_pos.cross(normal)
+    rt = rela_pos.cross(tao)
+    impulse_contribution = f.inverse_mass[b, i] + (rn) ** 2 * \
+                           f.inverse_inertia[b, i]
+    timpulse_contribution = f.inverse_mass[b, i] + (rt) ** 2 * \
+                            f.inverse_inertia[b, i]
+
+    rela_v_ground = normal.dot(corner_v)
+
+    impulse = 0.0
+    timpulse = 0.0
+    new_corner_x = corner_x + dt * corner_v
+    toi = 0.0
+    if rela_v_ground < 0 and new_corner_x[1] < ground_height:
+        impulse = -(1 +
+                    elasticity) * rela_v_ground / impulse_contribution
+        if impulse > 0:
+            # friction
+            timpulse = -corner_v.dot(tao) / timpulse_contribution
+            timpulse = ti.min(friction * impulse,
+                              ti.max(-friction * impulse, timpulse))
+            if corner_x[1] > ground_height:
+                toi = -(corner_x[1] - ground_height) / ti.min(
+                    corner_v[1], -1e-3)
+
+    apply_impulse(f, b, t, i, impulse * normal + timpulse * tao,
+                  new_corner_x, toi)
+
+    penalty = 0.0
+    if new_corner_x[1] < ground_height:
+        # apply penalty
+        penalty = -dt * penalty * (
+            new_corner_x[1] - ground_height) / impulse_contribution
+
+    apply_impulse(f, b, t, i, penalty * normal, new_corner_x, 0)
+
+
+@ti.func
+def collide_object(f, t, b, i):
+    if f.object_mask[b, i] > 0:
         for k in ti.static(range(4)):
-            # the corner for collision detection
-            offset_scale = ti.Vector([k % 2 * 2 - 1, k // 2 % 2 * 2 - 1])
-
-            corner_x, corner_v, rela_pos = to_world(t, i, offset_scale * hs)
-            corner_v = corner_v + dt * gravity * ti.Vector([0.0, 1.0])
-
-            # Apply impulse so that there's no sinking
-            normal = ti.Vector([0.0, 1.0])
-            tao = ti.Vector([1.0, 0.0])
-
-            rn = rela_pos.cross(normal)
-            rt = rela_pos.cross(tao)
-            impulse_contribution = inverse_mass[i] + (rn) ** 2 * \
-                                   inverse_inertia[i]
-            timpulse_contribution = inverse_mass[i] + (rt) ** 2 * \
-                                    inverse_inertia[i]
-
-            rela_v_ground = normal.dot(corner_v)
-
-            impulse = 0.0
-            timpulse = 0.0
-            new_corner_x = corner_x + dt * corner_v
-            toi = 0.0
-            if rela_v_ground < 0 and new_corner_x[1] < ground_height:
-                impulse = -(1 +
-                            elasticity) * rela_v_ground / impulse_contribution
-                if impulse > 0:
-                    # friction
-                    timpulse = -corner_v.dot(tao) / timpulse_contribution
-                    timpulse = ti.min(friction * impulse,
-                                      ti.max(-friction * impulse, timpulse))
-                    if corner_x[1] > ground_height:
-                        toi = -(corner_x[1] - ground_height) / ti.min(
-                            corner_v[1], -1e-3)
-
-            apply_impulse(t, i, impulse * normal + timpulse * tao,
-                          new_corner_x, toi)
-
-            penalty = 0.0
-            if new_corner_x[1] < ground_height:
-                # apply penalty
-                penalty = -dt * penalty * (
-                    new_corner_x[1] - ground_height) / impulse_contribution
-
-            apply_impulse(t, i, penalty * normal, new_corner_x, 0)
+            collide_corner(f, t, b, i, k)
+
+
+@ti.kernel
+def collide(f: ti.template(), t: ti.i32):
+    for b, i in ti.ndrange(f.n_batch, f.n_objects):
+        collide_object(f, t, b, i)
+
+
+@untaped
+@ti.kernel
+def find_contacts(f: ti.template(), t: ti.i32):
+    # Broad phase: list the corners that end the step below the ground, the
+    # only ones collide_corner() applies an impulse to. Its impulses are
+    # zero for all other corners, so the contact list holds everything
+    # collide() would do, including the time of impact. The list is not
+    # differentiated; collide_contacts.grad reads the same list.
+    r = row(f, t)
+    f.n_contacts[r] = 0
+    for b, i in ti.ndrange(f.n_batch, f.n_objects):
+        if f.object_mask[b, i] > 0:
+            for k in ti.static(range(4)):
+                corner_x, corner_v, _ = corner_state(f, t, b, i, k)
+                if corner_x[1] + dt * corner_v[1] < ground_height:
+                    n = ti.atomic_add(f.n_contacts[r], 1)
+                    f.contacts[r, n] = (b * f.n_objects + i) * 4 + k
+
+
+@ti.kernel
+def collide_contacts(f: ti.template(), t: ti.i32, n_contacts: ti.i32):
+    # Autodiff requires a single top-level loop with no other statements, not
+    # even the load of a loop bound from a field, so the number of contacts
+    # find_contacts() listed is passed in and only those are launched.
+    for n in range(n_contacts):
+        c = f.contacts[row(f, t), n]
+        collide_corner(f, t, c // (4 * f.n_objects), c // 4 % f.n_objects,
+                       c % 4)
 
 
+@ti.func
+def grid_bucket(f, b, t, i, dx, dy):
+    # Bucket of the grid cell offset by (dx, dy) from the cell of object i.
+    cell = ti.floor(f.x[b, row(f, t), i] / f.cell_size[None]).cast(ti.i32)
+    h = (cell[0] + dx) * 73856093 ^ (cell[1] + dy) * 19349663
+    return h % f.n_buckets
+
+
+@untaped
 @ti.kernel
-def apply_spring_force(t: ti.i32):
-    
-    for i in range(n_springs):
-        a = spring_anchor_a[i]
-        b = spring_anchor_b[i]
-        pos_a, vel_a, rela_a = to_world(t, a, spring_offset_a[i])
-        pos_b, vel_b, rela_b = to_world(t, b, spring_offset_b[i])
+def build_box_grid(f: ti.template(), t: ti.i32):
+    # Broad phase of box collisions, not differentiated: collide_boxes.grad
+    # reads the same neighbor lists. Every box lists the boxes hashed to the
+    # 3 x 3 cells around it, which hold every box it can overlap, except
+    # those connected to it. Buckets shared by several of these cells are
+    # only visited once.
+    r = row(f, t)
+    for b, h in ti.ndrange(f.n_batch, f.n_buckets):
+        f.bucket_count[b, h] = 0
+    for b, i in ti.ndrange(f.n_batch, f.n_objects):
+        if f.object_mask[b, i] > 0:
+            h = grid_bucket(f, b, t, i, 0, 0)
+            n = ti.atomic_add(f.bucket_count[b, h], 1)
+            if n < bucket_capacity:
+                f.bucket_objects[b, h, n] = i
+    for b, i in ti.ndrange(f.n_batch, f.n_objects):
+        f.neighbor_count[b, r, i] = 0
+        if f.object_mask[b, i] > 0:
+            buckets = ti.Vector.zero(ti.i32, 9)
+            for m in ti.static(range(9)):
+                buckets[m] = grid_bucket(f, b, t, i, m % 3 - 1, m // 3 - 1)
+            for m in ti.static(range(9)):
+                visited = 0
+                for m0 in ti.static(range(m)):
+                    if buckets[m0] == buckets[m]:
+                        visited = 1
+                if visited == 0:
+                    h = buckets[m]
+                    for n in range(ti.min(f.bucket_count[b, h],
+                                          bucket_capacity)):
+                        j = f.bucket_objects[b, h, n]
+                        count = f.neighbor_count[b, r, i]
+                        if j != i and connected(f, b, i, j) == 0 and \
+                                count < f.n_neighbors:
+                            f.neighbors[b, r, i, count] = j
+                            f.neighbor_count[b, r, i] = count + 1
+
+
+@ti.func
+def connected(f, b, i, j):
+    # Whether a spring or joint connects objects i and j, through the
+    # incidence of i (see spring_incidence()).
+    found = 0
+    for k in range(f.incidence_offset[b, i], f.incidence_offset[b, i + 1]):
+        end = f.incidence[b, k]
+        other = f.spring_anchor_b[b, end // 2]
+        if end % 2 == 1:
+            other = f.spring_anchor_a[b, end // 2]
+        if other == j:
+            found = 1
+    return found
+
+
+@ti.func
+def collide_corner_box(f, t, b, i, k, n):
+    # Pushes corner k of object i out of its n-th neighbor j along the axis
+    # of j it penetrates least, removing their approaching velocity and a
+    # box_contact_stiffness fraction of the penetration. Every local is
+    # assigned once, without branches: a corner outside of j (or an unused
+    # neighbor slot) applies a zero impulse. The rotations are written out
+    # rather than matrix products, whose accumulators the reverse pass loads
+    # before they are stored.
+    r = row(f, t)
+    j = f.neighbors[b, r, i, n]
+    corner_x, corner_v, rela_pos = corner_state(f, t, b, i, k)
+    cos_j = ti.cos(f.rotation[b, r, j])
+    sin_j = ti.sin(f.rotation[b, r, j])
+    offset_j = corner_x - f.x[b, r, j]
+    local = ti.Vector([cos_j * offset_j[0] + sin_j * offset_j[1],
+                       cos_j * offset_j[1] - sin_j * offset_j[0]])
+    depth = f.halfsize[b, j] - ti.abs(local)
+    inside = n < f.neighbor_count[b, r, i] and depth[0] > 0 and depth[1] > 0
+    y_axis = depth[1] < depth[0]
+    sign = ti.select(local < 0, -1.0, 1.0)
+    local_normal = ti.Vector([ti.select(y_axis, 0.0, sign[0]),
+                              ti.select(y_axis, sign[1], 0.0)])
+    penetration = ti.min(depth[0], depth[1])
+    normal = ti.Vector([cos_j * local_normal[0] - sin_j * local_normal[1],
+                        sin_j * local_normal[0] + cos_j * local_normal[1]])
+    # After gravity, like corner_v, so that boxes falling together do not
+    # approach each other.
+    v_j = f.v[b, r, j] + f.omega[b, r, j] * ti.Vector(
+        [-offset_j[1], offset_j[0]]) + dt * gravity * ti.Vector([0.0, 1.0])
+    rela_v = normal.dot(corner_v - v_j)
+    impulse_contribution = f.inverse_mass[b, i] + \
+        rela_pos.cross(normal) ** 2 * f.inverse_inertia[b, i] + \
+        f.inverse_mass[b, j] + \
+        offset_j.cross(normal) ** 2 * f.inverse_inertia[b, j]
+    # The contribution of an unused slot may be zero (padded objects).
+    impulse = ti.select(
+        inside, (ti.max(-rela_v, 0.0) + box_contact_stiffness * penetration /
+                 dt) / ti.select(inside, impulse_contribution, 1.0), 0.0)
+    apply_impulse(f, b, t, i, impulse * normal, corner_x, 0.0)
+    apply_impulse(f, b, t, j, -impulse * normal, corner_x, 0.0)
+
+
+@ti.kernel
+def collide_boxes(f: ti.template(), t: ti.i32):
+    # Narrow phase: every corner of every box against the neighbors listed by
+    # build_box_grid(). Autodiff requires a single top-level loop with no
+    # other statements; the corner is one of its indices rather than a
+    # static loop, so no local is carried from one corner to the next.
+    for b, i, n, k in ti.ndrange(f.n_batch, f.n_objects, f.n_neighbors, 4):
+        collide_corner_box(f, t, b, i, k, n)
+
+
+@ti.func
+def spring_force(f, t, b, i, gather: ti.template()):
+    if f.spring_mask[b, i] > 0:
+        a = f.spring_anchor_a[b, i]
+        c = f.spring_anchor_b[b, i]
+        pos_a, vel_a, rela_a = to_world(f, b, t, a, f.spring_offset_a[b, i])
+        pos_b, vel_b, rela_b = to_world(f, b, t, c, f.spring_offset_b[b, i])
         dist = pos_a - pos_b
         length = dist.norm() + 1e-4
-        
-        act = actuation[t, i]
 
-        is_joint = spring_length[i] == -1
+        act = f.actuation[b, row(f, t), i]
 
-        target_length = spring_length[i] * (1.0 + spring_actuation[i] * act)
+        is_joint = f.spring_length[b, i] == -1
+
+        target_length = f.spring_length[b, i] * (1.0 + f.spring_actuation[b, i] * act)
         if is_joint:
             target_length = 0.0
         impulse = dt * (length -
-                        target_length) * spring_stiffness[i] / length * dist
+                        target_length) * f.spring_stiffness[b, i] / length * dist
 
         if is_joint:
             rela_vel = vel_a - vel_b
             rela_vel_norm = rela_vel.norm() + 1e-1
             impulse_dir = rela_vel / rela_vel_norm
-            impulse_contribution = inverse_mass[a] + \
-              impulse_dir.cross(rela_a) ** 2 * inverse_inertia[
-                                     a] + inverse_mass[b] + impulse_dir.cross(rela_b) ** 2 * \
-                                   inverse_inertia[
-                                     b]
+            impulse_contribution = f.inverse_mass[b, a] + \
+              impulse_dir.cross(rela_a) ** 2 * f.inverse_inertia[
+                                     b, a] + f.inverse_mass[b, c] + impulse_dir.cross(rela_b) ** 2 * \
+                                   f.inverse_inertia[
+                                     b, c]
             # project relative velocity
             impulse += rela_vel_norm / impulse_contribution * impulse_dir
 
-        apply_impulse(t, a, -impulse, pos_a, 0.0)
-        apply_impulse(t, b, impulse, pos_b, 0.0)
+        if ti.static(gather):
+            # Stored per end and summed by spring_impulse_sum(). Impulses
+            # without time of impact do not change x_inc or rotation_inc.
+            r1 = row(f, t + 1)
+            f.spring_delta_v[b, r1, i, 0], f.spring_delta_omega[b, r1, i, 0] = \
+                impulse_response(f, b, t, a, -impulse, pos_a)
+            f.spring_delta_v[b, r1, i, 1], f.spring_delta_omega[b, r1, i, 1] = \
+                impulse_response(f, b, t, c, impulse, pos_b)
+        else:
+            apply_impulse(f, b, t, a, -impulse, pos_a, 0.0)
+            apply_impulse(f, b, t, c, impulse, pos_b, 0.0)
+
+
+@ti.kernel
+def apply_spring_force(f: ti.template(), t: ti.i32, gather: ti.template()):
+    for b, i in ti.ndrange(f.n_batch, f.n_springs):
+        spring_force(f, t, b, i, gather)
+
+
+@ti.func
+def spring_impulse_sum(f, t, b, i):
+    # Sum of the velocity changes of the spring ends attached to object i,
+    # read in CSR order by a single thread, so no atomics are needed.
+    r = row(f, t)
+    delta_v = ti.Vector([0.0, 0.0])
+    delta_omega = 0.0
+    for k in range(f.incidence_offset[b, i], f.incidence_offset[b, i + 1]):
+        end = f.incidence[b, k]
+        delta_v += f.spring_delta_v[b, r, end // 2, end % 2]
+        delta_omega += f.spring_delta_omega[b, r, end // 2, end % 2]
+    return delta_v, delta_omega
+
+
+@ti.func
+def advance_object(f, t, b, i, use_toi: ti.template(), gather: ti.template()):
+    r = row(f, t)
+    r0 = row(f, t - 1)
+    s = math.exp(-dt * damping)
+    v_inc = f.v_inc[b, r, i]
+    omega_inc = f.omega_inc[b, r, i]
+    if ti.static(gather):
+        delta_v, delta_omega = spring_impulse_sum(f, t, b, i)
+        v_inc += delta_v
+        omega_inc += delta_omega
+    f.v[b, r, i] = s * f.v[b, r0, i] + v_inc + dt * gravity * ti.Vector(
+        [0.0, 1.0]) * f.object_mask[b, i]
+    f.omega[b, r, i] = s * f.omega[b, r0, i] + omega_inc
+    if ti.static(use_toi):
+        f.x[b, r, i] = f.x[b, r0, i] + dt * f.v[b, r, i] + f.x_inc[b, r, i]
+        f.rotation[b, r, i] = f.rotation[b, r0,
+                                         i] + dt * f.omega[b, r, i] + f.rotation_inc[b, r, i]
+    else:
+        f.x[b, r, i] = f.x[b, r0, i] + dt * f.v[b, r, i]
+        f.rotation[b, r, i] = f.rotation[b, r0, i] + dt * f.omega[b, r, i]
 
 
 @ti.kernel
-def advance_toi(t: ti.i32):
-    for i in range(n_objects):
-        s = math.exp(-dt * damping)
-        v[t, i] = s * v[t - 1, i] + v_inc[t, i] + dt * gravity * ti.Vector(
-            [0.0, 1.0])
-        x[t, i] = x[t - 1, i] + dt * v[t, i] + x_inc[t, i]
-        omega[t, i] = s * omega[t - 1, i] + omega_inc[t, i]
-        rotation[t, i] = rotation[t - 1,
-                                  i] + dt * omega[t, i] + rotation_inc[t, i]
+def advance_toi(f: ti.template(), t: ti.i32, gather: ti.template()):
+    for b, i in ti.ndrange(f.n_batch, f.n_objects):
+        advance_object(f, t, b, i, True, gather)
 
 
 @ti.kernel
-def advance_no_toi(t: ti.i32):
-    for i in range(n_objects):
-        s = math.exp(-dt * damping)
-        v[t, i] = s * v[t - 1, i] + v_inc[t, i] + dt * gravity * ti.Vector(
-            [0.0, 1.0])
-        x[t, i] = x[t - 1, i] + dt * v[t, i]
-        omega[t, i] = s * omega[t - 1, i] + omega_inc[t, i]
-        rotation[t, i] = rotation[t - 1, i] + dt * omega[t, i]
+def advance_no_toi(f: ti.template(), t: ti.i32, gather: ti.template()):
+    for b, i in ti.ndrange(f.n_batch, f.n_objects):
+        advance_object(f, t, b, i, False, gather)
+
+
+@ti.kernel
+def fused_step(f: ti.template(), t: ti.i32, use_toi: ti.template(),
+               gather: ti.template()):
+    # All stages of RigidBodySim.step(t) in a single launch. Every stage is
+    # still a parallel loop of its own, and they run in order.
+    for b, i in ti.ndrange(f.n_batch, n_hidden):
+        nn1_hidden(f, t - 1, b, i)
+    for b, i in ti.ndrange(f.n_batch, f.n_springs):
+        nn2_spring(f, t - 1, b, i)
+    for b, i in ti.ndrange(f.n_batch, f.n_objects):
+        collide_object(f, t - 1, b, i)
+    for b, i in ti.ndrange(f.n_batch, f.n_springs):
+        spring_force(f, t - 1, b, i, gather)
+    for b, i in ti.ndrange(f.n_batch, f.n_objects):
+        advance_object(f, t, b, i, use_toi, gather)
 
 amplitude = 0.75
 frequency = 0.425
-start_pos = ti.Vector([0.25, 0.5]) 
-goal_pos = ti.Vector([0.9, 0.5]) 
-deformation_loss_field = ti.field(dtype=real, shape=())
-# start_pos = ti.Vector([0.25, 0.25]) 
-# goal_pos = ti.Vector([0.9, 0.25]) 
+start_pos = ti.Vector([0.25, 0.5])
+goal_pos = ti.Vector([0.9, 0.5])
+# start_pos = ti.Vector([0.25, 0.25])
+# goal_pos = ti.Vector([0.9, 0.25])
 
 # Follow a cosine wave. Robot center node at trough of wave -> ground is lowest point on path.
 @ti.func
 def gen_cos_path(t, total_steps):
     t_norm = t / total_steps
     x = start_pos[0] + (goal_pos[0] - start_pos[0]) * t_norm
-    y = start_pos[1] - amplitude * ti.cos(frequency * 2 * math.pi * t_norm) 
+    y = start_pos[1] - amplitude * ti.cos(frequency * 2 * math.pi * t_norm)
     return ti.Vector([x, y])
 
 @ti.func
@@ -338,24 +826,29 @@ def gen_parabola_path(t, total_steps):
     k = start_pos[1] + 0.5  # Peak height
     a = -0.5  # Controls curvature (negative for downward-facing)
 
-    y = a * (x - h) ** 2 + k  
+    y = a * (x - h) ** 2 + k
 
     return ti.Vector([x, y])
 
 @ti.kernel
-def compute_deformation_loss(t: ti.i32):
-    loss_val = 0.0
-    for i in range(n_springs):
-        a = spring_anchor_a[i]
-        b = spring_anchor_b[i]
-        pos_a = x[t, a] + rotation_matrix(rotation[t, a]) @ spring_offset_a[i]
-        pos_b = x[t, b] + rotation_matrix(rotation[t, b]) @ spring_offset_b[i]
-        current_length = (pos_a - pos_b).norm()
-        loss_val += (current_length - spring_length[i]) ** 2
-    if shape == "wheel":
-        deformation_loss_field[None] =((loss_val - (n_objects-1))*100)
-    else:
-        deformation_loss_field[None] =((loss_val - (n_objects-1))*1)
+def compute_deformation_loss(f: ti.template(), t: ti.i32, shape: ti.template()):
+    for b in range(f.n_batch):
+        f.deformation_loss[b] = 0.0
+    for b, i in ti.ndrange(f.n_batch, f.n_springs):
+        r = row(f, t)
+        if f.spring_mask[b, i] > 0:
+            a = f.spring_anchor_a[b, i]
+            c = f.spring_anchor_b[b, i]
+            pos_a = f.x[b, r, a] + rotation_matrix(f.rotation[b, r, a]) @ f.spring_offset_a[b, i]
+            pos_b = f.x[b, r, c] + rotation_matrix(f.rotation[b, r, c]) @ f.spring_offset_b[b, i]
+            current_length = (pos_a - pos_b).norm()
+            f.deformation_loss[b] += (current_length - f.spring_length[b, i]) ** 2
+    for b in range(f.n_batch):
+        loss_val = f.deformation_loss[b]
+        if ti.static(shape == "wheel"):
+            f.deformation_loss[b] =((loss_val - (f.object_count[b]-1))*100)
+        else:
+            f.deformation_loss[b] =((loss_val - (f.object_count[b]-1))*1)
 
 
 # path = "cos" # Options cos, sin, parabola.
@@ -364,244 +857,690 @@ def compute_deformation_loss(t: ti.i32):
 
 # ** Adjust weights.
 @ti.kernel
-def compute_loss(t: ti.i32, total_steps: ti.i32):
-    dist_w = 10
-    dev_w = 30
-    def_w = 1
-    
-    distance_loss = (x[t, head_id] - goal[None]).norm() * dist_w # Move right.
+def compute_loss(f: ti.template(), t: ti.i32, total_steps: ti.i32,
+                 shape: ti.template(), path: ti.template()):
+    for b in range(f.n_batch):
+        r = row(f, t)
+        dist_w = 10
+        dev_w = 30
+        def_w = 1
+        head_id = f.head_id[b]
+
+        distance_loss = (f.x[b, r, head_id] - f.goal[None]).norm() * dist_w # Move right.
+
+        desired_pos = gen_sine_path(t, total_steps)
+        # Follow a specified path.
+        if ti.static(path == "cos"):
+            desired_pos = gen_cos_path(t, total_steps)
+        if ti.static(path == "sin"):
+            desired_pos = gen_abs_sine_path(t, total_steps)
+        if ti.static(path == "para"):
+            desired_pos = gen_parabola_path(t, total_steps)
+
+        if ti.static(shape == "circle"):
+            dev_w = 1
+        deviation_loss = (f.x[b, r, head_id] - desired_pos).norm() * dev_w # ** Adjust as needed.
+
+        deformation = f.deformation_loss[b] * def_w
+
+        f.loss_components[b] = ti.Vector([distance_loss, deviation_loss,
+                                          deformation])
+        f.losses[b] = distance_loss + deviation_loss + deformation
+        f.loss[None] += distance_loss + deviation_loss + deformation
 
-    desired_pos = gen_sine_path(t, total_steps)
-    # Follow a specified path.
-    if path == "cos":
-        desired_pos = gen_cos_path(t, total_steps)
-    if path == "sin":
-        desired_pos = gen_abs_sine_path(t, total_steps)
-    if path == "para":
-        desired_pos = gen_parabola_path(t, total_steps)
 
-    if shape == "circle":
-        dev_w = 1
-    deviation_loss = (x[t, head_id] - desired_pos).norm() * dev_w # ** Adjust as needed.
+@ti.kernel
+def load_initial_state(f: ti.template(), x0: ti.types.ndarray(),
+                       rotation0: ti.types.ndarray()):
+    for b, i in ti.ndrange(f.n_batch, f.n_objects):
+        f.x[b, 0, i] = [x0[b, i, 0], x0[b, i, 1]]
+        f.rotation[b, 0, i] = rotation0[b, i]
+        f.v[b, 0, i] = [0.0, 0.0]
+        f.omega[b, 0, i] = 0.0
+        f.checkpoint_x[b, 0, i] = f.x[b, 0, i]
+        f.checkpoint_v[b, 0, i] = f.v[b, 0, i]
+        f.checkpoint_rotation[b, 0, i] = f.rotation[b, 0, i]
+        f.checkpoint_omega[b, 0, i] = f.omega[b, 0, i]
 
-    deformation = deformation_loss_field[None] * def_w
 
-    print(f'Distance Loss: {distance_loss}, Deviation Loss: {deviation_loss}, Deformation Loss: {deformation}')
-    
-    loss[None] = distance_loss + deviation_loss + deformation
+@ti.kernel
+def clear_states(f: ti.template(), n_steps: ti.i32):
+    for b, t, i in ti.ndrange(f.n_batch, n_steps, f.n_objects):
+        f.v_inc[b, t, i] = ti.Vector([0.0, 0.0])
+        f.x_inc[b, t, i] = ti.Vector([0.0, 0.0])
+        f.rotation_inc[b, t, i] = 0.0
+        f.omega_inc[b, t, i] = 0.0
 
 
-gui = ti.GUI('Rigid Body Simulation', (512, 512), background_color=0xFFFFFF)
+@ti.kernel
+def clear_step(f: ti.template(), t: ti.i32):
+    # Impulses of timestep t, whose row of the ring buffer is being reused.
+    for b, i in ti.ndrange(f.n_batch, f.n_objects):
+        r = row(f, t)
+        f.v_inc[b, r, i] = ti.Vector([0.0, 0.0])
+        f.x_inc[b, r, i] = ti.Vector([0.0, 0.0])
+        f.rotation_inc[b, r, i] = 0.0
+        f.omega_inc[b, r, i] = 0.0
 
 
-def forward(output=None, visualize=True):
+@ti.kernel
+def save_checkpoint(f: ti.template(), slot: ti.i32, t: ti.i32):
+    for b, i in ti.ndrange(f.n_batch, f.n_objects):
+        r = row(f, t)
+        f.checkpoint_x[b, slot, i] = f.x[b, r, i]
+        f.checkpoint_v[b, slot, i] = f.v[b, r, i]
+        f.checkpoint_rotation[b, slot, i] = f.rotation[b, r, i]
+        f.checkpoint_omega[b, slot, i] = f.omega[b, r, i]
 
-    initialize_properties()
 
-    interval = vis_interval
-    total_steps = steps
-    if output:
-        print(output)
-        interval = output_vis_interval
-        os.makedirs('rigid_body/{}/'.format(output), exist_ok=True)
-        total_steps *= 2
+@ti.kernel
+def load_checkpoint(f: ti.template(), slot: ti.i32, t: ti.i32):
+    for b, i in ti.ndrange(f.n_batch, f.n_objects):
+        r = row(f, t)
+        f.x[b, r, i] = f.checkpoint_x[b, slot, i]
+        f.v[b, r, i] = f.checkpoint_v[b, slot, i]
+        f.rotation[b, r, i] = f.checkpoint_rotation[b, slot, i]
+        f.omega[b, r, i] = f.checkpoint_omega[b, slot, i]
 
-    goal[None] = [0.9, 0.5]
 
-    for t in range(1, total_steps):
-        nn1(t - 1)
-        nn2(t - 1)
-        collide(t - 1)
-        apply_spring_force(t - 1)
-        if use_toi:
-            advance_toi(t)
+@ti.kernel
+def clear_segment_grads(f: ti.template(), t_end: ti.i32):
+    # Zero the gradients of every row except the state at the end of the
+    # segment, which holds the gradient flowing in from the next segment.
+    for b, r, i in ti.ndrange(f.n_batch, f.n_steps, f.n_objects):
+        f.v_inc.grad[b, r, i] = ti.Vector([0.0, 0.0])
+        f.x_inc.grad[b, r, i] = ti.Vector([0.0, 0.0])
+        f.rotation_inc.grad[b, r, i] = 0.0
+        f.omega_inc.grad[b, r, i] = 0.0
+        if r != row(f, t_end):
+            f.x.grad[b, r, i] = ti.Vector([0.0, 0.0])
+            f.v.grad[b, r, i] = ti.Vector([0.0, 0.0])
+            f.rotation.grad[b, r, i] = 0.0
+            f.omega.grad[b, r, i] = 0.0
+    for b, r, i in ti.ndrange(f.n_batch, f.n_steps, n_hidden):
+        f.hidden.grad[b, r, i] = 0.0
+    for b, r, i in ti.ndrange(f.n_batch, f.n_steps, f.n_springs):
+        f.actuation.grad[b, r, i] = 0.0
+        for k in ti.static(range(2)):
+            f.spring_delta_v.grad[b, r, i, k] = ti.Vector([0.0, 0.0])
+            f.spring_delta_omega.grad[b, r, i, k] = 0.0
+
+
+# Created on first use, offscreen if there is no display.
+gui = LazyGUI('Rigid Body Simulation', (512, 512), background_color=0xFFFFFF)
+
+
+def draw_frame(canvas, frame):
+    """
+    Draw a frame from RigidBodySim.frames() on a ti.GUI or OffscreenCanvas.
+    """
+    for points in frame['corners']:
+        for k in range(4):
+            canvas.line(points[k], points[(k + 1) % 4], color=0x0, radius=2)
+
+    for (pt1, pt2), color, joint in zip(frame['springs'], frame['colors'],
+                                        frame['joints']):
+        if joint:
+            canvas.line(pt1, pt2, color=0x000000, radius=9)
+            canvas.line(pt1, pt2, color=int(color), radius=7)
+        else:
+            canvas.line(pt1, pt2, color=0x000000, radius=7)
+            canvas.line(pt1, pt2, color=int(color), radius=5)
+
+    canvas.line((0.05, ground_height - 5e-3),
+                (0.95, ground_height - 5e-3),
+                color=0x0,
+                radius=5)
+
+
+def render_frame(frame):
+    """
+    Rasterize a frame offscreen. Writes it to frame['file'] if set, otherwise
+    returns the image. Runs in the FrameWriter workers of forward().
+    """
+    canvas = OffscreenCanvas(res=gui.res, background_color=gui.background_color)
+    draw_frame(canvas, frame)
+    if frame['file']:
+        canvas.show(file=frame['file'])
+        return None
+    return canvas.img
+
+
+class RigidBodySim:
+    """
+    Differentiable rigid-body simulation and controller training for a
+    population of robots that are simulated in lockstep, one kernel launch per
+    stage and timestep for the whole population. setup_robots() reuses the
+    current RobotFields (and therefore the compiled kernels) when the padded
+    population has the same size, and otherwise destroys them and allocates
+    fields of the new size.
+
+    Parameters:
+        shape (str): Shape of the robots, "wheel" or "circle". Selects the
+            deformation and deviation loss weights.
+        path (str): Desired path, "cos", "sin" or "para".
+        rollout (bool): Size the time axis for output rollouts
+            (forward(output=...)), which simulate 2 * steps timesteps.
+            Otherwise only the steps timesteps of training are allocated.
+        segment_length (int): If set, simulate with gradient checkpointing:
+            only the state at every segment_length-th timestep is kept, the
+            time axis is a ring buffer of segment_length + 1 timesteps, and
+            the backward pass recomputes every segment from its checkpoint.
+            Memory grows with steps / segment_length + segment_length
+            instead of steps, at the cost of a second forward pass;
+            segment_length close to sqrt(steps) minimizes it.
+        fused (bool): Simulate every timestep with a single fused_step()
+            launch (and its gradient with one launch of fused_step.grad)
+            instead of one launch per stage. The populations are small, so
+            this mostly saves kernel launch overhead.
+        gather (bool): Store the impulse of every spring end, and let every
+            object sum those of its springs through the CSR incidence built
+            by setup_robots(), instead of scattering them into the objects
+            with atomic adds. The gradients then flow through plain reads
+            instead of atomics on objects shared by many springs.
+        sparse_contacts (bool): Before collision, compact the box corners
+            that reach the ground during the step into a list with
+            find_contacts(), and only resolve those, instead of all corners
+            of all objects. The results are the same. Has no effect with
+            fused, whose single launch checks every corner.
+        box_collisions (bool): Also collide the boxes of every robot with
+            each other (except those connected by a spring or joint), with a
+            spatial hash of the box centers rebuilt every timestep as broad
+            phase, so the cost grows linearly with the number of boxes.
+            Robots of a population are independent simulations and never
+            collide with each other. In the wheels and circles of
+            build_robot_skeleton(), springs connect every box to its
+            neighbors, so only boxes two or more apart along the rim (e.g. of
+            a squashed wheel) can collide. Not supported with fused.
+    """
+
+    def __init__(self, shape="wheel", path="sin", rollout=False,
+                 segment_length=None, fused=False, gather=False,
+                 sparse_contacts=False, box_collisions=False):
+        self.shape = shape
+        self.path = path
+        self.segment_length = segment_length
+        self.fused = fused
+        self.gather = gather
+        self.sparse_contacts = sparse_contacts
+        self.box_collisions = box_collisions
+        if fused and box_collisions:
+            raise ValueError('box_collisions is not supported by the fused '
+                             'step kernel')
+        self.n_basis_steps = n_time_steps(rollout)
+        if segment_length:
+            self.n_steps = segment_length + 1
+            self.n_checkpoints = self.n_segments(n_time_steps(rollout)) + 1
+        else:
+            self.n_steps = n_time_steps(rollout)
+            self.n_checkpoints = 1
+        self.fields = None
+        # RobotFields allocated by preallocate(), by (n_batch, n_objects,
+        # n_springs). They are kept alive when other robots are set up.
+        self.preallocated = {}
+        self.use_toi = False
+
+    @property
+    def n_batch(self):
+        return self.fields.n_batch
+
+    def setup_robot(self, objects, springs, h_id):
+        self.setup_robots([(objects, springs, h_id)])
+
+    def setup_robots(self, robots, n_objects=None, n_springs=None):
+        """
+        Load a population of skeletons, one (objects, springs, head_id) tuple
+        per robot as returned by build_robot_skeleton(). Robots are padded to
+        n_objects objects and n_springs springs, which default to the largest
+        robot; passing fixed sizes lets populations of varying robots reuse
+        the same fields and kernels.
+        """
+        n_batch = len(robots)
+        n_objects = max([n_objects or 0] + [len(r[0]) for r in robots])
+        n_springs = max([n_springs or 0] + [len(r[1]) for r in robots])
+        size = (n_batch, n_objects, n_springs)
+        f = self.fields
+        if f is None or (f.n_batch, f.n_objects, f.n_springs) != size:
+            if f is not None and f not in self.preallocated.values():
+                f.destroy()
+            f = self.fields = (self.preallocated.get(size) or
+                               self.allocate(*size))
+
+        print('n_batch=', n_batch, '   n_objects=', n_objects,
+              '   n_springs=', n_springs)
+
+        self.object_counts = [len(r[0]) for r in robots]
+        self.spring_counts = [len(r[1]) for r in robots]
+
+        # Every field is filled from whole columns of the skeleton arrays and
+        # uploaded once, padded robots included.
+        objects = [r[0] for r in robots]
+        springs = [r[1] for r in robots]
+        upload(f.head_id, [r[2] for r in robots])
+        upload(f.object_count, self.object_counts)
+
+        def columns(arrays, name, length):
+            return stack_padded([a[name] for a in arrays], length)
+
+        x0 = columns(objects, 'x', n_objects).astype(np.float32)
+        rotation0 = columns(objects, 'rotation', n_objects).astype(np.float32)
+        halfsize = columns(objects, 'halfsize', n_objects)
+        anchor_a = columns(springs, 'anchor_a', n_springs)
+        anchor_b = columns(springs, 'anchor_b', n_springs)
+        actuation = columns(springs, 'actuation', n_springs)
+        object_mask = np.arange(n_objects) < np.array(self.object_counts)[:, None]
+        spring_mask = np.arange(n_springs) < np.array(self.spring_counts)[:, None]
+
+        # Padded springs are attached to no object.
+        incidence = [spring_incidence(s['anchor_a'], s['anchor_b'], n_objects)
+                     for s in springs]
+
+        load_initial_state(f, x0, rotation0)
+        upload(f.halfsize, halfsize)
+        upload(f.object_mask, object_mask)
+        upload(f.spring_anchor_a, anchor_a)
+        upload(f.spring_anchor_b, anchor_b)
+        upload(f.spring_offset_a, columns(springs, 'offset_a', n_springs))
+        upload(f.spring_offset_b, columns(springs, 'offset_b', n_springs))
+        upload(f.spring_length, columns(springs, 'length', n_springs))
+        upload(f.spring_stiffness, columns(springs, 'stiffness', n_springs))
+        upload(f.spring_actuation,
+               np.where(actuation != 0, actuation, default_actuation) * spring_mask)
+        upload(f.spring_mask, spring_mask)
+        upload(f.incidence_offset, np.stack([offsets for offsets, _ in incidence]))
+        upload(f.incidence, stack_padded([ends for _, ends in incidence], 2 * n_springs))
+        # Boxes closer than the largest diameter are in adjacent cells.
+        f.cell_size[None] = 2 * np.linalg.norm(halfsize, axis=-1).max()
+        self.init_sin_basis()
+
+    def allocate(self, n_batch, n_objects, n_springs):
+        # About four buckets per box keep hash collisions rare.
+        n_buckets = 4 * n_objects if self.box_collisions else 1
+        return RobotFields(n_objects, n_springs, self.n_steps, n_batch,
+                           self.n_checkpoints, self.n_basis_steps, n_buckets)
+
+    def preallocate(self, sizes):
+        """
+        Allocate RobotFields for every (n_batch, n_objects, n_springs) in
+        sizes, in order, and keep them for the populations of that size.
+        Taichi's offline cache keys kernels by the ids of the fields they
+        access, which depend on the order fields are allocated in; processes
+        that preallocate the same sizes share cached kernels no matter in
+        which order they simulate robots.
+        """
+        for size in sizes:
+            if size not in self.preallocated:
+                self.preallocated[size] = self.allocate(*size)
+
+    def init_sin_basis(self):
+        """
+        Reset the sine-wave inputs of every robot to spring_omega, with
+        phases evenly spread over a period, and precompute their values.
+        """
+        f = self.fields
+        f.sin_omega.fill(spring_omega)
+        phase = 2 * math.pi / n_sin_waves * np.arange(n_sin_waves)
+        f.sin_phase.from_numpy(
+            np.tile(phase, (f.n_batch, 1)).astype(np.float32))
+        compute_sin_basis(f)
+
+    def clear_states(self):
+        f = self.fields
+        clear_states(f, f.touched_steps)
+        f.touched_steps = 0
+
+    def forward(self, output=None, visualize=True):
+        """
+        Simulate the population. Visualization shows the first robot.
+        """
+        f = self.fields
+
+        initialize_properties(f)
+
+        interval = vis_interval
+        total_steps = n_time_steps(output)
+        if self.segment_length:
+            assert self.n_segments(total_steps) < f.n_checkpoints, \
+                'Output rollouts need a RigidBodySim created with rollout=True.'
         else:
-            advance_no_toi(t)
-
-        if (t + 1) % interval == 0 and visualize:
-
-            for i in range(n_objects):
-                points = []
-                for k in range(4):
-                    offset_scale = [[-1, -1], [1, -1], [1, 1], [-1, 1]][k]
-                    rot = rotation[t, i]
-                    rot_matrix = np.array([[math.cos(rot), -math.sin(rot)],
-                                           [math.sin(rot),
-                                            math.cos(rot)]])
-
-                    pos = np.array([x[t, i][0], x[t, i][1]
-                                    ]) + offset_scale * rot_matrix @ np.array(
-                                        [halfsize[i][0], halfsize[i][1]])
-
-                    points.append((pos[0], pos[1]))
-
-                for k in range(4):
-                    gui.line(points[k],
-                             points[(k + 1) % 4],
-                             color=0x0,
-                             radius=2)
-
-            for i in range(n_springs):
-
-                def get_world_loc(i, offset):
-                    rot = rotation[t, i]
-                    rot_matrix = np.array([[math.cos(rot), -math.sin(rot)],
-                                           [math.sin(rot),
-                                            math.cos(rot)]])
-                    pos = np.array([[x[t, i][0]], [
-                        x[t, i][1]
-                    ]]) + rot_matrix @ np.array([[offset[0]], [offset[1]]])
-                    return pos
-
-                pt1 = get_world_loc(spring_anchor_a[i], spring_offset_a[i])
-                pt2 = get_world_loc(spring_anchor_b[i], spring_offset_b[i])
-
-                color = 0xFF2233
-
-                if spring_actuation[i] != 0 and spring_length[i] != -1:
-                    a = actuation[t - 1, i] * 0.5
-                    color = ti.rgb_to_hex((0.5 + a, 0.5 - abs(a), 0.5 - a))
-
-                if spring_length[i] == -1:
-                    gui.line(pt1, pt2, color=0x000000, radius=9)
-                    gui.line(pt1, pt2, color=color, radius=7)
+            assert total_steps <= f.n_steps, \
+                'Output rollouts need a RigidBodySim created with rollout=True.'
+        f.touched_steps = min(f.n_steps, max(f.touched_steps, total_steps))
+        writer = None
+        if output:
+            print(output)
+            interval = output_vis_interval
+            video = None
+            if output_video:
+                video = f'rigid_body/{output}.{output_video}'
+            else:
+                os.makedirs('rigid_body/{}/'.format(output), exist_ok=True)
+            if visualize:
+                writer = FrameWriter(render_frame, video, render_processes)
+
+        f.goal[None] = [0.9, 0.5]
+        if learn_sin_basis:
+            compute_sin_basis(f)
+
+        # Timesteps of output frames that are still in the time axis, which
+        # are rendered together once they have been simulated.
+        pending = []
+
+        def frame(t):
+            if (t + 1) % interval == 0 and visualize:
+                if writer:
+                    pending.append(t)
                 else:
-                    gui.line(pt1, pt2, color=0x000000, radius=7)
-                    gui.line(pt1, pt2, color=color, radius=5)
-
-            gui.line((0.05, ground_height - 5e-3),
-                     (0.95, ground_height - 5e-3),
-                     color=0x0,
-                     radius=5)
-
-            file = None
-            if output:
-                file = f'rigid_body/{output}/{t:04d}.png'
-            gui.show(file=file)
-
-    loss[None] = 0
-    compute_loss(steps - 1, total_steps)
-
+                    self.show(t)
+
+        def flush():
+            if pending:
+                # Frames of a video are returned instead of written.
+                writer.write(self.frames(pending,
+                                         None if output_video else output))
+                pending.clear()
+
+        def loss():
+            f.loss[None] = 0
+            compute_loss(f, steps - 1, total_steps, self.shape, self.path)
+
+        if self.segment_length:
+            for s in range(self.n_segments(total_steps)):
+                self.simulate_segment(s, total_steps, frame)
+                # The next segment overwrites the ring buffer, so the loss is
+                # computed as soon as the segment holding timestep steps - 1
+                # (which output rollouts simulate past) is done.
+                t_start, t_end = self.segment_bounds(s, total_steps)
+                if t_start < steps - 1 <= t_end:
+                    loss()
+                if writer:
+                    flush()
+        else:
+            for t in range(1, total_steps):
+                self.step(t)
+                frame(t)
+            loss()
+        if writer:
+            flush()
+            writer.close()
+
+    def step(self, t):
+        """
+        Advance the population from timestep t - 1 to t.
+        """
+        f = self.fields
+        if self.fused:
+            fused_step(f, t, self.use_toi, self.gather)
+            return
+        nn1(f, t - 1)
+        nn2(f, t - 1)
+        if self.sparse_contacts:
+            find_contacts(f, t - 1)
+            collide_contacts(f, t - 1, self.contact_count(t - 1))
+        else:
+            collide(f, t - 1)
+        if self.box_collisions:
+            build_box_grid(f, t - 1)
+            collide_boxes(f, t - 1)
+        apply_spring_force(f, t - 1, self.gather)
+        if self.use_toi:
+            advance_toi(f, t, self.gather)
+        else:
+            advance_no_toi(f, t, self.gather)
+
+    def step_grad(self, t):
+        """
+        Backpropagate through step(t).
+        """
+        f = self.fields
+        if self.fused:
+            fused_step.grad(f, t, self.use_toi, self.gather)
+            return
+        if self.use_toi:
+            advance_toi.grad(f, t, self.gather)
+        else:
+            advance_no_toi.grad(f, t, self.gather)
+        apply_spring_force.grad(f, t - 1, self.gather)
+        if self.box_collisions:
+            collide_boxes.grad(f, t - 1)
+        if self.sparse_contacts:
+            collide_contacts.grad(f, t - 1, self.contact_count(t - 1))
+        else:
+            collide.grad(f, t - 1)
+        nn2.grad(f, t - 1)
+        nn1.grad(f, t - 1)
+
+    def contact_count(self, t):
+        """
+        Number of contacts find_contacts() listed for timestep t, read back
+        from the device.
+        """
+        f = self.fields
+        return int(f.n_contacts[t % f.n_steps])
+
+    def n_segments(self, total_steps):
+        return -(-(total_steps - 1) // self.segment_length)
+
+    def segment_bounds(self, s, total_steps):
+        t_start = s * self.segment_length
+        return t_start, min(t_start + self.segment_length, total_steps - 1)
+
+    @ti.ad.grad_replaced
+    def simulate_segment(self, s, total_steps, frame=None):
+        """
+        Simulate segment s of a checkpointed rollout, starting from checkpoint
+        s, and save its final state as checkpoint s + 1.
+        """
+        f = self.fields
+        t_start, t_end = self.segment_bounds(s, total_steps)
+        load_checkpoint(f, s, t_start)
+        for t in range(t_start + 1, t_end + 1):
+            clear_step(f, t)
+            self.step(t)
+            if frame:
+                frame(t)
+        save_checkpoint(f, s + 1, t_end)
+
+    @ti.ad.grad_for(simulate_segment)
+    def simulate_segment_grad(self, s, total_steps, frame=None):
+        # Recompute the trajectory of the segment from its checkpoint, then
+        # backpropagate through it step by step.
+        t_start, t_end = self.segment_bounds(s, total_steps)
+        self.simulate_segment(s, total_steps)
+        clear_segment_grads(self.fields, t_end)
+        for t in reversed(range(t_start + 1, t_end + 1)):
+            self.step_grad(t)
+
+    def frames(self, ts, output=None):
+        """
+        Geometry of the first robot at the timesteps ts, which must still be
+        in the time axis, as one dict per timestep for draw_frame(). Every
+        field is read back once and the box corners and spring endpoints of
+        all timesteps are computed together. If output is set, every frame
+        carries the path of its PNG file.
+        """
+        f = self.fields
+        n_objects = self.object_counts[0]
+        n_springs = self.spring_counts[0]
+        ts = np.asarray(ts)
+        rows = ts % f.n_steps
+        x = f.x.to_numpy()[0, rows, :n_objects]
+        rotation = f.rotation.to_numpy()[0, rows, :n_objects]
+        actuation = f.actuation.to_numpy()[0, (ts - 1) % f.n_steps, :n_springs]
+        halfsize = f.halfsize.to_numpy()[0, :n_objects]
+        anchors = np.stack([f.spring_anchor_a.to_numpy()[0, :n_springs],
+                            f.spring_anchor_b.to_numpy()[0, :n_springs]])
+        offsets = np.stack([f.spring_offset_a.to_numpy()[0, :n_springs],
+                            f.spring_offset_b.to_numpy()[0, :n_springs]])
+        length = f.spring_length.to_numpy()[0, :n_springs]
+        spring_actuation = f.spring_actuation.to_numpy()[0, :n_springs]
+
+        cos, sin = np.cos(rotation), np.sin(rotation)
+        # [T, n_objects, 2, 2]
+        rot_matrix = np.stack([np.stack([cos, -sin], -1),
+                               np.stack([sin, cos], -1)], -2)
+        offset_scale = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]])
+        # [T, n_objects, 4, 2]
+        corners = x[:, :, None] + np.einsum('toij,okj->toki', rot_matrix,
+                                            offset_scale * halfsize[:, None])
+        # [T, n_springs, 2, 2]: both ends of every spring.
+        ends = x[:, anchors] + np.einsum('tesij,esj->tesi',
+                                         rot_matrix[:, anchors], offsets)
+        ends = ends.transpose(0, 2, 1, 3)
+
+        joints = length == -1
+        a = actuation * 0.5
+        rgb = np.clip((np.stack([0.5 + a, 0.5 - np.abs(a), 0.5 - a], -1) *
+                       255).astype(np.int32), 0, 255)
+        colors = (rgb[..., 0] << 16) + (rgb[..., 1] << 8) + rgb[..., 2]
+        actuated = (spring_actuation != 0) & ~joints
+        colors = np.where(actuated, colors, 0xFF2233)
+
+        return [{
+            'corners': corners[k],
+            'springs': ends[k],
+            'colors': colors[k],
+            'joints': joints,
+            'file': f'rigid_body/{output}/{t:04d}.png' if output else None,
+        } for k, t in enumerate(ts.tolist())]
+
+    def show(self, t, output=None):
+        """
+        Draw the first robot at timestep t, and save the frame if output is
+        set.
+        """
+        frame, = self.frames([t], output)
+        draw_frame(gui, frame)
+        gui.show(file=frame['file'])
+
+    def get_parameters(self):
+        """
+        Trained parameters of every robot, one dict of NumPy arrays (keyed by
+        parameter_names()) per robot, for set_parameters().
+        """
+        f = self.fields
+        values = {name: getattr(f, name).to_numpy() for name in parameter_names()}
+        return [{name: values[name][b] for name in values}
+                for b in range(f.n_batch)]
+
+    def set_parameters(self, parameters):
+        """
+        Load parameters from get_parameters(), one dict per robot. The robots
+        must have been set up with the same padded sizes.
+        """
+        f = self.fields
+        for name in parameter_names():
+            getattr(f, name).from_numpy(
+                np.stack([p[name] for p in parameters]).astype(np.float32))
+
+    def init_parameters(self, seeds=None):
+        """
+        Randomly initialize the controller weights and spring stiffnesses of
+        every robot, and zero the biases. Padded entries stay zero. If seeds
+        (one per robot) are given, every robot draws from the weights stream
+        of its seed (see seeding.py), so its initialization does not depend
+        on its batch or process; otherwise from fresh unseeded streams.
+        """
+        f = self.fields
+        weights1 = np.zeros(f.weights1.shape, dtype=np.float32)
+        weights2 = np.zeros(f.weights2.shape, dtype=np.float32)
+        stiffness = np.zeros(f.spring_stiffness.shape, dtype=np.float32)
+        for b in range(f.n_batch):
+            n_objects = self.object_counts[b]
+            n_springs = self.spring_counts[b]
+            n_inputs = n_input_states(n_objects)
+            rng = seeding.generator(None if seeds is None else seeds[b],
+                                    seeding.weights_stream)
+            w1 = normal_weights((n_hidden, n_inputs), n_hidden + n_inputs, 0.5, rng)
+            # Object inputs are laid out for the padded object count, the goal
+            # inputs come last.
+            weights1[b, :, :n_sin_waves + 6 * n_objects] = w1[:, :-2]
+            weights1[b, :, -2:] = w1[:, -2:]
+            # TODO: n_springs should be n_actuators
+            weights2[b, :n_springs] = normal_weights((n_springs, n_hidden),
+                                                     n_hidden + n_springs, 1, rng)
+            stiffness[b, :n_springs] = rng.standard_normal(n_springs) * 25 + 85
+        f.weights1.from_numpy(weights1)
+        f.weights2.from_numpy(weights2)
+        f.spring_stiffness.from_numpy(stiffness)
+        f.bias1.fill(0)
+        f.bias2.fill(0)
+        self.init_sin_basis()
+
+    def apply_gradients(self):
+        """
+        One clipped optimizer step (see optimizer_name), with the gradient
+        norm computed separately for every robot of the population.
+        """
+        total_norm_sqr = self.fields.optimizer.step()
+        print(total_norm_sqr)
 
-@ti.kernel
-def clear_states():
-    for t in range(0, max_steps):
-        for i in range(0, n_objects):
-            v_inc[t, i] = ti.Vector([0.0, 0.0])
-            x_inc[t, i] = ti.Vector([0.0, 0.0])
-            rotation_inc[t, i] = 0.0
-            omega_inc[t, i] = 0.0
-
-
-def setup_robot(objects, springs, h_id):
-    global head_id
-    head_id = h_id
-    global n_objects, n_springs
-    n_objects = len(objects)
-    n_springs = len(springs)
-    allocate_fields()
-
-    print('n_objects=', n_objects, '   n_springs=', n_springs)
-
-    for i in range(n_objects):
-        x[0, i] = objects[i][0]
-        halfsize[i] = objects[i][1]
-        rotation[0, i] = objects[i][2]
-
-    for i in range(n_springs):
-        s = springs[i]
-        spring_anchor_a[i] = s[0]
-        spring_anchor_b[i] = s[1]
-        spring_offset_a[i] = s[2]
-        spring_offset_b[i] = s[3]
-        spring_length[i] = s[4]
-        spring_stiffness[i] = s[5]
-        if s[6]:
-            spring_actuation[i] = s[6]
+    def optimize(self, iters, toi=True, visualize=True, seeds=None,
+                 callback=None, parameters=None, metrics=None):
+        """
+        Train the controllers and spring stiffnesses of all robots for iters
+        iterations and return one loss curve per robot. seeds are passed to
+        init_parameters(). callback(iter, losses) is called after every
+        iteration with the current loss of every robot, and
+        metrics(iter, components) every metrics_interval iterations with an
+        (n_batch, 3) array of loss components. If parameters (from
+        get_parameters()) are given, training resumes from them instead of
+        a random initialization; the deformation loss of the first iteration
+        is zero, as for a fresh start.
+        """
+        self.use_toi = toi
+        f = self.fields
+
+        if parameters is None:
+            self.init_parameters(seeds)
         else:
-            spring_actuation[i] = default_actuation
+            self.set_parameters(parameters)
+        f.optimizer.reset()
 
+        '''
+        if visualize:
+        self.clear_states()
+        self.forward('initial{}'.format(robot_id))
+        '''
 
-def optimize(toi=True, visualize=True):
-    global use_toi
-    use_toi = toi
-    
-    for i in range(n_hidden):
-        for j in range(n_input_states()):
-            weights1[i, j] = np.random.randn() * math.sqrt(
-                2 / (n_hidden + n_input_states())) * 0.5
+        losses = [[] for _ in range(f.n_batch)]
 
-    for i in range(n_springs):
-        for j in range(n_hidden):
-            # TODO: n_springs should be n_actuators
-            weights2[i, j] = np.random.randn() * math.sqrt(
-                2 / (n_hidden + n_springs)) * 1
-            
-    for i in range(n_springs):
-        spring_stiffness[i] = np.random.randn() * 25 + 85
-
-    '''
-    if visualize:
-    clear_states()
-    forward('initial{}'.format(robot_id))
-    '''
-
-    losses = []
-
-    for iter in range(iters):
-        print(f"Iteration {iter}/{iters}")  # Inside the loop
-
-        clear_states()
-        if iter != 0:
-            compute_deformation_loss(steps - 1)
-        else:
-            deformation_loss_field[None] = 0
+        for iter in range(iters):
+            print(f"Iteration {iter}/{iters}")  # Inside the loop
 
-        with ti.ad.Tape(loss):
-            forward(visualize=visualize)
+            self.clear_states()
+            if iter != 0:
+                if self.segment_length:
+                    # The ring buffer no longer holds the final state of the
+                    # previous iteration, but its last checkpoint does.
+                    load_checkpoint(f, self.n_segments(steps), steps - 1)
+                compute_deformation_loss(f, steps - 1, self.shape)
+            else:
+                f.deformation_loss.fill(0)
 
-        print('Iter=', iter, 'Loss=', loss[None]) # **
+            with ti.ad.Tape(f.loss):
+                self.forward(visualize=visualize)
 
-        total_norm_sqr = 0
-        for i in range(n_hidden):
-            for j in range(n_input_states()):
-                total_norm_sqr += weights1.grad[i, j]**2
-            total_norm_sqr += bias1.grad[i]**2
+            robot_losses = f.losses.to_numpy()
+            print('Iter=', iter, 'Loss=', robot_losses) # **
 
-        for i in range(n_springs):
-            for j in range(n_hidden):
-                total_norm_sqr += weights2.grad[i, j]**2
-            total_norm_sqr += bias2.grad[i]**2
-        
-        for i in range(n_springs):
-            total_norm_sqr += spring_stiffness.grad[i]**2 
+            self.apply_gradients()
 
-        print(total_norm_sqr)
+            for b in range(f.n_batch):
+                losses[b].append(float(robot_losses[b]))
 
-        gradient_clip = 0.2
-        scale = learning_rate * min(
-            1.0, gradient_clip / (total_norm_sqr**0.5 + 1e-4))
-        for i in range(n_hidden):
-            for j in range(n_input_states()):
-                weights1[i, j] -= scale * weights1.grad[i, j]
-            bias1[i] -= scale * bias1.grad[i]
-
-        for i in range(n_springs):
-            for j in range(n_hidden):
-                weights2[i, j] -= scale * weights2.grad[i, j]
-            bias2[i] -= scale * bias2.grad[i]
-        
-        for i in range(n_springs):
-            spring_stiffness[i] -= scale * spring_stiffness.grad[i] 
-        
-        losses.append(loss[None])
+            if callback is not None:
+                callback(iter, [float(l) for l in robot_losses])
+            if metrics is not None and (iter % metrics_interval == 0
+                                        or iter == iters - 1):
+                metrics(iter, f.loss_components.to_numpy())
 
-    return losses
+        return losses
 
 import matplotlib.pyplot as plt
 
 def plot_single(losses, num_boxes):
-    plt.plot(losses, label=f'num_boxes {num_boxes} {iters} iterations') 
+    plt.plot(losses, label=f'num_boxes {num_boxes} {iters} iterations')
     plt.xlabel('Iteration')
     plt.ylabel('Loss')
     plt.title('Loss over time for 100 iterations')
@@ -609,79 +1548,230 @@ def plot_single(losses, num_boxes):
     plt.show()
     plt.figtext(0.0, 0.0, f'Losses for {num_boxes} {shape} over {iters} iterations')
 
-import pickle
-import os
-
-robot_id = 0
-
-
-def save_results(robot_id, losses, directory='results', filename=f'{robot_id}_results.pkl'):
-    # Ensure the directory exists
-    os.makedirs(directory, exist_ok=True)
-    
-    # Construct the full file path
-    filepath = os.path.join(directory, filename)
-    
-    # Save the results to the file
-    with open(filepath, 'wb') as f:
-        pickle.dump({'robot_id': robot_id, 'losses': losses}, f)
-    print(f"Results saved to {filepath}")
-
-def load_results(directory='results', filename=f'{robot_id}_results.pkl'):
-    # Construct the full file path
-    filepath = os.path.join(directory, filename)
-    
-    # Load the results from the file
-    with open(filepath, 'rb') as f:
-        data = pickle.load(f)
-    
-    robot_id = data['robot_id']
-    losses = data['losses']
-    
-    return robot_id, losses
+def loss_frame(robot_id, iter, loss):
+    """
+    One line of the loss stream written by the para command: the loss of a
+    robot after an iteration, tagged so that it can be picked out of the
+    rest of the output.
+    """
+    return f'@loss {robot_id} {iter} {loss!r}'
+
+
+def parse_loss_frame(line):
+    """
+    (robot_id, iter, loss) of a line written by loss_frame(), or None for any
+    other output line.
+    """
+    fields = line.split()
+    if len(fields) != 4 or fields[0] != '@loss':
+        return None
+    return int(fields[1]), int(fields[2]), float(fields[3])
 
 from robot_config import build_robot_skeleton
 
+# Simulation reused by run_individual()/run_population() across calls within
+# one process.
+worker_sim = None
+
+
+def build_design(design, shape, rng=None):
+    """
+    Skeleton of a robot design: either a box count or a dict of keyword
+    arguments of build_robot_skeleton(). shape is used unless the design sets
+    its own. Random designs draw their parameters from rng.
+    """
+    if not isinstance(design, dict):
+        design = {'num_boxes': design}
+    return build_robot_skeleton(**{'shape': shape, **design}, rng=rng)
+
+
+def worker_simulation():
+    """
+    RigidBodySim of this process, shared by every run_population() call.
+    """
+    global worker_sim
+    if worker_sim is None:
+        worker_sim = RigidBodySim(segment_length=checkpoint_segment_length,
+                                  fused=fuse_step_kernels,
+                                  gather=gather_spring_impulses,
+                                  sparse_contacts=sparse_contacts,
+                                  box_collisions=box_collisions)
+    return worker_sim
+
+
+def population_shape(population, shape):
+    """
+    Shape shared by the robots of a population, see run_population().
+    """
+    shapes = {design.get('shape', shape) if isinstance(design, dict) else shape
+              for design in population}
+    assert len(shapes) == 1, 'Robots simulated together must share a shape'
+    return shapes.pop()
+
+
+def padded_size(population, shape, pad_boxes=None):
+    """
+    (n_batch, n_objects, n_springs) of the fields run_population() simulates
+    a population in.
+    """
+    shape = population_shape(population, shape)
+    designs = list(population) + ([pad_boxes] if pad_boxes is not None else [])
+    skeletons = [build_design(design, shape) for design in designs]
+    return (len(population), max(len(objects) for objects, _, _ in skeletons),
+            max(len(springs) for _, springs, _ in skeletons))
+
+
+def preallocate_populations(populations, shape, pad_boxes=None):
+    """
+    Allocate the fields of every population (a list of designs, see
+    run_population()) in this process up front, see
+    RigidBodySim.preallocate().
+    """
+    worker_simulation().preallocate(
+        [padded_size(population, shape, pad_boxes) for population in populations])
+
+
+def run_population(population, shape, path, iters, pad_boxes=None, seeds=None,
+                   callback=None, parameters=None, return_parameters=False,
+                   metrics=None):
+    """
+    Optimize a population of robots in lockstep inside the calling process.
+    Used by the persistent GA workers of main_opt.py: each worker keeps one
+    RigidBodySim, so Taichi is initialized once and kernels are only
+    recompiled when the padded population size changes.
+
+    Inputs:
+        population: List of robot designs, each a box count or a dict of
+            build_robot_skeleton() arguments. All robots must share a shape,
+            which selects the loss.
+        shape: "wheel" or "circle", unless the designs set their own.
+        path: Desired path, "cos", "sin" or "para".
+        iters: Number of optimization iterations.
+        pad_boxes: Pad every robot to the size of this design (e.g. the largest
+            box count), so that populations of different designs share
+            compiled kernels.
+        seeds: Optional list with one seed per robot, which its random design
+            parameters and initialization are derived from (see seeding.py).
+        callback: Optional callback(iter, losses) called after every iteration
+            with the current loss of every robot.
+        parameters: Optional list with the parameters of every robot (see
+            RigidBodySim.get_parameters()) to resume training from.
+        return_parameters: If True, also return the trained parameters.
+        metrics: Optional callback(iter, components) called with the sampled
+            loss components of every robot, see RigidBodySim.optimize().
+
+    Outputs:
+        losses: One list of losses during optimization per robot.
+        parameters: Trained parameters of every robot, if return_parameters.
+    """
+    shape = population_shape(population, shape)
+    worker_sim = worker_simulation()
+    worker_sim.shape = shape
+    worker_sim.path = path
+
+    n_objects = n_springs = None
+    if pad_boxes is not None:
+        objects, springs, _ = build_design(pad_boxes, shape)
+        n_objects, n_springs = len(objects), len(springs)
+
+    robots = [build_design(design, shape, seeding.generator(seed, seeding.design_stream))
+              for design, seed in zip(population, seeds or [None] * len(population))]
+    worker_sim.setup_robots(robots, n_objects=n_objects, n_springs=n_springs)
+    losses = worker_sim.optimize(iters, toi=True, visualize=False, seeds=seeds,
+                                 callback=callback, parameters=parameters,
+                                 metrics=metrics)
+    worker_sim.clear_states()
+    if return_parameters:
+        return losses, worker_sim.get_parameters()
+    return losses
+
+
+def run_individual(design, shape, path, iters, seed=None, callback=None,
+                   metrics=None):
+    """
+    Optimize a single robot design inside the calling process, see
+    run_population(). callback(iter, loss) is called after every iteration,
+    metrics(iter, components) with the sampled loss components.
+
+    Outputs:
+        losses: List of all losses during optimization.
+    """
+    seeds = None if seed is None else [seed]
+    population_callback = None
+    if callback is not None:
+        population_callback = lambda iter, losses: callback(iter, losses[0])
+    population_metrics = None
+    if metrics is not None:
+        population_metrics = lambda iter, components: metrics(iter,
+                                                              components[0])
+    return run_population([design], shape, path, iters, seeds=seeds,
+                          callback=population_callback,
+                          metrics=population_metrics)[0]
+
 def main():
-    
+
+    sim = RigidBodySim(shape=shape, path=path,
+                       rollout=cmd not in ('plot', 'para'),
+                       segment_length=checkpoint_segment_length,
+                       fused=fuse_step_kernels,
+                       gather=gather_spring_impulses,
+                       sparse_contacts=sparse_contacts,
+                       box_collisions=box_collisions)
     a, b, c = build_robot_skeleton(num_boxes=robot_id, shape=shape)
-    setup_robot(a, b, c)
+    sim.setup_robot(a, b, c)
+
+    # Sampled loss components of the trained robot.
+    metrics_log = MetricsLog(f'rigid_body/loss_components_{robot_id}.csv',
+                             ['iter'] + loss_component_names)
+
+    def metrics(iter, components):
+        metrics_log.write(iter=iter,
+                          **dict(zip(loss_component_names, components[0])))
 
     if cmd == 'plot':
         ret = {}
         for toi in [False, True]:
             ret[toi] = []
             for i in range(5):
-                losses = optimize(toi=toi, visualize=False)
+                # Both modes start from the same five initializations.
+                losses = sim.optimize(iters, toi=toi, visualize=False,
+                                      seeds=[seeding.derive_seed(seed, i)])[0]
                 # losses = gaussian_filter(losses, sigma=3)
                 ret[toi].append(losses)
-        clear_states()
-        #forward('final{}'.format(robot_id))
+        sim.clear_states()
+        #sim.forward('final{}'.format(robot_id))
         print(robot_id, losses)
 
         import pickle
         pickle.dump(ret, open('losses.pkl', 'wb'))
         print("Losses saved to losses.pkl")
     if cmd == 'single':
-        losses = optimize(toi=True, visualize=True)
+        losses = sim.optimize(iters, toi=True, visualize=True, seeds=[seed],
+                              metrics=metrics)[0]
         plot_single(losses, robot_id)
-        clear_states()
-        forward('final{}'.format(robot_id))
+        sim.clear_states()
+        sim.forward('final{}'.format(robot_id))
     elif cmd == 'para':
-        losses = optimize(toi=True, visualize=False)
-        save_results(robot_id, losses, directory='results', filename=filename)
-        clear_states()
-    else: 
-        losses = optimize(toi=True, visualize=True)
-        clear_states()
-        forward('final{}'.format(robot_id))
+        # Stream the losses to stdout as they are computed, one loss_frame()
+        # line per iteration.
+        sim.optimize(iters, toi=True, visualize=False, seeds=[seed],
+                     callback=lambda iter, losses: print(
+                         loss_frame(robot_id, iter, losses[0]), flush=True),
+                     metrics=metrics)
+        sim.clear_states()
+    else:
+        losses = sim.optimize(iters, toi=True, visualize=True, seeds=[seed],
+                              metrics=metrics)[0]
+        sim.clear_states()
+        sim.forward('final{}'.format(robot_id))
+    metrics_log.close()
 
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) != 7: 
+    if len(sys.argv) != 6:
         print(
-        "Usage: python3 rigid_body.py [num_boxes=0, 1, 2, ...] [cmd=single/para] [shape=wheel/circle] [iter=10, 20, ..., 100] [path=cos/sin/parabola] [filename=""]"
-        )   
+        "Usage: python3 rigid_body.py [num_boxes=0, 1, 2, ...] [cmd=single/para] [shape=wheel/circle] [iter=10, 20, ..., 100] [path=cos/sin/parabola]"
+        )
         exit(-1)
     else:
         robot_id = int(sys.argv[1])
@@ -689,6 +1779,5 @@ if __name__ == '__main__':
         shape = sys.argv[3]
         iters = int(sys.argv[4])
         path = sys.argv[5]
-        filename = sys.argv[6]
         print(sys.argv)
         main()
@@ -0,0 +1,47 @@
+import contextlib
+import io
+import sys
+import time
+
+import rigid_body
+from robot_config import build_robot_skeleton
+
+# Wall time per optimization iteration (forward and backward pass) of
+# rigid_body.py with one kernel launch per stage and timestep, and with the
+# fused per-timestep kernel, for populations of growing size. Then with
+# collision of every box corner, and of the compacted contact list only.
+#
+# Usage: python3 rigid_body_benchmark.py [num_boxes=6] [iters=5]
+
+n_boxes = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+iters = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+batch_sizes = [1, 4, 16]
+
+
+def benchmark(n_batch, **options):
+    sim = rigid_body.RigidBodySim(**options)
+    sim.setup_robots([build_robot_skeleton(num_boxes=n_boxes)] * n_batch)
+    with contextlib.redirect_stdout(io.StringIO()):
+        # The first iteration compiles the kernels.
+        sim.optimize(1, visualize=False, seeds=list(range(n_batch)))
+        t = time.perf_counter()
+        sim.optimize(iters, visualize=False, seeds=list(range(n_batch)))
+        elapsed = (time.perf_counter() - t) / iters
+    sim.fields.destroy()
+    return elapsed
+
+
+print(f'num_boxes = {n_boxes}, {rigid_body.steps} steps, {iters} iterations')
+print(f'{"batch":>6} {"per-stage (s/iter)":>20} {"fused (s/iter)":>16} '
+      f'{"speedup":>8}')
+for n_batch in batch_sizes:
+    staged = benchmark(n_batch)
+    fused = benchmark(n_batch, fused=True)
+    print(f'{n_batch:>6} {staged:>20.3f} {fused:>16.3f} {staged / fused:>7.2f}x')
+
+print(f'{"batch":>6} {"all corners (s/iter)":>20} {"contacts (s/iter)":>18} '
+      f'{"speedup":>8}')
+for n_batch in batch_sizes:
+    dense = benchmark(n_batch)
+    sparse = benchmark(n_batch, sparse_contacts=True)
+    print(f'{n_batch:>6} {dense:>20.3f} {sparse:>18.3f} {dense / sparse:>7.2f}x')
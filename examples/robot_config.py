@@ -1,20 +1,12 @@
+import functools
 import math
 
-objects = []
-springs = []
-
-
-def add_object(x, halfsize, rotation=0):
-    objects.append([x, halfsize, rotation])
-    return len(objects) - 1
-
-
-# actuation 0.0 will be translated into default actuation
-def add_spring(a, b, offset_a, offset_b, length, stiffness, actuation=0.0):
-    springs.append([a, b, offset_a, offset_b, length, stiffness, actuation])
-
+import numpy as np
 
 def robotA():
+    skeleton = SkeletonBuilder()
+    add_object = skeleton.add_object
+    add_spring = skeleton.add_spring
     add_object(x=[0.3, 0.25], halfsize=[0.15, 0.03])
     add_object(x=[0.2, 0.15], halfsize=[0.03, 0.02])
     add_object(x=[0.3, 0.15], halfsize=[0.03, 0.02])
@@ -32,10 +24,13 @@ def robotA():
     # -1 means the spring is a joint
     add_spring(0, 4, [0.1, 0], [0, -0.05], -1, s)
 
-    return objects, springs, 0
+    return (*skeleton.arrays(), 0)
 
 
 def robotC():
+    skeleton = SkeletonBuilder()
+    add_object = skeleton.add_object
+    add_spring = skeleton.add_spring
     add_object(x=[0.3, 0.25], halfsize=[0.15, 0.03])
     add_object(x=[0.2, 0.15], halfsize=[0.03, 0.02])
     add_object(x=[0.3, 0.15], halfsize=[0.03, 0.02])
@@ -50,7 +45,7 @@ def robotC():
     add_spring(0, 3, [0.03, 0.00], [0.0, 0.0], l, s)
     add_spring(0, 3, [0.1, 0.00], [0.0, 0.0], l, s)
 
-    return objects, springs, 3
+    return (*skeleton.arrays(), 3)
 
 
 l_thigh_init_ang = 10
@@ -79,6 +74,9 @@ half_hip_length = 0.08
 
 
 def robotLeg():
+    skeleton = SkeletonBuilder()
+    add_object = skeleton.add_object
+    add_spring = skeleton.add_spring
     #hip
     add_object(hip_pos, halfsize=[0.08, half_hip_length])
     hip_end = [hip_pos[0], hip_pos[1] - (0.08 - 0.01)]
@@ -168,10 +166,13 @@ def robotLeg():
     add_spring(7,8, [0, -0.09], [-0.05, 0.0], -1, s)
     add_spring(7,8, [0.0, 0.08], [0.05, 0.0], 0.20, 5, 0.08)
 
-    return objects, springs, 3
+    return (*skeleton.arrays(), 3)
 
 
 def robotB():
+    skeleton = SkeletonBuilder()
+    add_object = skeleton.add_object
+    add_spring = skeleton.add_spring
     body = add_object([0.15, 0.25], [0.1, 0.03])
     back = add_object([0.08, 0.22], [0.03, 0.10])
     front = add_object([0.22, 0.22], [0.03, 0.10])
@@ -193,7 +194,7 @@ def robotB():
     add_spring(body, back, [-0.08, 0.0], [0.0, 0.02], -1, stiffness)
     add_spring(body, front, [0.08, 0.0], [0.0, 0.05], -1, stiffness)
 
-    return objects, springs, body
+    return (*skeleton.arrays(), body)
 
 y_max = 1.0 
 y_min = 0.1
@@ -202,11 +203,50 @@ x_max = 0.5
 
 center = [0.25, 0.5]
 
-import random as rand
+# Skeletons built by SkeletonBuilder: one record per box and per spring (or
+# joint, with length -1).
+object_dtype = np.dtype([('x', np.float64, 2), ('halfsize', np.float64, 2),
+                         ('rotation', np.float64)])
+spring_dtype = np.dtype([('anchor_a', np.int32), ('anchor_b', np.int32),
+                         ('offset_a', np.float64, 2), ('offset_b', np.float64, 2),
+                         ('length', np.float64), ('stiffness', np.float64),
+                         ('actuation', np.float64)])
+# Number of distinct skeletons build_robot_skeleton() keeps.
+skeleton_cache_size = 1024
 
-def build_robot_skeleton(shape: str = "wheel", stiffness: int = 75, actuation: float = 0.115, rest_to_spring: float = 1, num_boxes: int = 6, radius: float = 0.15, random=False, spokes=False):
+
+class SkeletonBuilder:
+    """
+    Collects the boxes and springs of one skeleton, without global state, and emits them as read-only structured
+    arrays.
     """
-    Generate a rigid body skeleton based on the given user parameters.
+
+    def __init__(self):
+        self.objects = []
+        self.springs = []
+
+    def add_object(self, x, halfsize, rotation=0):
+        self.objects.append((x, halfsize, rotation))
+        return len(self.objects) - 1
+
+    # actuation 0.0 will be translated into default actuation
+    def add_spring(self, a, b, offset_a, offset_b, length, stiffness, actuation=0.0):
+        self.springs.append((a, b, offset_a, offset_b, length, stiffness, actuation))
+
+    def arrays(self):
+        objects = np.array(self.objects, dtype=object_dtype)
+        springs = np.array(self.springs, dtype=spring_dtype)
+        # They are shared by every caller of the cache.
+        objects.flags.writeable = False
+        springs.flags.writeable = False
+        return objects, springs
+
+
+def build_robot_skeleton(shape: str = "wheel", stiffness: int = 75, actuation: float = 0.115, rest_to_spring: float = 1, num_boxes: int = 6, radius: float = 0.15, random=False, spokes=False,
+                         rng=None):
+    """
+    Generate a rigid body skeleton based on the given user parameters. Skeletons are memoized by their
+    parameters (see skeleton_cache_size), so the same design is only built once per process.
     
     Parameters:
         shape (str): Shape of the robot skeleton. Can be "circle" or "wheel".
@@ -217,18 +257,22 @@ def build_robot_skeleton(shape: str = "wheel", stiffness: int = 75, actuation: f
         radius (float): Radius of underlying circle.
         random (bool): If True, randomize the parameters.
         spokes (bool): If True, add spokes to the wheel shape. Not very interesting.
+        rng (np.random.Generator): Stream the random parameters are drawn from, e.g. a
+            seeding.generator(). If None, a fresh unseeded one.
+
+    Returns:
+        objects, springs: Read-only arrays of object_dtype and spring_dtype.
+        head_id: Index of the head object.
     """
-    global objects, springs
-    objects = []
-    springs = []
     # Randomize the parameters.
     if random:
-        shape = rand.choice(["circle", "wheel"])
-        stiffness = rand.randint(50, 100)
-        actuation = rand.uniform(0.05, 0.35)
-        rest_to_spring = rand.uniform(0.75, 1.25)
-        num_boxes = rand.randint(3, 8)
-        radius = rand.uniform(0.1, 0.20)
+        rng = np.random.default_rng(rng)
+        shape = str(rng.choice(["circle", "wheel"]))
+        stiffness = int(rng.integers(50, 100, endpoint=True))
+        actuation = float(rng.uniform(0.05, 0.35))
+        rest_to_spring = float(rng.uniform(0.75, 1.25))
+        num_boxes = int(rng.integers(3, 8, endpoint=True))
+        radius = float(rng.uniform(0.1, 0.20))
 
     # print("PARAMETERS:")
     # print("shape: ", shape)
@@ -238,6 +282,17 @@ def build_robot_skeleton(shape: str = "wheel", stiffness: int = 75, actuation: f
     # print("num_boxes: ", num_boxes)
     # print("radius: ", radius)
 
+    return build_skeleton(shape, stiffness, actuation, rest_to_spring, num_boxes, radius, bool(spokes))
+
+@functools.lru_cache(maxsize=skeleton_cache_size)
+def build_skeleton(shape, stiffness, actuation, rest_to_spring, num_boxes, radius, spokes):
+    """
+    Memoized body of build_robot_skeleton(), keyed by its positional parameters.
+    """
+    skeleton = SkeletonBuilder()
+    add_object = skeleton.add_object
+    add_spring = skeleton.add_spring
+
     # Angle between each box.
     if shape == "circle":
         angle_size = 2 * math.pi / num_boxes
@@ -314,13 +369,16 @@ def build_robot_skeleton(shape: str = "wheel", stiffness: int = 75, actuation: f
             add_spring(i+1, i+2, [0, halfsize[1]], [0, halfsize[1]], rest_to_spring*rest_length, 10, actuation)
             add_spring(i+1, i+2, [0, halfsize[1]], [0, -halfsize[1]], -1, stiffness, 0)
 
-    return objects, springs, 0
+    return (*skeleton.arrays(), 0)
 
 def test_robot():
     return build_robot_skeleton(shape="wheel", num_boxes=9)
     #return build_robot_skeleton(shape="circle", stiffness=80, actuation=0.04, rest_to_spring=1.03, num_boxes=8, radius=0.12)
 
 def robotC():
+    skeleton = SkeletonBuilder()
+    add_object = skeleton.add_object
+    add_spring = skeleton.add_spring
     body = add_object([0.15, 0.16], [0.05, 0.05])
     back = add_object([0.35, 0.16], [0.05, 0.05])
 
@@ -336,7 +394,7 @@ def robotC():
     # add_spring(body, back, [0.0, 0.0], [0.0, 0.0], -1, stiffness)
     # add_spring(body, front, [0.0, 0.0], [0.0, 0.0], -1, stiffness)
 
-    return objects, springs, body
+    return (*skeleton.arrays(), body)
 
 
 
@@ -0,0 +1,41 @@
+import numpy as np
+
+# Keys of the independent streams derived from a seed, see generator().
+# Streams of the root seed of a GA run (main_opt.seed):
+# the initial population, then (ga_stream, generation) for its offspring,
+ga_stream = 0
+# (restart_stream, generation, individual, restart): seed of a training run,
+restart_stream = 1
+# (cache_stream, generation, individual): seeds picked from the fitness cache.
+cache_stream = 2
+# Streams of the seed of a training run (see rigid_body.run_population()):
+# the parameters of build_robot_skeleton(random=True),
+design_stream = 0
+# the initial controller weights and spring stiffnesses.
+weights_stream = 1
+
+
+def root_seed(seed=None):
+    """
+    seed, or fresh entropy from the OS if it is None. Print or save it, so
+    that the run can be repeated.
+    """
+    return np.random.SeedSequence(seed).entropy
+
+
+def generator(seed, *key):
+    """
+    np.random.Generator of the stream key of seed. Streams of different keys
+    are independent, and a stream only depends on seed and its key, not on
+    the process that draws from it or on the order streams are created in.
+    A seed of None draws fresh entropy.
+    """
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=key))
+
+
+def derive_seed(seed, *key):
+    """
+    Integer seed of the stream key of seed, for seeds that are sent to worker
+    processes or used as cache keys.
+    """
+    return int(np.random.SeedSequence(seed, spawn_key=key).generate_state(1)[0])
@@ -0,0 +1,50 @@
+import math
+import numpy as np
+import pytest
+import taichi as ti
+
+from optimizers import optimizers
+
+ti.init(arch=ti.cpu)
+
+
+def make_params(batched):
+    weights = ti.field(ti.f32, shape=(2, 3), needs_grad=True)
+    offsets = ti.Vector.field(2, ti.f32, shape=(2,), needs_grad=True)
+    params = [weights, offsets]
+    weights.grad.fill(1.0)
+    offsets.grad.fill(2.0)
+    if not batched:
+        scale = ti.field(ti.f32, shape=(), needs_grad=True)
+        scale.grad[None] = 3.0
+        params.append(scale)
+    return params
+
+
+@pytest.mark.parametrize('name', list(optimizers))
+@pytest.mark.parametrize('batched', [False, True])
+@pytest.mark.parametrize('own_norm', [False, True])
+def test_step(name, batched, own_norm):
+    params = make_params(batched)
+    norm_sqr = None
+    if not own_norm:
+        norm_sqr = ti.field(ti.f64, shape=2 if batched else 1)
+    optimizer = optimizers[name](params, norm_sqr, learning_rate=0.1,
+                                 batched=batched)
+    for _ in range(3):
+        norms = optimizer.step()
+    # Per model, 3 weights of gradient 1 and a vector of gradient (2, 2).
+    # Unbatched, one model has all 6 weights, both vectors and the scalar of
+    # gradient 3.
+    expected = [11.0, 11.0] if batched else [31.0]
+    np.testing.assert_allclose(norms, expected)
+    weights = params[0].to_numpy()
+    assert (weights < 0).all()
+    if name == 'sgd':
+        step = 0.1 * 0.2 / (math.sqrt(expected[0]) + 1e-4)
+        np.testing.assert_allclose(weights, -3 * step, rtol=1e-5)
+    elif name == 'adam':
+        # Every parameter moves by about the learning rate per step.
+        np.testing.assert_allclose(weights, -0.3, rtol=1e-3)
+    optimizer.reset()
+    optimizer.destroy()
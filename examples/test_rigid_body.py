@@ -0,0 +1,109 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+import taichi as ti
+
+import rigid_body
+from robot_config import SkeletonBuilder, build_robot_skeleton
+
+# Short rollouts keep the kernels quick to compile and run.
+rigid_body.steps = 64
+
+gradient_names = ['weights1', 'weights2', 'spring_stiffness']
+
+
+def train_once(robots, **options):
+    """
+    Loss and gradients of one optimization iteration of robots, simulated
+    with the RigidBodySim options.
+    """
+    sim = rigid_body.RigidBodySim(**options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim.setup_robots(robots)
+        losses = sim.optimize(1, visualize=False,
+                              seeds=list(range(len(robots))))
+    f = sim.fields
+    grads = {name: getattr(f, name).grad.to_numpy() for name in gradient_names}
+    f.destroy()
+    return np.array(losses)[:, 0], grads
+
+
+def assert_same_training(robots, options, reference=None):
+    losses, grads = train_once(robots, **options)
+    reference_losses, reference_grads = train_once(robots, **(reference or {}))
+    np.testing.assert_allclose(losses, reference_losses, rtol=1e-5)
+    for name in gradient_names:
+        np.testing.assert_allclose(grads[name], reference_grads[name],
+                                   rtol=1e-3, atol=1e-6, err_msg=name)
+
+
+wheels = [build_robot_skeleton(num_boxes=6)] * 2
+
+
+@pytest.mark.parametrize('options', [
+    dict(sparse_contacts=True),
+    dict(segment_length=16),
+    dict(segment_length=16, sparse_contacts=True),
+    dict(segment_length=50, sparse_contacts=True),
+])
+def test_gradients_match_dense(options):
+    assert_same_training(wheels, options)
+
+
+def overlapping_boxes():
+    """
+    Three boxes in the air: the head overlaps box 1, which an actuated spring
+    connects to box 2. The head only moves through box collisions, which
+    push the overlapping boxes apart.
+    """
+    skeleton = SkeletonBuilder()
+    skeleton.add_object([0.3, 0.6], [0.04, 0.04], 0.1)
+    skeleton.add_object([0.36, 0.62], [0.04, 0.03], -0.2)
+    skeleton.add_object([0.5, 0.62], [0.03, 0.03])
+    skeleton.add_spring(1, 2, [0.0, 0.0], [0.0, 0.0], 0.14, 40.0, 0.2)
+    return (*skeleton.arrays(), 0)
+
+
+def box_loss(sim, name, index, delta=0.0, tape=False):
+    """
+    Loss of a rollout of sim with getattr(fields, name)[index] offset by
+    delta, and its gradient with respect to that parameter if tape.
+    """
+    f = sim.fields
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim.init_parameters([0])
+    getattr(f, name)[index] += delta
+    sim.clear_states()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if tape:
+            with ti.ad.Tape(f.loss):
+                sim.forward(visualize=False)
+        else:
+            sim.forward(visualize=False)
+    return f.loss[None], getattr(f, name).grad[index]
+
+
+def test_box_collision_gradients_match_finite_differences():
+    sims = {}
+    for box_collisions in [False, True]:
+        sims[box_collisions] = rigid_body.RigidBodySim(
+            box_collisions=box_collisions)
+        with contextlib.redirect_stdout(io.StringIO()):
+            sims[box_collisions].setup_robots([overlapping_boxes()])
+    sim = sims[True]
+    # The boxes touch: without collisions, the head would not move apart.
+    assert abs(box_loss(sim, 'bias1', (0, 0))[0] -
+               box_loss(sims[False], 'bias1', (0, 0))[0]) > 1.0
+    # Contacts only separate, so the loss is smooth and central differences
+    # apply.
+    for name, index, h in [('bias1', (0, 0), 0.05),
+                           ('spring_stiffness', (0, 0), 4.0),
+                           ('weights2', (0, 0, 0), 0.05)]:
+        grad = box_loss(sim, name, index, tape=True)[1]
+        difference = (box_loss(sim, name, index, h)[0] -
+                      box_loss(sim, name, index, -h)[0]) / (2 * h)
+        np.testing.assert_allclose(grad, difference, rtol=3e-2, err_msg=name)
+    for s in sims.values():
+        s.fields.destroy()
@@ -0,0 +1,182 @@
+import multiprocessing as mp
+from multiprocessing.connection import wait
+import os
+import time
+import traceback
+
+# Pipe to the parent process and id of the running job, set inside workers.
+_conn = None
+_job_id = None
+
+
+def report(payload):
+    """
+    Send payload (any picklable object) to the parent process as progress of
+    the running job, e.g. the loss of every iteration as it is computed. The
+    parent receives it through the on_progress callback of WorkerPool.map().
+    Does nothing outside of a worker process.
+    """
+    if _conn is not None:
+        _conn.send((_job_id, 'progress', payload))
+
+
+def available_cpus():
+    """
+    CPUs this process may run on.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def _worker_loop(target, job_queue, conn, n_threads=None, cpus=None,
+                 initializer=None, worker_id=0):
+    """
+    Body of a persistent worker process. Takes (job_id, args) jobs from the
+    shared queue until it receives None, and sends (job_id, kind, payload)
+    messages back over its own end of the pipe: any number of 'progress'
+    messages, followed by 'done' with (result, seconds spent on the job) or
+    'error' with a traceback.
+    """
+    global _conn, _job_id
+    _conn = conn
+    if n_threads is not None:
+        # Read by ti.init(), which runs when target first imports Taichi.
+        os.environ['TI_CPU_MAX_NUM_THREADS'] = str(n_threads)
+    if cpus is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    if initializer is not None:
+        initializer(worker_id)
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        _job_id, args = job
+        start = time.perf_counter()
+        try:
+            result = target(*args)
+        except Exception:
+            conn.send((_job_id, 'error', traceback.format_exc()))
+        else:
+            conn.send((_job_id, 'done', (result, time.perf_counter() - start)))
+    conn.close()
+
+
+class WorkerPool:
+    """
+    A fixed set of long-lived worker processes that call target(*args) for
+    every job. Unlike a fresh interpreter per individual, each worker keeps
+    whatever target caches in its process (e.g. an initialized Taichi runtime
+    and its compiled kernels) from one job to the next.
+
+    Parameters:
+        target: Top-level (picklable) function run inside the workers.
+        n_workers: Number of worker processes. Defaults to the number of
+            available CPUs divided by threads_per_worker.
+        threads_per_worker: Maximum number of Taichi CPU threads per worker
+            (TI_CPU_MAX_NUM_THREADS), or None for Taichi's default of one
+            thread per core, which oversubscribes the machine with several
+            workers.
+        pin_cpus: If True, pin every worker to its own threads_per_worker
+            CPUs (Linux only), wrapping around if there are more workers
+            than CPUs.
+        initializer: Top-level function called as initializer(worker_id)
+            in every worker before its first job, with worker ids
+            0 .. n_workers - 1, e.g. to configure the environment Taichi is
+            initialized with.
+    """
+
+    def __init__(self, target, n_workers=None, threads_per_worker=None,
+                 pin_cpus=False, initializer=None):
+        cpus = available_cpus()
+        threads = threads_per_worker or 1
+        self.n_workers = n_workers or max(1, len(cpus) // threads)
+        # Time spent by workers on jobs, and wall time spent in map(), since
+        # the last reset_stats().
+        self.busy_time = 0.0
+        self.wall_time = 0.0
+        # spawn, so that workers never inherit a Taichi runtime from the parent.
+        ctx = mp.get_context('spawn')
+        self.job_queue = ctx.Queue()
+        self.conns = []
+        self.workers = []
+        for k in range(self.n_workers):
+            worker_cpus = None
+            if pin_cpus:
+                worker_cpus = [cpus[(k * threads + i) % len(cpus)]
+                               for i in range(threads)]
+            parent_conn, child_conn = ctx.Pipe()
+            worker = ctx.Process(target=_worker_loop,
+                                 args=(target, self.job_queue, child_conn,
+                                       threads_per_worker, worker_cpus,
+                                       initializer, k),
+                                 daemon=True)
+            worker.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+
+    def map(self, jobs, on_progress=None):
+        """
+        Run every job (a tuple of arguments for target) and return the results
+        in job order. on_progress(job_id, payload) is called in this process
+        for every report() of a job while the jobs run.
+        """
+        start = time.perf_counter()
+        jobs = list(jobs)
+        for job_id, args in enumerate(jobs):
+            self.job_queue.put((job_id, args))
+
+        results = [None] * len(jobs)
+        pending = len(jobs)
+        while pending:
+            for conn in wait(self.conns):
+                try:
+                    job_id, kind, payload = conn.recv()
+                except EOFError:
+                    raise RuntimeError('A worker process died unexpectedly.')
+                if kind == 'progress':
+                    if on_progress is not None:
+                        on_progress(job_id, payload)
+                    continue
+                if kind == 'error':
+                    raise RuntimeError(f'Job {jobs[job_id]} failed:\n{payload}')
+                results[job_id], busy = payload
+                self.busy_time += busy
+                pending -= 1
+        self.wall_time += time.perf_counter() - start
+        return results
+
+    def utilization(self):
+        """
+        Fraction of the worker time available during map() calls that was
+        spent on jobs, since the last reset_stats().
+        """
+        if self.wall_time == 0:
+            return 0.0
+        return self.busy_time / (self.wall_time * self.n_workers)
+
+    def reset_stats(self):
+        self.busy_time = 0.0
+        self.wall_time = 0.0
+
+    def close(self, terminate=False):
+        """
+        Shut the workers down once they finish their current job, or
+        immediately if terminate is True.
+        """
+        for worker in self.workers:
+            if terminate:
+                worker.terminate()
+            else:
+                self.job_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        for conn in self.conns:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(terminate=exc_type is not None)